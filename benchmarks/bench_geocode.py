@@ -0,0 +1,61 @@
+"""
+Lookups per second of the offline reverse geocoding index against a linear scan over the same places,
+on a synthetic GeoNames postal code file. Nominatim, which the index replaces, allows about one lookup a second.
+
+Run with `python -m benchmarks.bench_geocode`
+"""
+import os
+import random
+import argparse
+import tempfile
+from time import perf_counter
+from src import geocode
+
+
+def synthetic_postal_file(path: str, places: int, seed: int = 1):
+    """Places spread over India, in the columns of a GeoNames postal code file"""
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(places):
+            lat, lng = rng.uniform(8, 35), rng.uniform(68, 97)
+            f.write(f"IN\t{100000 + i}\tPlace {i}\tState {i % 36}\t{i % 36}\tDistrict {i % 700}\t{i % 700}\t\t\t{lat:.4f}\t{lng:.4f}\t4\n")
+
+
+def linear_nearest(points: list[tuple[float, float]], lat: float, lng: float):
+    return min(range(len(points)), key=lambda i: geocode.distance_km(lat, lng, *points[i]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--places", type=int, default=150_000)
+    parser.add_argument("--lookups", type=int, default=20_000)
+    parser.add_argument("--checks", type=int, default=50, help="lookups compared against the linear scan")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source, output = os.path.join(directory, "IN.txt"), os.path.join(directory, "geonames.idx")
+        synthetic_postal_file(source, args.places)
+        start = perf_counter()
+        geocode.build_index([source], output)
+        print(f"built the index of {args.places} places in {perf_counter() - start:.1f} s, {os.path.getsize(output) / 2**20:.1f} MiB")
+
+        start = perf_counter()
+        index = geocode.GeoIndex(output)
+        print(f"opened the index in {(perf_counter() - start) * 1e6:.0f} us")
+
+        rng = random.Random(2)
+        queries = [(rng.uniform(8, 35), rng.uniform(68, 97)) for _ in range(args.lookups)]
+        start = perf_counter()
+        for lat, lng in queries:
+            index.nearest(lat, lng)
+        elapsed = perf_counter() - start
+        print(f"index:  {args.lookups / elapsed:10.0f} lookups/s, {elapsed / args.lookups * 1e6:8.1f} us per lookup")
+
+        points = [(index.lats[i], index.lngs[i]) for i in range(len(index))]
+        start = perf_counter()
+        for lat, lng in queries[:args.checks]:
+            expected = linear_nearest(points, lat, lng)
+            assert index.nearest(lat, lng)["distance_km"] == geocode.distance_km(lat, lng, *points[expected])
+        elapsed = perf_counter() - start
+        print(f"linear: {args.checks / elapsed:10.1f} lookups/s, {elapsed / args.checks * 1e6:8.1f} us per lookup")
+        index.close()
@@ -0,0 +1,61 @@
+"""
+Compares one-off `requests.request` calls against the pooled session used by `Keka.make_request`
+
+Run with `python -m benchmarks.bench_http_session`
+"""
+import json
+import argparse
+import statistics
+import requests
+from time import perf_counter
+from src.helpers import get_http_session
+from benchmarks.stub_server import start_stub_server
+
+
+# the calls made by a single `Keka.punch`
+PUNCH_CALLS = [
+    ("GET", "me/publicprofile"),
+    ("GET", "me/leave/calendarevents"),
+    ("GET", "dashboard/holidays"),
+    ("POST", "mytime/attendance/remoteclockin"),
+]
+
+
+def run(request, base_url: str, punches: int):
+    timings = []
+    for _ in range(punches):
+        start = perf_counter()
+        for method, path in PUNCH_CALLS:
+            request(method, base_url + path, data=json.dumps({}), timeout=(5, 30)).raise_for_status()
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def summarize(name: str, timings: list[float], connections: int):
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(
+        f"{name:<10} mean: {statistics.mean(timings) * 1000:8.2f} ms/punch  "
+        f"p50: {statistics.median(timings) * 1000:8.2f} ms  p99: {p99 * 1000:8.2f} ms  "
+        f"connections: {connections}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--punches", type=int, default=50)
+    parser.add_argument("--handshake-delay", type=float, default=0.02, help="seconds per new connection")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    args = parser.parse_args()
+
+    server = start_stub_server(handshake_delay=args.handshake_delay, latency=args.latency)
+
+    timings = run(requests.request, server.base_url, args.punches)
+    summarize("unpooled", timings, server.connections)
+
+    server.connections = 0
+    session = get_http_session()
+    timings = run(session.request, server.base_url, args.punches)
+    summarize("pooled", timings, server.connections)
+
+    server.shutdown()
@@ -0,0 +1,229 @@
+"""
+Load test of punches, state reads and work time queries through the api, against the stub server,
+for growing numbers of simulated users. The api (`main:app`) runs under uvicorn in a process of its own,
+so the numbers include its async client and executor. Every user sends its requests one after the other
+with its own token, and the users of a run start together. Reports the p50/p99 latency and the throughput
+of every operation, and writes them as json to compare versions with `--compare`.
+
+Run with `python -m benchmarks.bench_load --users 1 10 500 --latency 0.02 --json results.json`
+"""
+import os
+import tempfile
+
+# a throwaway db shared with the api process, set before `config` reads the env
+os.environ.setdefault("DB_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-load-"), "data.sqlite"))
+
+import sys
+import json
+import time
+import httpx
+import config
+import socket
+import asyncio
+import secrets
+import argparse
+import platform
+import statistics
+import subprocess
+from src.user import User
+from time import perf_counter
+from datetime import datetime, timedelta
+from benchmarks.stub_server import start_stub_server, stub_jwt
+
+
+LAT, LNG = "22.5726", "88.3639"
+LOCATION = {
+    "latitude": LAT, "longitude": LNG, "city": "Kolkata", "countryCode": "IN", "state": "West Bengal",
+    "zip": "700001", "addressLine1": "Kolkata, West Bengal, 700001",
+}
+# the route of every operation, under `/users/{email}`, and whether an answer counts as a success
+OPERATIONS = {
+    "punch": ("/punch?force=true", lambda response: response.status_code == 200),
+    "state": ("/punch/state", lambda response: response.status_code == 200),
+    "work_time": (
+        f"/work_time_for_date?for_date={datetime.now().date().isoformat()}", lambda response: response.status_code == 200,
+    ),
+}
+
+
+def make_users(count: int):
+    """Users saved with a cached location and a token valid for a day, so the api neither geocodes nor logs in"""
+    config.DB.upsert_record(config.LOCATION_DB, LOCATION, f"{LAT},{LNG}")
+    emails = []
+    for i in range(count):
+        email = f"user{i}@example.com"
+        now = datetime.now().astimezone()
+        token = stub_jwt({"sub": email, "iat": int(now.timestamp()), "exp": int((now + timedelta(days=1)).timestamp())})
+        config.DB.upsert_record(config.TOKEN_DB, {"email": email, "token": token, "timestamp": now.isoformat()}, email)
+        User(email, "secret", LAT, LNG, tz="Asia/Kolkata")
+        emails.append(email)
+    config.DB.flush()
+    return emails
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_api(server, admin_token: str, log_path: str, timeout: float = 60):
+    """Starts the api on a free port in a process of its own, pointed at the stub, and waits until it answers"""
+    port = free_port()
+    env = os.environ | {
+        "KEKA_BASE_API_URL": server.base_url,
+        "NTFY_URL": server.ntfy_url,
+        "NOTIFY_SPOOL_PATH": os.path.join(os.path.dirname(os.environ["SQLITE_DB_PATH"]), "outbox.sqlite"),
+        "ADMIN_TOKEN": admin_token,
+        "KEKA_USERNAME": "user0@example.com",
+        "USER_LAT": LAT,
+        "USER_LNG": LNG,
+        "SCHEDULER_METRICS_PORT": "0",
+    }
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+            env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The api exited with {process.returncode}, see {log_path}")
+        try:
+            if httpx.get(url + "/scheduler/schedules").status_code == 200:
+                return process, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"The api didn't start within {timeout}s, see {log_path}")
+
+
+def percentile(timings: list[float], share: float):
+    return timings[min(len(timings) - 1, int(len(timings) * share))]
+
+
+async def run(url: str, admin_token: str, emails: list[str], operation: str, iterations: int):
+    """Every user sends the request of the operation `iterations` times, returns the latencies, the errors and the wall time"""
+    path, succeeded = OPERATIONS[operation]
+    timings: list[float] = []
+    errors = 0
+    start_line = asyncio.Event()
+
+    async def user(client: httpx.AsyncClient, email: str):
+        nonlocal errors
+        await start_line.wait()
+        for _ in range(iterations):
+            start = perf_counter()
+            try:
+                ok = succeeded(await client.get(f"/users/{email}{path}"))
+            except httpx.HTTPError:
+                ok = False
+            timings.append(perf_counter() - start)
+            errors += not ok
+
+    async with httpx.AsyncClient(
+        base_url=url, headers={"Authorization": f"Bearer {admin_token}"}, timeout=120,
+        limits=httpx.Limits(max_connections=len(emails), max_keepalive_connections=len(emails)),
+    ) as client:
+        # the first request of a user loads it in the api, it isn't timed
+        await asyncio.gather(*(client.get(f"/users/{x}/details") for x in emails))
+        tasks = [asyncio.create_task(user(client, x)) for x in emails]
+        await asyncio.sleep(0)
+        start = perf_counter()
+        start_line.set()
+        await asyncio.gather(*tasks)
+        wall = perf_counter() - start
+    return sorted(timings), errors, wall
+
+
+def summarize(users: int, operation: str, timings: list[float], errors: int, wall: float):
+    return {
+        "users": users,
+        "operation": operation,
+        "count": len(timings),
+        "errors": errors,
+        "p50_ms": round(statistics.median(timings) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+        "throughput": round(len(timings) / wall, 1),
+    }
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list[dict], path: str):
+    with open(path) as f:
+        baseline = {(x["users"], x["operation"]): x for x in json.load(f)["results"]}
+    print(f"\nCompared to {path}:")
+    for result in results:
+        old = baseline.get((result["users"], result["operation"]))
+        if old:
+            print(
+                f"{result['users']:>5} users  {result['operation']:<10} p50: {result['p50_ms'] / old['p50_ms']:6.2f}x  "
+                f"p99: {result['p99_ms'] / old['p99_ms']:6.2f}x  throughput: {result['throughput'] / old['throughput']:6.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="*", default=[1, 10, 500])
+    parser.add_argument("--iterations", type=int, default=20, help="requests per user and run")
+    parser.add_argument("--operations", nargs="*", default=list(OPERATIONS), choices=list(OPERATIONS))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request of the stub")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random seconds per request of the stub")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the stub's answers that fail")
+    parser.add_argument("--json", help="writes the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    emails = make_users(max(args.users))
+    admin_token = secrets.token_urlsafe(16)
+    log_path = os.path.join(os.path.dirname(os.environ["SQLITE_DB_PATH"]), "api.log")
+    api, url = start_api(server, admin_token, log_path)
+
+    results = []
+    try:
+        for users in args.users:
+            for operation in args.operations:
+                requests, injected = server.requests, server.errors
+                result = summarize(users, operation, *asyncio.run(run(url, admin_token, emails[:users], operation, args.iterations)))
+                # reads swallow failed answers, so the errors the stub injected are reported on their own
+                result |= {"requests": server.requests - requests, "injected_errors": server.errors - injected}
+                results.append(result)
+                print(
+                    f"{users:>5} users  {operation:<10} p50: {result['p50_ms']:9.2f} ms  p99: {result['p99_ms']:9.2f} ms  "
+                    f"throughput: {result['throughput']:9.1f}/s  errors: {result['errors']}/{result['count']}  "
+                    f"injected: {result['injected_errors']}/{result['requests']}"
+                )
+    finally:
+        api.terminate()
+        api.wait(timeout=30)
+    print(
+        f"stub: {server.requests} requests, {server.errors} injected errors, {server.connections} connections, "
+        f"{len(server.notifications)} ntfy posts; api logs in {log_path}"
+    )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "version": version(),
+                "timestamp": datetime.now().astimezone().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "db_backend": os.environ["DB_BACKEND"],
+                "settings": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+                "results": results,
+            }, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
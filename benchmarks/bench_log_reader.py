@@ -0,0 +1,88 @@
+"""
+Times `log_utils.read_logs` on a large synthetic json log, against the full read of `helpers.get_logs` before it
+
+Run with `python -m benchmarks.bench_log_reader --size-mb 2048`
+"""
+import os
+import argparse
+import tempfile
+import tracemalloc
+from time import perf_counter
+from src.models import LogModel
+from src.log_utils import read_logs
+from datetime import datetime, timedelta
+
+
+def legacy_get_logs(log_file: str, length: int = 100):
+    # the previous implementation, kept as is for comparison
+    with open(log_file) as f:
+        logs = f.read()
+        log_model_keys = list(LogModel.schema().get("properties", {}).keys())
+        valid_logs = list(filter(lambda x: [y for y in log_model_keys if y in x], logs.split("\n")))
+        valid_logs = [LogModel.parse_raw(x) for x in valid_logs]
+    length = (len(valid_logs), length) [length >= 0]
+    return valid_logs[-length:][::-1]
+
+
+def write_log(path: str, size_mb: int, start: datetime = datetime(2023, 1, 1)):
+    """Writes about `size_mb` of records a second apart, one in a thousand of them an error"""
+    written, i = 0, 0
+    with open(path, "w") as f:
+        while written < size_mb * 2 ** 20:
+            lines = []
+            for _ in range(10_000):
+                severity = "ERROR" if i % 1000 == 0 else "INFO"
+                timestamp = (start + timedelta(seconds=i)).isoformat()
+                lines.append(
+                    f'{{"message": "[root] Ran {i % 7} job(s) now, punch {i}", '
+                    f'"severity": "{severity}", "timestamp": "{timestamp}"}}'
+                )
+                i += 1
+            # tracebacks and prints end up in the same file
+            lines.append("Traceback (most recent call last):")
+            chunk = "\n".join(lines) + "\n"
+            f.write(chunk)
+            written += len(chunk)
+    return start + timedelta(seconds=i)
+
+
+def timed(name: str, func):
+    start = perf_counter()
+    result = func()
+    elapsed = perf_counter() - start
+    # measured on a second run, tracing allocations slows the first one down too much
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<40} {elapsed * 1000:10.2f} ms  peak memory: {peak / 2 ** 20:8.2f} MiB")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--legacy-size-mb", type=int, default=50, help="size of the log read by the old implementation")
+    parser.add_argument("--path", help="log file to (re)use, a temporary file by default")
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.gettempdir(), f"bench-{args.size_mb}mb.log")
+    if not os.path.exists(path) or os.path.getsize(path) < args.size_mb * 2 ** 20:
+        start = perf_counter()
+        end = write_log(path, args.size_mb)
+        print(f"wrote {os.path.getsize(path) / 2 ** 20:.0f} MiB in {perf_counter() - start:.1f}s")
+    end = datetime.fromisoformat(read_logs(path, 1)[0][0]["timestamp"])
+    print(f"{path}: {os.path.getsize(path) / 2 ** 20:.0f} MiB")
+
+    for length in (10, 100, 1000):
+        timed(f"latest {length}", lambda: read_logs(path, length))
+    records, cursor = timed("errors, latest 100", lambda: read_logs(path, 100, severity="ERROR"))
+    timed("errors, next page", lambda: read_logs(path, 100, severity="ERROR", cursor=cursor))
+    timed("contains 'punch 4242'", lambda: read_logs(path, 1, contains="punch 4242", since=end - timedelta(hours=1)))
+    timed("last hour, all", lambda: read_logs(path, -1, since=end - timedelta(hours=1)))
+
+    legacy_path = path + ".legacy"
+    write_log(legacy_path, args.legacy_size_mb)
+    timed(f"legacy get_logs, {args.legacy_size_mb} MiB, latest 100", lambda: legacy_get_logs(legacy_path, 100))
+    timed(f"read_logs, {args.legacy_size_mb} MiB, latest 100", lambda: read_logs(legacy_path, 100))
+    os.remove(legacy_path)
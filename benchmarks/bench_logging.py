@@ -0,0 +1,115 @@
+"""
+Records per second of the json `LoggingFormatter` against the pydantic one before it,
+and the time a logging call takes on the calling thread with and without the queue
+
+Run with `python -m benchmarks.bench_logging`
+"""
+import os
+import queue
+import logging
+import argparse
+from time import perf_counter
+from datetime import datetime
+from src.models import LogModel
+from src.log_utils import LoggingFormatter
+from logging.handlers import QueueHandler, QueueListener
+
+
+class LegacyFormatter(logging.Formatter):
+    # the previous implementation, kept as is for comparison
+    def format(self, record: logging.LogRecord) -> str:
+        s = super().format(record)
+        return LogModel(
+            message=s,
+            severity=record.levelname,
+            timestamp=datetime.fromtimestamp(record.created).isoformat()[:-7],
+        ).json()
+
+
+class SlowStream:
+    """A stream whose writes block for a while, like stdout piped to a busy consumer"""
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def write(self, text: str):
+        deadline = perf_counter() + self.delay
+        while perf_counter() < deadline:
+            pass
+
+    def flush(self):
+        pass
+
+
+def records(count: int):
+    return [
+        logging.LogRecord("root", logging.INFO, __file__, 1, "Punched in %s after %d retries", ("a@b.com", i), None)
+        for i in range(count)
+    ]
+
+
+def format_rate(formatter: logging.Formatter, count: int):
+    batch = records(count)
+    start = perf_counter()
+    for record in batch:
+        formatter.format(record)
+    return count / (perf_counter() - start)
+
+
+def call_rate(logger: logging.Logger, count: int, level: int = logging.INFO):
+    start = perf_counter()
+    for i in range(count):
+        logger.log(level, "Punched in %s after %d retries", "a@b.com", i)
+    return count / (perf_counter() - start)
+
+
+def handler(formatter: logging.Formatter, delay: float = 0):
+    handler = logging.StreamHandler(SlowStream(delay) if delay else open(os.devnull, "w"))
+    handler.setFormatter(formatter)
+    return handler
+
+
+def queued_rate(logger: logging.Logger, target: logging.Handler, count: int):
+    """Calls per second on the calling thread, and the seconds the listener took to drain the queue after"""
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, target)
+    listener.start()
+    logger.handlers = [QueueHandler(log_queue)]
+    rate = call_rate(logger, count)
+    start = perf_counter()
+    listener.stop()
+    return rate, perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--sink-delay", type=float, default=0.0002, help="seconds every write to the slow sink blocks")
+    args = parser.parse_args()
+
+    fmt = "[%(name)s] %(message)s"
+    legacy = format_rate(LegacyFormatter(fmt=fmt), args.records)
+    fast = format_rate(LoggingFormatter(fmt=fmt), args.records)
+    print(f"format   pydantic: {legacy:12,.0f} records/s  json: {fast:12,.0f} records/s  speedup: {fast / legacy:.1f}x")
+
+    logger = logging.getLogger("bench")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    logger.handlers = [handler(LegacyFormatter(fmt=fmt))]
+    sync_legacy = call_rate(logger, args.records)
+    logger.handlers = [handler(LoggingFormatter(fmt=fmt))]
+    sync_fast = call_rate(logger, args.records)
+    queued, drain = queued_rate(logger, handler(LoggingFormatter(fmt=fmt)), args.records)
+    skipped = call_rate(logger, args.records, logging.DEBUG)
+    print(f"calling thread, pydantic formatter, sync:   {sync_legacy:12,.0f} calls/s")
+    print(f"calling thread, json formatter, sync:       {sync_fast:12,.0f} calls/s")
+    print(f"calling thread, json formatter, queued:     {queued:12,.0f} calls/s  (drained in {drain * 1000:.0f} ms)")
+    print(f"calling thread, debug call below the level: {skipped:12,.0f} calls/s")
+
+    # with a sink that blocks, the calling thread no longer waits for it
+    count = args.records // 20
+    logger.handlers = [handler(LoggingFormatter(fmt=fmt), args.sink_delay)]
+    sync_slow = call_rate(logger, count)
+    queued_slow, drain = queued_rate(logger, handler(LoggingFormatter(fmt=fmt), args.sink_delay), count)
+    print(f"calling thread, {args.sink_delay * 1e6:.0f} us sink, sync:        {sync_slow:12,.0f} calls/s")
+    print(f"calling thread, {args.sink_delay * 1e6:.0f} us sink, queued:      {queued_slow:12,.0f} calls/s  (drained in {drain * 1000:.0f} ms)")
@@ -0,0 +1,108 @@
+"""
+Cold start time and peak RSS of the api (`import main`) and of the scheduler (the imports of `schedule.py`),
+each measured in a fresh interpreter with `-X importtime`, with and without the heavy modules
+the code used to import at load. Exits with 1 when a budget is exceeded.
+
+Run with `python -m benchmarks.bench_startup --budget-ms 1500 --budget-rss-mb 150`
+"""
+import os
+import re
+import ast
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+# modules that only some code paths need
+HEAVY_MODULES = ["selenium", "pandas", "deta", "geopy", "trio", "httpx", "webdriver_manager"]
+# what the modules imported at load before the imports were deferred, kept for comparison
+EAGER_IMPORTS = "import selenium.webdriver, selenium.webdriver.support.ui, httpx\ntry:\n    import deta\nexcept ImportError:\n    pass\n"
+
+PROBE = """
+import sys, json, time, resource
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+print("STARTUP " + json.dumps({{
+    "seconds": seconds,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy_modules": [x for x in {heavy!r} if x in sys.modules],
+}}))
+"""
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def top_level_imports(path: str):
+    """The import statements at the top level of a script, to import what it needs without running it"""
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(x) for x in tree.body if isinstance(x, (ast.Import, ast.ImportFrom)))
+
+
+def measure(code: str):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(code=code, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True, env=os.environ | {"PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    result = next((json.loads(x[len("STARTUP "):]) for x in process.stdout.splitlines() if x.startswith("STARTUP ")), None)
+    if result is None:
+        raise RuntimeError(f"The probe failed:\n{process.stderr[-2000:]}")
+    # cumulative microseconds of every top level import, of the interpreter and of the probe
+    modules = [
+        (match.group(4), int(match.group(1)), int(match.group(2)))
+        for match in map(IMPORT_TIME.match, process.stderr.splitlines()) if match and not match.group(3)
+    ]
+    result["slowest"] = [
+        {"module": name, "ms": cumulative / 1000} for name, _, cumulative in sorted(modules, key=lambda x: -x[2])[:5]
+    ]
+    return result
+
+
+def summarize(runs: list[dict]):
+    return {
+        "median_ms": round(statistics.median(x["seconds"] for x in runs) * 1000, 1),
+        "min_ms": round(min(x["seconds"] for x in runs) * 1000, 1),
+        "rss_mb": round(statistics.median(x["rss_mb"] for x in runs), 1),
+        "heavy_modules": runs[-1]["heavy_modules"],
+        "slowest": runs[-1]["slowest"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=None, help="maximum median startup time of any target")
+    parser.add_argument("--budget-rss-mb", type=float, default=None, help="maximum peak RSS of any target")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    targets = {
+        "api": "import main",
+        "scheduler": top_level_imports("schedule.py"),
+    }
+    results = {}
+    for name, code in targets.items():
+        results[name] = summarize([measure(code) for _ in range(args.repeat)])
+        results[f"{name} (eager)"] = summarize([measure(EAGER_IMPORTS + code) for _ in range(args.repeat)])
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, result in results.items():
+            print(
+                f"{name:<18} median: {result['median_ms']:8.1f} ms  min: {result['min_ms']:8.1f} ms  "
+                f"rss: {result['rss_mb']:6.1f} MiB  heavy: {', '.join(result['heavy_modules']) or '-'}"
+            )
+            print("    slowest: " + ", ".join(f"{x['module']} {x['ms']:.0f} ms" for x in result["slowest"]))
+
+    over = [
+        name for name, result in results.items() if "(eager)" not in name and (
+            (args.budget_ms is not None and result["median_ms"] > args.budget_ms)
+            or (args.budget_rss_mb is not None and result["rss_mb"] > args.budget_rss_mb)
+        )
+    ]
+    if over:
+        print(f"Over budget: {', '.join(over)}", file=sys.stderr)
+        sys.exit(1)
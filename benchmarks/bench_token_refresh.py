@@ -0,0 +1,113 @@
+"""
+Times token refreshes over plain http (`src/auth.py`) against the identity endpoints of the stub server,
+after checking the flow end to end with assertions: a rejected password, the PKCE exchange, the claims
+and expiry of the token, `Keka.refresh_token` saving it, and the fallback to the browser login when
+the http login fails. The browser login is replaced by a stand-in that records it was called.
+
+Run with `python -m benchmarks.bench_token_refresh`
+"""
+import os
+import tempfile
+
+# a throwaway db, set before `config` reads the env
+os.environ.setdefault("DB_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-token-"), "data.sqlite"))
+
+import time
+import config
+import argparse
+import statistics
+from src import auth
+from src.keka import Keka
+from src.user import User
+from time import perf_counter
+from benchmarks.stub_server import start_stub_server, stub_jwt
+from benchmarks.bench_load import LAT, LNG, LOCATION
+
+
+EMAIL, PASSWORD = "user@example.com", "secret"
+
+
+def check_http_login(server):
+    try:
+        auth.login_over_http(EMAIL, "wrong")
+        raise AssertionError("a wrong password was accepted")
+    except auth.AuthError as e:
+        print(f"wrong password: {e}")
+
+    before = int(time.time())
+    response = auth.login_over_http(EMAIL, PASSWORD)
+    # the stub only issues a token for a code whose verifier matches the challenge of the authorization
+    assert response["token_type"] == "Bearer" and response["expires_in"] == server.token_lifetime, response
+    claims = auth.token_claims(response["access_token"])
+    assert claims["sub"] == EMAIL, claims
+    assert before <= claims["iat"] <= time.time(), claims
+    assert auth.token_expiry(response["access_token"]).timestamp() == claims["iat"] + server.token_lifetime
+    assert not server.codes, "the authorization code wasn't redeemed"
+    print(f"http login: token of {claims['sub']} expiring in {response['expires_in']}s")
+
+
+def check_refresh(server):
+    config.DB.upsert_record(config.LOCATION_DB, LOCATION, f"{LAT},{LNG}")
+    keka = Keka(User(EMAIL, PASSWORD, LAT, LNG, tz="Asia/Kolkata", save=False))
+    browser_logins = []
+
+    def browser_login(headless=True):
+        browser_logins.append(keka.user.passw)
+        return stub_jwt({"sub": EMAIL, "exp": int(time.time()) + 60, "browser": True}), {"url": "stub"}, None
+
+    keka._token_from_browser = browser_login
+
+    # over http, the browser isn't needed
+    data = keka.refresh_token()
+    assert not browser_logins, "fell back to the browser although the http login worked"
+    saved = config.DB.read_record(config.TOKEN_DB, EMAIL)
+    assert saved["token"] == data["token"] and "browser" not in auth.token_claims(saved["token"]), saved
+    assert keka.token_status()["expiry_source"] == "claims"
+    assert keka.get_token() == data["token"]
+    print("refresh over http: token saved and used")
+
+    # a rejected http login falls back to the browser with `auto`, not with `http`
+    keka.user.passw = "wrong"
+    data = keka.refresh_token()
+    assert browser_logins == ["wrong"], browser_logins
+    assert auth.token_claims(data["token"]).get("browser") is True, data
+    assert config.DB.read_record(config.TOKEN_DB, EMAIL)["token"] == data["token"]
+    config.TOKEN_REFRESH_STRATEGY = "http"
+    try:
+        assert "token" not in keka.refresh_token() and len(browser_logins) == 1, browser_logins
+    finally:
+        config.TOKEN_REFRESH_STRATEGY = "auto"
+    keka.user.passw = PASSWORD
+    print("refresh falling back to the browser: token saved, no fallback with TOKEN_REFRESH_STRATEGY=http")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--refreshes", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency)
+    for name, value in server.identity_settings.items():
+        setattr(config, name, value)
+    config.NTFY_URL = server.ntfy_url
+    config.NOTIFY_SPOOL_PATH = os.path.join(os.path.dirname(os.environ["SQLITE_DB_PATH"]), "outbox.sqlite")
+    server.credentials[EMAIL] = PASSWORD
+
+    check_http_login(server)
+    check_refresh(server)
+
+    timings = []
+    for _ in range(args.refreshes):
+        start = perf_counter()
+        auth.login_over_http(EMAIL, PASSWORD)
+        timings.append(perf_counter() - start)
+
+    timings.sort()
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(
+        f"{args.refreshes} http refreshes  mean: {statistics.mean(timings) * 1000:.2f} ms  "
+        f"p50: {statistics.median(timings) * 1000:.2f} ms  p99: {p99 * 1000:.2f} ms  "
+        f"requests: {server.requests}"
+    )
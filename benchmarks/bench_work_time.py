@@ -0,0 +1,93 @@
+"""
+Compares `attendance.pair_punches` against the pandas pipeline `get_work_time_for_date` used before it
+
+Run with `python -m benchmarks.bench_work_time`, after `pip install -r benchmarks/requirements.txt` for pandas
+"""
+import random
+import argparse
+from time import perf_counter
+from itertools import zip_longest
+from src import attendance
+from datetime import date, datetime, timedelta
+
+
+def pandas_work_time(data: dict, dt: date):
+    # the previous implementation, kept as is for comparison
+    import pandas as pd
+
+    clockin_requests = [
+        y
+        for x in data.get("remoteClockInRequests", [])
+        for y in x.get("timeEntries", [])
+        if x.get("requestDate") == dt.isoformat()
+    ]
+    if len(clockin_requests) == 0:
+        return timedelta(seconds=0)
+    df = pd.DataFrame.from_records(clockin_requests)[["punchStatus", "actualTimestamp"]]
+    if len(df)%2 == 1 or df.iloc[-1]["punchStatus"] != 1:
+        last_punch_ts = datetime.fromisoformat(df.iloc[-1]["actualTimestamp"])
+        df.loc[len(df)] = (
+            [1, last_punch_ts.isoformat()] if last_punch_ts.date() == dt
+            else [1, datetime.now().isoformat()]
+        )
+
+    return timedelta(seconds=sum(map(
+        lambda x: (datetime.fromisoformat(x[1]) - datetime.fromisoformat(x[0])).total_seconds(),
+        df.groupby("punchStatus")
+        .agg({"actualTimestamp": list})
+        .transpose()
+        .apply(lambda x: zip_longest(x[0], x[1], fillvalue=datetime.now()), axis=1)
+        .iloc[0]
+    )))
+
+
+def synthetic_day(day: date, punches: int):
+    """A day of alternating, closed punch ins and outs, spread evenly over the day"""
+    start = datetime.combine(day, datetime.min.time())
+    step = timedelta(days=1) / (punches + 1)
+    entries = [
+        {"punchStatus": i % 2, "actualTimestamp": (start + step * (i + 1)).isoformat()}
+        for i in range(punches - punches % 2)
+    ]
+    return {"remoteClockInRequests": [{"requestDate": day.isoformat(), "timeEntries": entries}]}
+
+
+def best_of(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        timings.append(perf_counter() - start)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10, 1_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    start = perf_counter()
+    import pandas
+    print(f"importing pandas took {(perf_counter() - start) * 1000:.0f} ms")
+
+    day = date(2023, 1, 9)
+    for size in args.sizes:
+        data = synthetic_day(day, size)
+        old, old_result = best_of(lambda: pandas_work_time(data, day), args.repeat)
+        new, new_result = best_of(
+            lambda: attendance.pair_punches(attendance.clockin_entries(data, day), day), args.repeat
+        )
+        assert old_result == new_result, (old_result, new_result)
+        print(
+            f"{size:>8} punches  pandas: {old * 1000:10.3f} ms  streaming: {new * 1000:10.3f} ms  "
+            f"speedup: {old / new:8.1f}x"
+        )
+
+        # out of order entries cost a sort, the result stays the same
+        random.shuffle(data["remoteClockInRequests"][0]["timeEntries"])
+        shuffled, shuffled_result = best_of(
+            lambda: attendance.pair_punches(attendance.clockin_entries(data, day), day), args.repeat
+        )
+        assert shuffled_result == new_result
+        print(f"{size:>8} punches  streaming, out of order: {shuffled * 1000:10.3f} ms")
@@ -0,0 +1,317 @@
+"""
+A local stand-in for the Keka endpoints used by `src/keka.py`, the identity server used by `src/auth.py`
+and ntfy. Punches are kept per bearer token, so the attendance requests of a user list their punches.
+Every answer can be delayed (`latency` plus up to `jitter` seconds) and a share of them (`error_rate`)
+fails with `error_status`.
+
+It can be run on its own with `python -m benchmarks.stub_server --port 8089`
+and pointed at by setting `KEKA_BASE_API_URL=http://127.0.0.1:8089/k/dashboard/api/`,
+`KEKA_IDENTITY_URL=http://127.0.0.1:8089/`, `KEKA_CLIENT_ID=stub-client`,
+`KEKA_REDIRECT_URI=http://127.0.0.1:8089/callback` and `NTFY_URL=http://127.0.0.1:8089/ntfy`
+"""
+import json
+import time
+import random
+import base64
+import socket
+import hashlib
+import secrets
+import argparse
+import threading
+from html import escape
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qsl, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+API_PREFIX = "/k/dashboard/api"
+NTFY_PREFIX = "/ntfy"
+
+
+def public_profile(handler: "KekaStubHandler", params: dict, body: dict):
+    return 200, {"id": "stub-employee-id", "displayName": "Stub User"}
+
+
+def leave_calendar_events(handler: "KekaStubHandler", params: dict, body: dict):
+    return 200, {"teamLeaveRequests": []}
+
+
+def holidays(handler: "KekaStubHandler", params: dict, body: dict):
+    year = datetime.now().year
+    return 200, {"value": [{"name": "New Year", "date": f"{year}-01-01T00:00:00"}]}
+
+
+def attendance_requests(handler: "KekaStubHandler", params: dict, body: dict):
+    start, end = params.get("fromDate", "")[:10], params.get("toDate", "9999")[:10]
+    with handler.server.lock:
+        punches = list(handler.server.punches.get(handler.headers.get("authorization"), []))
+    days: dict[str, list[dict]] = {}
+    for punch in punches:
+        day = punch["actualTimestamp"][:10]
+        if start <= day <= end:
+            days.setdefault(day, []).append(punch)
+    return 200, {"remoteClockInRequests": [{"requestDate": day, "timeEntries": entries} for day, entries in days.items()]}
+
+
+def remote_clock_in(handler: "KekaStubHandler", params: dict, body: dict):
+    body = body or {}
+    # recorded like keka records them, without the trailing `Z` of the payload
+    punch = {"punchStatus": body.get("originalPunchStatus", 0), "actualTimestamp": body.get("timestamp", "").rstrip("Z")}
+    with handler.server.lock:
+        handler.server.punches.setdefault(handler.headers.get("authorization"), []).append(punch)
+    return 200, {"succeeded": True}
+
+
+def ntfy_publish(handler: "KekaStubHandler", params: dict, body: dict):
+    with handler.server.lock:
+        handler.server.notifications.append((handler.path[len(NTFY_PREFIX) + 1:], handler.raw_body.decode()))
+    return 200, {"id": secrets.token_hex(6), "event": "message"}
+
+
+LOGIN_PAGE = """<html><body>
+<form method="post" action="/Account/Login">
+  <input type="hidden" name="ReturnUrl" value="{return_url}">
+  <input type="hidden" name="__RequestVerificationToken" value="{antiforgery}">
+  <input type="email" name="Email" id="email">
+  <input type="password" name="Password" id="password">
+  {error}
+  <button type="submit">Login</button>
+</form>
+</body></html>"""
+
+
+def stub_jwt(claims: dict):
+    """An unsigned jwt, enough for clients that only read its claims"""
+    encode = lambda x: base64.urlsafe_b64encode(json.dumps(x).encode()).rstrip(b"=").decode()
+    return f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(claims)}.stub"
+
+
+def login_page(handler: "KekaStubHandler", return_url: str, error: str = ""):
+    antiforgery = secrets.token_urlsafe(16)
+    handler.server.antiforgery.add(antiforgery)
+    html = LOGIN_PAGE.format(
+        return_url=escape(return_url), antiforgery=antiforgery,
+        error=f'<span class="text-danger">{escape(error)}</span>' if error else "",
+    )
+    return 200, html, {"Set-Cookie": f"antiforgery={antiforgery}; Path=/; HttpOnly"}
+
+
+def authorize(handler: "KekaStubHandler", params: dict, body: dict):
+    if params.get("client_id") != handler.server.client_id:
+        return 400, {"error": "invalid_client"}
+    return 302, "", {"Location": "/Account/Login?" + urlencode({"ReturnUrl": "/connect/authorize/callback?" + urlencode(params)})}
+
+
+def login_form(handler: "KekaStubHandler", params: dict, body: dict):
+    return login_page(handler, params.get("ReturnUrl", "/"))
+
+
+def login(handler: "KekaStubHandler", params: dict, body: dict):
+    body = body or {}
+    antiforgery = body.get("__RequestVerificationToken")
+    if antiforgery not in handler.server.antiforgery or handler.cookies.get("antiforgery") != antiforgery:
+        return 400, {"error": "invalid antiforgery token"}
+    password = handler.server.credentials.get(body.get("Email"))
+    if not body.get("Email") or (password is not None and password != body.get("Password")):
+        return login_page(handler, body.get("ReturnUrl", "/"), "Invalid email or password")
+    session = secrets.token_urlsafe(16)
+    handler.server.sessions[session] = body["Email"]
+    return 302, "", {"Location": body.get("ReturnUrl", "/"), "Set-Cookie": f"idsrv={session}; Path=/; HttpOnly"}
+
+
+def authorize_callback(handler: "KekaStubHandler", params: dict, body: dict):
+    email = handler.server.sessions.get(handler.cookies.get("idsrv"))
+    if email is None:
+        return authorize(handler, params, body)
+    code = secrets.token_urlsafe(16)
+    handler.server.codes[code] = (email, params)
+    location = params["redirect_uri"] + "?" + urlencode({"code": code, "state": params.get("state", "")})
+    return 302, "", {"Location": location}
+
+
+def token(handler: "KekaStubHandler", params: dict, body: dict):
+    body = body or {}
+    email, authorization = handler.server.codes.pop(body.get("code"), (None, {}))
+    challenge = base64.urlsafe_b64encode(
+        hashlib.sha256(body.get("code_verifier", "").encode()).digest()
+    ).rstrip(b"=").decode()
+    if (
+        email is None
+        or body.get("client_id") != authorization.get("client_id")
+        or body.get("redirect_uri") != authorization.get("redirect_uri")
+        or challenge != authorization.get("code_challenge")
+    ):
+        return 400, {"error": "invalid_grant"}
+    now = int(time.time())
+    claims = {"sub": email, "iat": now, "exp": now + handler.server.token_lifetime}
+    return 200, {"access_token": stub_jwt(claims), "expires_in": handler.server.token_lifetime, "token_type": "Bearer"}
+
+
+def redirect_target(handler: "KekaStubHandler", params: dict, body: dict):
+    return 200, "<html><body>dashboard</body></html>"
+
+
+ROUTES = {
+    ("GET", "/me/publicprofile"): public_profile,
+    ("GET", "/me/leave/calendarevents"): leave_calendar_events,
+    ("GET", "/dashboard/holidays"): holidays,
+    ("GET", "/mytime/attendance/attendancerequests"): attendance_requests,
+    ("POST", "/mytime/attendance/remoteclockin"): remote_clock_in,
+    # identity server
+    ("GET", "/connect/authorize"): authorize,
+    ("GET", "/Account/Login"): login_form,
+    ("POST", "/Account/Login"): login,
+    ("GET", "/connect/authorize/callback"): authorize_callback,
+    ("POST", "/connect/token"): token,
+    ("GET", "/callback"): redirect_target,
+}
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # hundreds of simulated users connect at once
+    request_queue_size = 1024
+
+    def __init__(
+        self, address, handshake_delay: float = 0.0, latency: float = 0.0, jitter: float = 0.0,
+        error_rate: float = 0.0, error_status: int = 503,
+    ):
+        super().__init__(address, KekaStubHandler)
+        # `handshake_delay` is paid once per new connection, mimicking a TCP+TLS handshake
+        self.handshake_delay = handshake_delay
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        # punches by the authorization header they were made with, and the (channel, message) sent to ntfy
+        self.punches: dict[str, list[dict]] = {}
+        self.notifications: list[tuple[str, str]] = []
+        # identity server, every email is accepted with any password unless it is in `credentials`
+        self.client_id = "stub-client"
+        self.credentials: dict[str, str] = {}
+        self.token_lifetime = 3600
+        self.antiforgery: set[str] = set()
+        self.sessions: dict[str, str] = {}
+        self.codes: dict[str, tuple[str, dict]] = {}
+
+    @property
+    def root_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def base_url(self):
+        return self.root_url.rstrip("/") + API_PREFIX + "/"
+
+    @property
+    def ntfy_url(self):
+        return self.root_url.rstrip("/") + NTFY_PREFIX
+
+    @property
+    def identity_settings(self):
+        """Config values pointing `src/auth.py` at this server"""
+        return {
+            "KEKA_IDENTITY_URL": self.root_url,
+            "KEKA_CLIENT_ID": self.client_id,
+            "KEKA_REDIRECT_URI": self.root_url + "callback",
+        }
+
+
+class KekaStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StubServer
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.handshake_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_route(self, method: str):
+        with self.server.lock:
+            self.server.requests += 1
+        url = urlparse(self.path)
+        path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path
+        params = dict(parse_qsl(url.query))
+        self.cookies = {k: v.value for k, v in SimpleCookie(self.headers.get("Cookie", "")).items()}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.raw_body = self.rfile.read(length) if length else b""
+        if "application/x-www-form-urlencoded" in self.headers.get("Content-Type", ""):
+            body = dict(parse_qsl(raw.decode()))
+        else:
+            try:
+                body = json.loads(raw or b"null")
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                body = None
+
+        if method == "POST" and path.startswith(NTFY_PREFIX + "/"):
+            route = ntfy_publish
+        else:
+            route = ROUTES.get((method, path.rstrip("/")))
+        time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        # routes answer with a status, a json body (or html, as a string) and optionally headers
+        if route and random.random() < self.server.error_rate:
+            with self.server.lock:
+                self.server.errors += 1
+            status, data, *headers = self.server.error_status, {"error": "Injected error"}
+        else:
+            status, data, *headers = route(self, params, body) if route else (404, {"error": "Not Found"})
+
+        payload = data.encode() if isinstance(data, str) else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html" if isinstance(data, str) else "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers[0] if headers else {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.handle_route("GET")
+
+    def do_POST(self):
+        self.handle_route("POST")
+
+
+def start_stub_server(
+    port: int = 0, handshake_delay: float = 0.0, latency: float = 0.0, jitter: float = 0.0,
+    error_rate: float = 0.0, error_status: int = 503,
+):
+    """Starts the stub on a daemon thread and returns the running server"""
+    server = StubServer(
+        ("127.0.0.1", port), handshake_delay=handshake_delay, latency=latency, jitter=jitter,
+        error_rate=error_rate, error_status=error_status,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Keka API")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--handshake-delay", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests that fail")
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+
+    server = StubServer(
+        ("127.0.0.1", args.port), args.handshake_delay, args.latency, args.jitter, args.error_rate, args.error_status,
+    )
+    print(f"Serving stub Keka API on {server.base_url}, ntfy on {server.ntfy_url}")
+    print("Identity server settings: " + " ".join(f"{k}={v}" for k, v in server.identity_settings.items()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
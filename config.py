@@ -4,12 +4,12 @@ from enum import Enum, IntEnum
 from dotenv import load_dotenv
 from src.log_utils import get_logger
 
-DB = get_db()
-LOGGER = get_logger()
-
 # read from .env file
 load_dotenv()
 
+DB = get_db()
+LOGGER = get_logger()
+
 KEKA_USERNAME = os.environ.get("KEKA_USERNAME", "")
 KEKA_PASSWORD = os.environ.get("KEKA_PASSWORD", "")
 
@@ -18,10 +18,99 @@ USER_LNG = os.environ.get("USER_LNG", 88.4112943)
 
 USER_TIMEZONE = os.environ.get("USER_TIMEZONE", "Asia/Kolkata")
 
+# offline reverse geocoding index, built with `python -m src.geocode build`. Places farther than
+# `GEOCODE_MAX_DISTANCE_KM` from a user are not used, and `GEOCODE_REFINE` asks Nominatim for the full address too
+GEOCODE_INDEX_PATH = os.environ.get("GEOCODE_INDEX_PATH", "data/geonames.idx")
+GEOCODE_MAX_DISTANCE_KM = float(os.environ.get("GEOCODE_MAX_DISTANCE_KM", 25))
+GEOCODE_REFINE = os.environ.get("GEOCODE_REFINE", "false").lower() in ("1", "true", "yes")
+
+# key used to encrypt the keka passwords of the users in `USERS_DB`,
+# generate one with `python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"`
+TENANT_SECRET_KEY = os.environ.get("TENANT_SECRET_KEY", "")
+# bearer token of `/users` and the routes under `/users/{email}`, which are refused while it isn't set
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# tokens are refreshed in the background this long before they expire (at most a quarter of their lifetime),
+# plus a delay of up to `TOKEN_REFRESH_JITTER` seconds that differs for every user so they don't refresh together
+TOKEN_REFRESH_LEAD = int(os.environ.get("TOKEN_REFRESH_LEAD", 6 * 60 * 60))
+TOKEN_REFRESH_JITTER = int(os.environ.get("TOKEN_REFRESH_JITTER", 60 * 60))
+# seconds between two checks of the scheduler for tokens due for a refresh
+TOKEN_CHECK_INTERVAL = int(os.environ.get("TOKEN_CHECK_INTERVAL", 10 * 60))
+# a token this close to its expiry is not used anymore
+TOKEN_EXPIRY_MARGIN = int(os.environ.get("TOKEN_EXPIRY_MARGIN", 5 * 60))
+
+# seconds after which a prefetched quarter of leaves is fetched again
+LEAVE_CACHE_TTL = int(os.environ.get("LEAVE_CACHE_TTL", 3600))
+# statuses of the leave requests keka has approved, as numbers or names, only these keep a user from punching
+LEAVE_APPROVED_STATUSES = {x.strip().lower() for x in os.environ.get("LEAVE_APPROVED_STATUSES", "1,approved").split(",") if x.strip()}
+
+# weekdays nobody works on, 0 is monday
+WEEKEND_DAYS = {int(x) for x in os.environ.get("WEEKEND_DAYS", "5,6").split(",") if x.strip()}
+# the scheduler precomputes the working days of every user this many days ahead, every night at
+# `CALENDAR_REFRESH_TIME` in their timezone, and logs the next `PLANNED_PUNCHES_SHOWN` punches it planned
+WORKING_DAY_HORIZON = int(os.environ.get("WORKING_DAY_HORIZON", 14))
+CALENDAR_REFRESH_TIME = os.environ.get("CALENDAR_REFRESH_TIME", "00:30")
+PLANNED_PUNCHES_SHOWN = int(os.environ.get("PLANNED_PUNCHES_SHOWN", 10))
+
+# attendance of a date range is fetched in chunks of this many days
+ATTENDANCE_CHUNK_DAYS = int(os.environ.get("ATTENDANCE_CHUNK_DAYS", 31))
+ATTENDANCE_MAX_DAYS = int(os.environ.get("ATTENDANCE_MAX_DAYS", 366))
+
+# number of users punched in parallel by the scheduler
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 16))
+# daily punch times in the timezone of every user, each user is punched after a random delay of
+# `PUNCH_MIN_JITTER` to `PUNCH_MAX_JITTER` seconds. These are the defaults, `/scheduler/schedules` overrides them
+PUNCH_IN_TIME = os.environ.get("PUNCH_IN_TIME", "10:00")
+PUNCH_OUT_TIME = os.environ.get("PUNCH_OUT_TIME", "20:00")
+PUNCH_MIN_JITTER = int(os.environ.get("PUNCH_MIN_JITTER", 2))
+PUNCH_MAX_JITTER = int(os.environ.get("PUNCH_MAX_JITTER", 600))
+# seconds between two checks of the scheduler for changed schedules and new timezones
+SCHEDULE_WATCH_INTERVAL = float(os.environ.get("SCHEDULE_WATCH_INTERVAL", 60))
+# number of chrome instances allowed to run at once while refreshing tokens
+MAX_CONCURRENT_BROWSERS = int(os.environ.get("MAX_CONCURRENT_BROWSERS", 2))
+
+# log file of the scheduler, read by `/scheduler/get_logs`. Every process writes its own file, set with `LOG_FILE`,
+# and rotates it by `LOG_MAX_BYTES` and `LOG_ROTATE_INTERVAL` seconds into `LOG_COMPRESSION` (gzip, zstd or none)
+# compressed segments, keeping `LOG_BACKUP_COUNT` of them
+SCHEDULER_LOG_FILE = os.environ.get("SCHEDULER_LOG_FILE", "logs/scheduler.log")
+
+# the scheduler writes its pid, last loop time, next jobs and queue depth to this file every
+# `HEARTBEAT_INTERVAL` seconds, the api reports it as not running after `HEARTBEAT_STALE_AFTER` seconds without a beat
+SCHEDULER_HEARTBEAT_FILE = os.environ.get("SCHEDULER_HEARTBEAT_FILE", "logs/scheduler.heartbeat.json")
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 15))
+HEARTBEAT_STALE_AFTER = float(os.environ.get("HEARTBEAT_STALE_AFTER", 60))
+# the beat comes from a thread of its own, so the scheduler is also reported as not running once its loop or
+# its next job is late by more than `SCHEDULER_LOOP_GRACE` seconds, as when the loop hangs
+SCHEDULER_LOOP_GRACE = float(os.environ.get("SCHEDULER_LOOP_GRACE", 60))
+# the scheduler serves its prometheus metrics on this port, proxied by the api at `/scheduler/metrics`, 0 disables it
+SCHEDULER_METRICS_HOST = os.environ.get("SCHEDULER_METRICS_HOST", "127.0.0.1")
+SCHEDULER_METRICS_PORT = int(os.environ.get("SCHEDULER_METRICS_PORT", 9101))
+
+# notifications are sent to `NTFY_URL`/<channel> by a background worker, from a sqlite spool at `NOTIFY_SPOOL_PATH`.
+# Notifications of a channel within `NOTIFY_COALESCE_WINDOW` seconds are sent as one, failed ones are retried
+# `NOTIFY_MAX_ATTEMPTS` times, after `NOTIFY_RETRY_BACKOFF` seconds doubling up to `NOTIFY_MAX_BACKOFF`
+NTFY_URL = os.environ.get("NTFY_URL", "https://ntfy.sh")
+NOTIFY_SPOOL_PATH = os.environ.get("NOTIFY_SPOOL_PATH", "db/outbox.sqlite")
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", 4))
+NOTIFY_COALESCE_WINDOW = float(os.environ.get("NOTIFY_COALESCE_WINDOW", 1))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", 8))
+NOTIFY_RETRY_BACKOFF = float(os.environ.get("NOTIFY_RETRY_BACKOFF", 2))
+NOTIFY_MAX_BACKOFF = float(os.environ.get("NOTIFY_MAX_BACKOFF", 10 * 60))
+NOTIFY_CONNECT_TIMEOUT = float(os.environ.get("NOTIFY_CONNECT_TIMEOUT", 5))
+NOTIFY_READ_TIMEOUT = float(os.environ.get("NOTIFY_READ_TIMEOUT", 10))
+
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
 
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
-# CHROME_DRIVER_PATH = PROJECT_ROOT + "/chromedriver"
+# chromedriver binary, looked up on the PATH and then downloaded by webdriver-manager when not set
+CHROME_DRIVER_PATH = os.environ.get("CHROME_DRIVER_PATH", "")
+
+# seconds a browser login may take in total, and seconds to wait for any single page element
+LOGIN_TIMEOUT = float(os.environ.get("LOGIN_TIMEOUT", 90))
+LOGIN_STEP_TIMEOUT = float(os.environ.get("LOGIN_STEP_TIMEOUT", 30))
+# how the token is read from the browser after login, `cdp` listens to the network events of chrome
+# over the devtools protocol, `logs` reads chrome's performance logs
+TOKEN_CAPTURE_MODE = os.environ.get("TOKEN_CAPTURE_MODE", "cdp")
 
 SUCCESS = "Success"
 FAIL = "Fail"
@@ -49,12 +138,31 @@ STATE_DB = "state"
 TOKEN_DB = "token"
 LOCATION_DB = "location"
 HOLIDAYS_DB = "holidays"
+SCHEDULES_DB = "schedules"
 
 
 KEKA_SUBDOMAIN = os.environ.get("KEKA_SUBDOMAIN", "fiftyfive")
 
 KEKA_LOGIN_URL = f"https://{KEKA_SUBDOMAIN}.keka.com/"
-KEKA_BASE_API_URL = f"https://{KEKA_SUBDOMAIN}.keka.com/k/dashboard/api/"
+KEKA_BASE_API_URL = os.environ.get(
+    "KEKA_BASE_API_URL", f"https://{KEKA_SUBDOMAIN}.keka.com/k/dashboard/api/"
+)
+
+# identity server of keka, used to log in over plain http without a browser when the client id is set
+KEKA_IDENTITY_URL = os.environ.get("KEKA_IDENTITY_URL", "https://app.keka.com/")
+KEKA_CLIENT_ID = os.environ.get("KEKA_CLIENT_ID", "")
+KEKA_REDIRECT_URI = os.environ.get("KEKA_REDIRECT_URI", f"https://{KEKA_SUBDOMAIN}.keka.com")
+KEKA_OAUTH_SCOPE = os.environ.get("KEKA_OAUTH_SCOPE", "openid offline_access")
+# how tokens are refreshed, `http` logs in without a browser, `browser` with chrome,
+# and `auto` tries `http` first and falls back to `browser`
+TOKEN_REFRESH_STRATEGY = os.environ.get("TOKEN_REFRESH_STRATEGY", "auto")
+
+# pooled http session used for every call to the keka api
+KEKA_POOL_SIZE = int(os.environ.get("KEKA_POOL_SIZE", 10))
+KEKA_MAX_RETRIES = int(os.environ.get("KEKA_MAX_RETRIES", 3))
+KEKA_RETRY_BACKOFF = float(os.environ.get("KEKA_RETRY_BACKOFF", 0.5))
+KEKA_CONNECT_TIMEOUT = float(os.environ.get("KEKA_CONNECT_TIMEOUT", 5))
+KEKA_READ_TIMEOUT = float(os.environ.get("KEKA_READ_TIMEOUT", 30))
 
 
 USER_AGENT = os.environ.get(
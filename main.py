@@ -1,78 +1,152 @@
 import os
+import hmac
+import json
 
-import psutil
 import config
 import uvicorn
 from src import helpers
 from src.models import *
 from src.user import User
-from src.keka import Keka
-from fastapi import FastAPI
-from datetime import datetime, date
-from fastapi.responses import PlainTextResponse
+from src.tenants import Tenant, TenantRegistry
+from src.heartbeat import heartbeat_status
+from src.schedules import load_schedules, save_schedule
+from src.async_keka import AsyncKeka, run_blocking, close_async_client
+from src import attendance
+from datetime import datetime, date, timedelta
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Security
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 app = FastAPI(title="Auto Keka", description="Automation API for Keka", version="0.0.1")
 
-user = User()
-keka = Keka(user)
+registry = TenantRegistry(keka_cls=AsyncKeka)
+
+
+@app.on_event("startup")
+async def startup():
+    # the default user reads the db and may geocode its location, so it is set up once the app starts
+    # instead of when `main` is imported
+    registry.set_default(await run_blocking(User))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_async_client()
+    await run_blocking(config.DB.flush)
+
+
+admin_bearer = HTTPBearer(
+    auto_error=False, description="`ADMIN_TOKEN`, needed by `/users`, the routes under it and `PUT /scheduler/schedules`",
+)
+
+
+def require_admin(credentials: HTTPAuthorizationCredentials | None = Security(admin_bearer)):
+    if not config.ADMIN_TOKEN:
+        raise HTTPException(403, "Other users can't be managed until `ADMIN_TOKEN` is set")
+    if credentials is None or not hmac.compare_digest(credentials.credentials.encode(), config.ADMIN_TOKEN.encode()):
+        raise HTTPException(401, "Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+
+# the email of the routes under `/users/{email}` is read by `get_tenant`, so it is documented on them by hand
+EMAIL_PATH = {"parameters": [{"name": "email", "in": "path", "required": True, "schema": {"type": "string"}}]}
+
+
+def get_tenant(request: Request, credentials: HTTPAuthorizationCredentials | None = Security(admin_bearer)):
+    """
+    Routes under `/users/{email}` act on that user and need the admin token,
+    the rest act on the user from the env vars
+    """
+    # only taken from the path, so that `?email=` can't pick another user on the routes without a prefix
+    email = request.path_params.get("email")
+    if email is None:
+        return registry.default
+    require_admin(credentials)
+    try:
+        return registry.get(email)
+    except KeyError:
+        raise HTTPException(404, f"User {email!r} not found")
+
+
+@app.get("/users", response_model=list[ReturnUser], dependencies=[Depends(require_admin)])
+def get_users():
+    return [tenant.user.get_user() for tenant in registry.load()]
+
+
+@app.post("/users", response_model=ReturnUser, dependencies=[Depends(require_admin)])
+def add_user(new_user: NewUser):
+    tenant = registry.register(new_user.email, new_user.passw, new_user.lat, new_user.lng, new_user.timezone)
+    return tenant.user.get_user()
 
 
 @app.get("/punch", description="`Punch In` or `Punch Out` based on last punch status")
-def punch_with_opposite_type(force: bool = False):
-    status_code, message = keka.punch(force=force)
+@app.get("/users/{email}/punch", description="`Punch In` or `Punch Out` based on last punch status", openapi_extra=EMAIL_PATH)
+async def punch_with_opposite_type(force: bool = False, tenant: Tenant = Depends(get_tenant)):
+    status_code, message = await tenant.keka.punch(force=force)
     return PlainTextResponse(message, status_code=status_code)
 
 
 @app.get("/punch/state")
-def get_punch_state():
-    punch_status, timestamp = keka.retrieve_state()
+@app.get("/users/{email}/punch/state", openapi_extra=EMAIL_PATH)
+def get_punch_state(tenant: Tenant = Depends(get_tenant)):
+    punch_status, timestamp = tenant.keka.retrieve_state()
     punch_message = config.punch_message_map[punch_status.value]
     return {
         "punch_status": punch_message,
         "timestamp": timestamp,
         "message": helpers.format_time_delta(
-            f"{punch_message} ", datetime.now(user.timezone) - timestamp, " ago"
+            f"{punch_message} ", datetime.now(tenant.user.timezone) - timestamp, " ago"
         ),
     }
 
 
 @app.get("/punch/{punch_type}", description="**0** for `Punch In`, **1** for `Punch Out`")
-def punch_with_given_type(punch_type: config.AllowedPunchType, force: bool = False):
+@app.get("/users/{email}/punch/{punch_type}", description="**0** for `Punch In`, **1** for `Punch Out`", openapi_extra=EMAIL_PATH)
+async def punch_with_given_type(
+    punch_type: config.AllowedPunchType, force: bool = False, tenant: Tenant = Depends(get_tenant)
+):
     punch_type = config.PunchType(punch_type.value)
-    status_code, message = keka.punch(punch_type, force=force)
+    status_code, message = await tenant.keka.punch(punch_type, force=force)
     return PlainTextResponse(message, status_code=status_code)
 
 
 @app.get("/token/refresh")
-async def refresh_token():
-    keka.refresh_token(headless=True)
-    return get_token_age()
+@app.get("/users/{email}/token/refresh", openapi_extra=EMAIL_PATH)
+async def refresh_token(tenant: Tenant = Depends(get_tenant)):
+    # selenium blocks for a long time, so the login runs in the executor to keep the other routes responsive
+    await run_blocking(tenant.keka.refresh_token, headless=True)
+    return await run_blocking(get_token_age, tenant)
 
 
 @app.get("/token/age")
-def get_token_age():
-    token_age, timestamp = keka.get_token_age(auto_load=True)
+@app.get("/users/{email}/token/age", openapi_extra=EMAIL_PATH)
+def get_token_age(tenant: Tenant = Depends(get_tenant)):
+    token_age, timestamp = tenant.keka.get_token_age(auto_load=True)
     return {
-        "email": user.email,
+        "email": tenant.email,
         "token_age": token_age.total_seconds(),
         "timestamp": timestamp,
         "message": helpers.format_time_delta("Token is ", token_age, " old"),
+        **tenant.keka.token_status(),
     }
 
 
 @app.get("/user/details", response_model=ReturnUser)
-def get_user():
-    return user.get_user()
+@app.get("/users/{email}/details", response_model=ReturnUser, openapi_extra=EMAIL_PATH)
+def get_user(tenant: Tenant = Depends(get_tenant)):
+    return tenant.user.get_user()
 
 
 @app.get("/user/keka_profile")
-def get_keka_profile():
-    return keka.get_keka_profile()
+@app.get("/users/{email}/keka_profile", openapi_extra=EMAIL_PATH)
+async def get_keka_profile(tenant: Tenant = Depends(get_tenant)):
+    return await tenant.keka.get_keka_profile()
 
 
 @app.get("/user/work_time_for_date", description="Gives total working time for a given date. Date format: `YYYY-MM-DD`")
-def get_work_time_for_date(for_date: str):
-    work_time = keka.get_work_time_for_date(for_date:=date.fromisoformat(for_date))
+@app.get("/users/{email}/work_time_for_date", description="Gives total working time for a given date. Date format: `YYYY-MM-DD`", openapi_extra=EMAIL_PATH)
+async def get_work_time_for_date(for_date: str, tenant: Tenant = Depends(get_tenant)):
+    work_time = await tenant.keka.get_work_time_for_date(for_date:=date.fromisoformat(for_date))
     return {
         "total_seconds": work_time.total_seconds(),
         "formatted_time": helpers.format_time_delta(td=work_time),
@@ -80,14 +154,145 @@ def get_work_time_for_date(for_date: str):
     }
 
 
+def work_time_line(key: str, value: str, work_time: timedelta, **extra):
+    return json.dumps({
+        key: value,
+        "total_seconds": work_time.total_seconds(),
+        "formatted_time": helpers.format_time_delta(td=work_time),
+        **extra,
+    }) + "\n"
+
+
+@app.get(
+    "/user/work_time_for_range",
+    description=(
+        "Streams the working time of every day from `from_date` to `to_date` as NDJSON, "
+        "followed by weekly, monthly and overall totals. Date format: `YYYY-MM-DD`"
+    ),
+)
+@app.get(
+    "/users/{email}/work_time_for_range",
+    description=(
+        "Streams the working time of every day from `from_date` to `to_date` as NDJSON, "
+        "followed by weekly, monthly and overall totals. Date format: `YYYY-MM-DD`"
+    ),
+    openapi_extra=EMAIL_PATH,
+)
+async def get_work_time_for_range(from_date: str, to_date: str, tenant: Tenant = Depends(get_tenant)):
+    from_date, to_date = date.fromisoformat(from_date), date.fromisoformat(to_date)
+    if to_date < from_date:
+        raise HTTPException(400, "`to_date` is before `from_date`")
+    if (to_date - from_date).days >= config.ATTENDANCE_MAX_DAYS:
+        raise HTTPException(400, f"The range can't be longer than {config.ATTENDANCE_MAX_DAYS} days")
+
+    async def lines():
+        days = {}
+        async for day, work_time in tenant.keka.iter_work_time_for_range(from_date, to_date):
+            days[day] = work_time
+            yield work_time_line("date", day.isoformat(), work_time, day_of_week=day.strftime('%A').lower())
+        weeks, months = attendance.aggregate(days)
+        for week, work_time in weeks.items():
+            yield work_time_line("week", week, work_time)
+        for month, work_time in months.items():
+            yield work_time_line("month", month, work_time)
+        yield work_time_line("total", f"{from_date.isoformat()}/{to_date.isoformat()}", sum(days.values(), timedelta(0)))
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics", response_class=PlainTextResponse, description="Prometheus metrics of the api process")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get(
+    "/scheduler/metrics",
+    response_class=PlainTextResponse,
+    description="Prometheus metrics of the scheduler process, read from `SCHEDULER_METRICS_PORT`",
+)
+async def get_scheduler_metrics():
+    if not config.SCHEDULER_METRICS_PORT:
+        raise HTTPException(404, "The scheduler doesn't serve metrics, `SCHEDULER_METRICS_PORT` is 0")
+    import httpx
+
+    # not the client of keka, which sends its headers, retries and would take one of its connections
+    try:
+        async with httpx.AsyncClient(timeout=5, limits=httpx.Limits(max_connections=1)) as client:
+            response = await client.get(f"http://{config.SCHEDULER_METRICS_HOST}:{config.SCHEDULER_METRICS_PORT}/metrics")
+    except httpx.HTTPError as e:
+        raise HTTPException(503, f"Couldn't reach the scheduler: {e!r}")
+    return Response(response.content, status_code=response.status_code, media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/scheduler/is_running", response_model=bool)
 def is_scheduler_running():
-    return bool([x for x in psutil.process_iter(["pid", "name"]) if x.cmdline() and "schedule.py" in x.cmdline()])
+    return heartbeat_status()["healthy"]
+
+
+@app.get(
+    "/scheduler/status",
+    description=(
+        "Last heartbeat of the scheduler: pid, host, last loop time, next jobs and queue depth, with `healthy` "
+        "false and a `reason` when the beat is older than `HEARTBEAT_STALE_AFTER` seconds, the process is gone, "
+        "or the loop or the next job is late by more than `SCHEDULER_LOOP_GRACE` seconds"
+    ),
+)
+def get_scheduler_status(response: Response):
+    status = heartbeat_status()
+    if not status["healthy"]:
+        response.status_code = 503
+    return status
+
+
+@app.get("/scheduler/schedules", response_model=dict[str, ScheduleModel])
+def get_schedules():
+    return load_schedules()
+
+
+@app.put(
+    "/scheduler/schedules/{punch_type}",
+    response_model=ScheduleModel,
+    description=(
+        "Changes the daily time (`HH:MM` in every user's timezone) and random delay of `PUNCH_IN` or `PUNCH_OUT`. "
+        "The scheduler picks it up within `SCHEDULE_WATCH_INTERVAL` seconds, without a restart. "
+        "Needs the admin token since it moves the punches of every user."
+    ),
+    dependencies=[Depends(require_admin)],
+)
+def update_schedule(punch_type: str, schedule: ScheduleModel):
+    try:
+        return save_schedule(punch_type, schedule.dict())
+    except KeyError:
+        raise HTTPException(404, f"No schedule for {punch_type!r}")
+    except ValueError as e:
+        raise HTTPException(422, str(e))
 
 
-@app.get("/scheduler/get_logs", response_model=list[LogModel])
-def get_scheduler_logs(length: int = 100):
-    return helpers.get_logs("logs/scheduler.log", length)
+@app.get(
+    "/scheduler/get_logs",
+    response_model=list[LogModel],
+    description=(
+        "Latest logs of the scheduler, newest first. `severity` is the minimum severity, `since` and `until` "
+        "bound the timestamps and `contains` filters the messages. The `X-Next-Cursor` header holds the "
+        "`cursor` of the next (older) page and is missing on the last one. Rotated segments are searched too."
+    ),
+)
+def get_scheduler_logs(
+    response: Response,
+    length: int = 100,
+    severity: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    contains: str = None,
+    cursor: str = None,
+):
+    logs, next_cursor = helpers.get_logs(
+        config.SCHEDULER_LOG_FILE, length,
+        severity=severity, since=since, until=until, contains=contains, cursor=cursor,
+    )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return logs
 
 
 if __name__ == "__main__":
@@ -2,57 +2,333 @@ import time
 import random
 import config
 import datetime
-from src.keka import Keka
+import threading
+from src import metrics
+from pytz import timezone
+from functools import wraps
 from src.user import User
 from scheduler import Scheduler
 from src.helpers import format_time_delta
-from scheduler.trigger.core import Sunday
+from src.schedules import load_schedules
+from src.heartbeat import write_heartbeat, remove_heartbeat
+from src.tenants import Tenant, TenantRegistry
+from prometheus_client import start_http_server
+from concurrent.futures import ThreadPoolExecutor
 
 
-user = User()
-keka = Keka(user)
+registry = TenantRegistry()
+registry.set_default(User())
 
 logger = config.LOGGER
 schedule = Scheduler(tzinfo=datetime.timezone.utc)
+# punches and token refreshes of all the users share this pool
+pool = ThreadPoolExecutor(max_workers=config.SCHEDULER_WORKERS)
+# work handed to the pool that no worker has picked up yet, for the heartbeat
+queued = 0
+queued_lock = threading.Lock()
 
 
-def refresh_token():
-    keka.refresh_token(headless=True)
+def submit(job: str, func, *args):
+    """Hands `func` to the pool, measuring how long it waits for a worker"""
+    global queued
+    queued_at = time.monotonic()
 
+    def run():
+        global queued
+        with queued_lock:
+            queued -= 1
+        metrics.SCHEDULER_QUEUE_SECONDS.labels(job).observe(time.monotonic() - queued_at)
+        func(*args)
+    with queued_lock:
+        queued += 1
+    return pool.submit(run)
 
-def punch(punch_type: config.PunchType):
-    sleep_time = random.randint(2, 600)
-    logger.info(f"Sleeping for another {sleep_time} seconds before {config.punch_message_map[punch_type.value]}")
-    time.sleep(sleep_time)
-    status_code, message = keka.punch(punch_type, force=False)
-    logger.info(f"{message}, Status Code: {status_code}")
 
+def tenants_in(tz_name: str):
+    # reloading picks up users added through the api since the last run
+    return [x for x in registry.load() if x.user.timezone.zone == tz_name]
 
-TOKEN_ROTATION_TIME = Sunday(datetime.time(hour=22, minute=44, tzinfo=user.timezone))
-PUNCH_IN_TIME       = datetime.time(hour=10, minute=00, tzinfo=user.timezone)
-PUNCH_OUT_TIME      = datetime.time(hour=20, minute=00, tzinfo=user.timezone)
 
+# failures of the jobs by their name, since the last start, for the heartbeat
+failures: dict[str, int] = {}
 
-schedule.weekly(TOKEN_ROTATION_TIME, refresh_token)
-schedule.daily(PUNCH_IN_TIME, punch, args=(config.PunchType.PUNCH_IN,))
-schedule.daily(PUNCH_OUT_TIME, punch, args=(config.PunchType.PUNCH_OUT,))
 
+def job_failed(job: str):
+    failures[job] = failures.get(job, 0) + 1
+    metrics.SCHEDULER_JOB_FAILURES.labels(job).inc()
 
-try:
+
+def run_safely(func, tenant: Tenant, *args):
+    try:
+        func(tenant, *args)
+    except Exception:
+        job_failed(func.__name__)
+        logger.exception(f"{func.__name__} failed for {tenant.email}")
+
+
+# users whose token refresh is queued or running
+refreshing: set[str] = set()
+# a failed refresh is retried after an hour, not at every check
+retry_after: dict[str, float] = {}
+
+
+def refresh_token(tenant: Tenant, before: datetime.datetime = None):
+    try:
+        if tenant.keka.refresh_token_if_due(before=before) is False:
+            retry_after[tenant.email] = time.monotonic() + 60 * 60
+    finally:
+        refreshing.discard(tenant.email)
+
+
+def submit_refresh(tenant: Tenant, before: datetime.datetime = None):
+    if tenant.email not in refreshing and retry_after.get(tenant.email, 0) <= time.monotonic():
+        refreshing.add(tenant.email)
+        submit("refresh_token", run_safely, refresh_token, tenant, before)
+
+
+def punch(tenant: Tenant, punch_type: config.PunchType):
+    status_code, message = tenant.keka.punch(punch_type, force=False)
+    logger.info(f"{tenant.email}: {message}, Status Code: {status_code}")
+
+
+def submit_punch(tenant: Tenant, punch_type: config.PunchType):
+    submit("punch", run_safely, punch, tenant, punch_type)
+
+
+def run_job(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        job_failed(func.__name__)
+        logger.exception(f"Job {func.__name__}{args} failed")
+
+
+def in_pool(func):
+    """Job handle that hands `func` to the pool, so that no job holds up the loop or the other jobs"""
+    @wraps(func)
+    def submit_job(*args):
+        submit(func.__name__, run_job, func, *args)
+    return submit_job
+
+
+# the loop sleeps on this until the next job is due, or until jobs are added or changed
+wakeup = threading.Condition()
+changes = 0
+
+
+def jobs_changed():
+    global changes
+    with wakeup:
+        changes += 1
+        wakeup.notify_all()
+
+
+def planned_punches():
+    return sorted(schedule.get_jobs(tags={"punch"}), key=lambda x: x.datetime)
+
+
+def refresh_tokens():
+    # every token is refreshed ahead of its expiry, at a time that differs for every user,
+    # and the browser slots bound how many refresh at once
+    now = datetime.datetime.now(datetime.timezone.utc)
+    next_punches: dict[str, datetime.datetime] = {}
+    for job in planned_punches():
+        next_punches.setdefault(job.args[0].email, job.datetime)
+    for tenant in registry.load():
+        status = tenant.keka.token_status(now)
+        if now >= datetime.datetime.fromisoformat(status["refresh_at"]) or status["expires_in"] <= 0:
+            submit_refresh(tenant)
+        elif tenant.email in next_punches and next_punches[tenant.email] - now <= datetime.timedelta(seconds=config.TOKEN_CHECK_INTERVAL + 60):
+            # a token that would expire before the next punch is refreshed ahead of it, so the punch doesn't have to
+            submit_refresh(tenant, before=next_punches[tenant.email] + datetime.timedelta(seconds=60))
+
+
+# schedules of the daily punches, by the name of their punch type
+punch_schedules = load_schedules()
+# users whose punches are planned
+planned: set[str] = set()
+planning = threading.Lock()
+
+
+def plan_punches(tenant: Tenant, refresh: bool = False):
+    """
+    Replaces the planned punches of a user with one shot jobs on their working days up to the end of tomorrow,
+    at the time of the schedule plus a random delay. Days off get no jobs, and cost no call to keka.
+    """
+    tz = tenant.user.timezone
+    now = datetime.datetime.now(tz)
+    tomorrow = now.date() + datetime.timedelta(days=1)
+    if refresh:
+        # the nightly refresh fetches the holidays again, so that holidays edited in keka are picked up
+        tenant.keka.holidays.invalidate()
+    if refresh or not tenant.keka.working_days.covers(tomorrow):
+        tenant.keka.refresh_working_days(now.date())
+
+    with planning:
+        schedule.delete_jobs(tags={"punch", tenant.email})
+        for day in tenant.keka.working_days.upcoming(now.date()):
+            if day > tomorrow:
+                break
+            for punch_type in (config.PunchType.PUNCH_IN, config.PunchType.PUNCH_OUT):
+                settings = punch_schedules[punch_type.name]
+                at = tz.localize(datetime.datetime.combine(day, datetime.time.fromisoformat(settings["time"])))
+                # a punch planned again after its time has come is still made, within what is left of its delay
+                earliest = max(at + datetime.timedelta(seconds=settings["min_jitter"]), now + datetime.timedelta(seconds=1))
+                latest = at + datetime.timedelta(seconds=settings["max_jitter"])
+                if not settings["enabled"] or latest < earliest:
+                    continue
+                at = earliest + (latest - earliest) * random.random()
+                schedule.once(
+                    at.astimezone(datetime.timezone.utc), submit_punch, args=(tenant, punch_type), tags={"punch", tenant.email},
+                )
+        planned.add(tenant.email)
+
+
+def log_planned_punches(limit: int = config.PLANNED_PUNCHES_SHOWN):
+    jobs = planned_punches()
+    logger.info(
+        f"Next {min(limit, len(jobs))} of {len(jobs)} planned punch(es): " + "; ".join(
+            f"{config.punch_message_map[x.args[1].value]} {x.args[0].email} at "
+            f"{x.datetime.astimezone(x.args[0].user.timezone).isoformat(timespec='seconds')}"
+            for x in jobs[:limit]
+        )
+    )
+
+
+def plan_all(tz_name: str = None, refresh: bool = False):
+    """Plans the punches of the users in a timezone, or of everyone, one user after the other"""
+    for tenant in (tenants_in(tz_name) if tz_name else registry.load()):
+        run_safely(plan_punches, tenant, refresh)
+    jobs_changed()
+    log_planned_punches()
+
+
+def register_plans(schedules: dict[str, dict], tz_names: list[str]):
+    """
+    Registers the nightly refresh of the working days and the planning of the punches, once for
+    every timezone the users are in, and plans the punches with the given schedules right away
+    """
+    punch_schedules.update(schedules)
+    schedule.delete_jobs(tags={"nightly"})
+    for tz_name in tz_names:
+        schedule.daily(
+            datetime.time.fromisoformat(config.CALENDAR_REFRESH_TIME).replace(tzinfo=timezone(tz_name)),
+            in_pool(plan_all),
+            args=(tz_name, True),
+            tags={"nightly"},
+        )
+    submit("plan_all", run_job, plan_all)
+
+
+def watch_schedules(current: tuple):
+    """
+    Plans the punches again whenever their schedules change or a user in a new timezone is added,
+    and plans the punches of new users
+    """
     while True:
-        logger.info(f"Ran {schedule.exec_jobs()} job(s) now")
-        current_time = datetime.datetime.now(user.timezone)
-        logger.info(
-            "; ".join([
-            format_time_delta(
-                f"{x.handle.__name__}{tuple(str(y) for y in x.args)} will run after ", (x.datetime - current_time),
-            ) 
-            for x in schedule.get_jobs()])
+        time.sleep(config.SCHEDULE_WATCH_INTERVAL)
+        try:
+            tenants = registry.load()
+            latest = (load_schedules(), sorted({x.user.timezone.zone for x in tenants}))
+            if latest != current:
+                logger.info(f"Schedules changed to {latest[0]} for timezones {latest[1]}")
+                register_plans(*latest)
+                current = latest
+            elif any(x.email not in planned for x in tenants):
+                for tenant in [x for x in tenants if x.email not in planned]:
+                    run_safely(plan_punches, tenant)
+                jobs_changed()
+                log_planned_punches()
+        except Exception:
+            logger.exception("Couldn't reload the schedules")
+
+
+def describe_jobs(limit: int = 10):
+    current_time = datetime.datetime.now(registry.default.user.timezone)
+    jobs = sorted(schedule.get_jobs(), key=lambda x: x.datetime)
+    message = "; ".join([
+        format_time_delta(
+            f"{x.handle.__name__}{tuple(str(y) for y in x.args)} will run after ", (x.datetime - current_time),
         )
-        time_to_run_jobs = [x.timedelta() for x in schedule.get_jobs()]
-        least_delta = min(time_to_run_jobs)
-        least_delta = least_delta if least_delta.total_seconds() > 0 else 1
+        for x in jobs[:limit]
+    ])
+    return message + (f"; and {len(jobs) - limit} more job(s)" if len(jobs) > limit else "")
+
+
+started_at = time.time()
+last_loop_at = None
+# seconds the loop sleeps at most after `last_loop_at`
+loop_sleep = None
+
+
+def beat(limit: int = 10):
+    """Publishes the state of the scheduler for `/scheduler/status`"""
+    jobs = sorted(schedule.get_jobs(), key=lambda x: x.datetime)
+    metrics.SCHEDULER_JOBS.set(len(jobs))
+    write_heartbeat({
+        "started_at": started_at,
+        "last_loop_at": last_loop_at,
+        "loop_sleep": loop_sleep,
+        "jobs": len(jobs),
+        "planned_punches": sum(1 for x in jobs if "punch" in x.tags),
+        "queued": queued,
+        "refreshing": len(refreshing),
+        "failed_jobs": dict(failures),
+        "next_jobs": [
+            {"job": x.handle.__name__, "args": [str(y) for y in x.args], "at": x.datetime.isoformat()}
+            for x in jobs[:limit]
+        ],
+    })
+
+
+def heartbeat():
+    while True:
+        try:
+            beat()
+        except Exception:
+            logger.exception("Couldn't write the heartbeat")
+        time.sleep(config.HEARTBEAT_INTERVAL)
+
+
+def run_due_jobs():
+    """Runs the due jobs, observing how late each of them runs compared to when it was planned for"""
+    due = [(x.handle.__name__, x.datetime) for x in schedule.get_jobs() if x.timedelta() <= datetime.timedelta(0)]
+    count = schedule.exec_jobs()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for job, at in due:
+        metrics.SCHEDULER_DRIFT_SECONDS.labels(job).observe(max(0.0, (now - at).total_seconds()))
+    return count
+
+
+if config.SCHEDULER_METRICS_PORT:
+    # the api serves these at `/scheduler/metrics`
+    start_http_server(config.SCHEDULER_METRICS_PORT, addr=config.SCHEDULER_METRICS_HOST)
+
+schedule.cyclic(datetime.timedelta(seconds=config.TOKEN_CHECK_INTERVAL), in_pool(refresh_tokens))
+
+current = (punch_schedules, sorted({x.user.timezone.zone for x in registry.load()}))
+register_plans(*current)
+threading.Thread(target=watch_schedules, args=(current,), name="schedule-watcher", daemon=True).start()
+threading.Thread(target=heartbeat, name="heartbeat", daemon=True).start()
+
+
+try:
+    while True:
+        with wakeup:
+            seen = changes
+        # the handles only hand the work to the pool, so this returns right away
+        logger.info(f"Ran {run_due_jobs()} job(s) now")
+        last_loop_at = time.time()
+        least_delta = min((x.timedelta() for x in schedule.get_jobs()), default=datetime.timedelta(hours=1))
+        least_delta = max(least_delta, datetime.timedelta(seconds=0.1))
+        loop_sleep = least_delta.total_seconds()
+        beat()
+        logger.info(describe_jobs())
         logger.info(format_time_delta("Sleeping for ", least_delta))
-        time.sleep(least_delta.total_seconds())
+        with wakeup:
+            wakeup.wait_for(lambda: changes != seen, timeout=least_delta.total_seconds())
 except KeyboardInterrupt:
-    print()
\ No newline at end of file
+    pool.shutdown(wait=False, cancel_futures=True)
+    print()
+finally:
+    remove_heartbeat()
@@ -1,7 +1,8 @@
 #!/bin/bash
 
-nohup python3 -u schedule.py >> logs/scheduler.log &
-nohup uvicorn main:app --host 0.0.0.0 --port 5000 >> logs/api.log &
+# every process writes and rotates its own log file, stdout goes to the container's logs
+LOG_FILE=logs/scheduler.log nohup python3 -u schedule.py &
+LOG_FILE=logs/api.log nohup uvicorn main:app --host 0.0.0.0 --port 5000 &
 
 # Wait for any process to exit
 wait -n
@@ -0,0 +1,191 @@
+import config
+import asyncio
+from src import metrics
+from src import attendance
+from src.keka import Keka, logger, HOLIDAY_MESSAGE, LEAVE_MESSAGE
+from functools import partial
+from datetime import datetime
+
+
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+
+_client = None
+
+
+def get_async_client():
+    # one pooled client per process, shared by every `AsyncKeka` instance, httpx is imported with the first one
+    global _client
+    if _client is None or _client.is_closed:
+        import httpx
+
+        _client = httpx.AsyncClient(
+            headers=config.HEADERS,
+            limits=httpx.Limits(
+                max_connections=config.KEKA_POOL_SIZE,
+                max_keepalive_connections=config.KEKA_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(config.KEKA_READ_TIMEOUT, connect=config.KEKA_CONNECT_TIMEOUT),
+            transport=httpx.AsyncHTTPTransport(retries=config.KEKA_MAX_RETRIES),
+        )
+    return _client
+
+
+async def close_async_client():
+    if _client is not None:
+        await _client.aclose()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call (db, selenium, ...) in the default executor so the event loop stays free"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def none():
+    return None
+
+
+class AsyncKeka(Keka):
+    """`Keka` with every call to the Keka API made as a coroutine"""
+
+    async def _send(self, url: str, method: str, data: dict, params: dict, token: str):
+        kwargs = self._request_args(url, method, data, params, token)
+        kwargs["content"] = kwargs.pop("data")
+
+        # 5xx responses are retried with backoff, except for non idempotent methods like a punch
+        retries = config.KEKA_MAX_RETRIES if method.upper() in IDEMPOTENT_METHODS else 0
+        with metrics.timed(metrics.KEKA_REQUEST_SECONDS, method=method, endpoint=self._endpoint(kwargs["url"]), status="error") as labels:
+            for retry in range(retries + 1):
+                response = await get_async_client().request(**kwargs)
+                if response.status_code not in RETRY_STATUSES or retry == retries:
+                    break
+                await asyncio.sleep(config.KEKA_RETRY_BACKOFF * 2 ** retry)
+            labels["status"] = response.status_code
+        return response
+
+
+    async def make_request(self, url: str, method: str = "GET", data: dict = None, params: dict = None):
+        # the executor is only needed when the token isn't cached or has to be refreshed
+        token = self.cached_token() or await run_blocking(self.get_token)
+        response = await self._send(url, method, data, params, token)
+        if response.status_code == 401:
+            logger.warning("Keka rejected the token, getting a new one")
+            await run_blocking(self.invalidate_token, token)
+            response = await self._send(url, method, data, params, await run_blocking(self.get_token))
+        return response
+
+
+    async def get_or_ingest_data(self, url: str, method: str = "GET",
+        ingest=False, db_path: str = None, data: dict = None, params: dict = None
+    ):
+        response = await self.make_request(url, method=method, data=data, params=params)
+        if ingest:
+            return await run_blocking(self._parse_response, url, response, ingest, db_path)
+        return self._parse_response(url, response)
+
+
+    async def get_leaves_for_date(self, dt: datetime):
+        return await self.get_leaves_for_range(dt, dt)
+
+
+    async def get_leaves_for_range(self, from_date: datetime, to_date: datetime):
+        return await self.get_or_ingest_data(
+            "/me/leave/calendarevents",
+            params={"fromDate": from_date.isoformat(), "toDate": to_date.isoformat()}
+        )
+
+
+    async def get_last_30_days_summary(self):
+        return await self.get_or_ingest_data(
+            "https://fiftyfive.keka.com/k/attendance/api/mytime/attendance/summary",
+        )
+
+
+    async def get_attendance_requests(self, from_date: datetime, to_date: datetime):
+        return await self.get_or_ingest_data(
+            "/mytime/attendance/attendancerequests",
+            params={"fromDate": from_date.isoformat(), "toDate": to_date.isoformat()},
+        )
+
+
+    async def get_work_time_for_date(self, dt: datetime):
+        return self._work_time_from_attendance(await self.get_attendance_requests(dt, dt), dt)
+
+
+    async def iter_work_time_for_range(self, from_date: datetime, to_date: datetime):
+        """
+        Yields the time worked on every day of the range in order. The chunks of
+        `ATTENDANCE_CHUNK_DAYS` days are all fetched concurrently.
+        """
+        chunks = list(attendance.date_chunks(from_date, to_date, config.ATTENDANCE_CHUNK_DAYS))
+        tasks = [asyncio.ensure_future(self.get_attendance_requests(start, end)) for start, end in chunks]
+        try:
+            for (start, end), task in zip(chunks, tasks):
+                for day, work_time in self._work_time_by_day(await task, start, end).items():
+                    yield day, work_time
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+    async def get_work_time_for_range(self, from_date: datetime, to_date: datetime):
+        return {day: work_time async for day, work_time in self.iter_work_time_for_range(from_date, to_date)}
+
+
+    async def get_keka_profile(self):
+        return await self.get_or_ingest_data("/me/publicprofile")
+
+
+    async def is_leave(self, dt: datetime):
+        start, end = self.leaves.window(dt)
+        # the profile and the leaves of the quarter are fetched concurrently, only when not cached
+        profile, leaves = await asyncio.gather(
+            self.get_keka_profile() if self.leaves.employee_id is None else none(),
+            self.get_leaves_for_range(start, end) if self.leaves.needs_fetch(dt) else none(),
+        )
+        self._update_leaves(profile, leaves, start, end)
+        return self.leaves.is_leave(dt)
+
+
+    async def is_holiday_or_weekend(self, dt: datetime):
+        if not self.holidays.covers(dt):
+            await run_blocking(self.holidays.load)
+        if not self.holidays.covers(dt):
+            holidays = await self.get_or_ingest_data("/dashboard/holidays")
+            if holidays:
+                await run_blocking(self.holidays.update, holidays, dt.year)
+        return self._is_holiday_or_weekend_from(dt)
+
+
+    async def punch(self, punch_type: config.PunchType | None = None, force: bool = False):
+        with metrics.timed(metrics.PUNCH_SECONDS, punch_type=getattr(punch_type, "name", "AUTO"), status="error") as labels:
+            status, message = await self._punch(punch_type, force)
+            labels["status"] = status
+        return status, message
+
+
+    async def _punch(self, punch_type: config.PunchType | None, force: bool):
+        punch_type, result = await run_blocking(self._prepare_punch, punch_type, force)
+        if result:
+            return result
+
+        user_current_time = datetime.now(self.user.timezone)
+
+        if not force:
+            # profile, leaves and holidays are looked up concurrently
+            is_holiday_or_weekend, is_leave = await asyncio.gather(
+                self.is_holiday_or_weekend(user_current_time.date()),
+                self.is_leave(user_current_time.date()),
+            )
+            if is_holiday_or_weekend:
+                return 400, HOLIDAY_MESSAGE
+            if is_leave:
+                return 400, LEAVE_MESSAGE
+
+        response = await self.make_request(
+            "/mytime/attendance/remoteclockin", "POST", self._punch_payload(punch_type, user_current_time)
+        )
+        return await run_blocking(
+            self._handle_punch_response, punch_type, response.status_code, response.text
+        )
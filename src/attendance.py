@@ -0,0 +1,98 @@
+from typing import Iterable
+from datetime import date, datetime, timedelta
+
+
+PUNCH_IN = 0
+PUNCH_OUT = 1
+
+
+def parse_timestamp(value: str):
+    return datetime.fromisoformat(value)
+
+
+def clockin_entries(data: dict, day: date):
+    """Time entries of `day` in an `attendancerequests` response"""
+    return [
+        entry
+        for request in data.get("remoteClockInRequests", [])
+        if (request.get("requestDate") or "")[:10] == day.isoformat()
+        for entry in request.get("timeEntries", [])
+    ]
+
+
+def pair_punches(entries: Iterable[dict], day: date, now: datetime = None):
+    """
+    Pairs every punch in with the punch out after it, in a single pass, and returns the time worked
+
+    Args:
+        entries: time entries with `punchStatus` (0 for in, 1 for out) and `actualTimestamp`
+        day: the day the entries belong to
+        now: current time in the user's timezone, used to count a session that is still going on
+
+    Returns:
+        total time between the paired punches
+
+    Entries are sorted first only when they are out of order. A punch in while a session is open
+    and a punch out with no open session are ignored. A session left open counts until `now`
+    when `day` is today, and not at all on earlier days.
+    """
+    punches = [
+        (parse_timestamp(x["actualTimestamp"]), x.get("punchStatus"))
+        for x in entries if x.get("actualTimestamp")
+    ]
+    if any(punches[i][0] > punches[i + 1][0] for i in range(len(punches) - 1)):
+        punches.sort(key=lambda x: x[0])
+
+    total = timedelta(seconds=0)
+    opened_at = None
+    for timestamp, status in punches:
+        if status == PUNCH_IN:
+            opened_at = opened_at or timestamp
+        elif status == PUNCH_OUT and opened_at is not None:
+            total += timestamp - opened_at
+            opened_at = None
+
+    if opened_at is not None:
+        now = now or datetime.now(opened_at.tzinfo)
+        # keka's timestamps may or may not carry an offset, `now` is brought to the same form
+        now = now.astimezone(opened_at.tzinfo) if opened_at.tzinfo else now.replace(tzinfo=None)
+        if now.date() == day and now > opened_at:
+            total += now - opened_at
+    return total
+
+
+def work_time_by_day(data: dict, from_date: date, to_date: date, now: datetime = None):
+    """
+    Time worked on every day from `from_date` to `to_date` in an `attendancerequests` response,
+    grouping the entries by `requestDate` in a single pass
+    """
+    entries: dict[str, list[dict]] = {}
+    for request in data.get("remoteClockInRequests", []):
+        day = (request.get("requestDate") or "")[:10]
+        entries.setdefault(day, []).extend(request.get("timeEntries", []))
+
+    days = {}
+    day = from_date
+    while day <= to_date:
+        days[day] = pair_punches(entries.get(day.isoformat(), []), day, now)
+        day += timedelta(days=1)
+    return days
+
+
+def date_chunks(from_date: date, to_date: date, days: int):
+    """Splits a range of dates into consecutive ranges of at most `days` days"""
+    while from_date <= to_date:
+        end = min(from_date + timedelta(days=days - 1), to_date)
+        yield from_date, end
+        from_date = end + timedelta(days=1)
+
+
+def aggregate(days: dict[date, timedelta]):
+    """Totals of the time worked per ISO week (`2023-W02`) and per month (`2023-01`)"""
+    weeks: dict[str, timedelta] = {}
+    months: dict[str, timedelta] = {}
+    for day, work_time in days.items():
+        year, week, _ = day.isocalendar()
+        weeks[f"{year}-W{week:02d}"] = weeks.get(f"{year}-W{week:02d}", timedelta(0)) + work_time
+        months[day.strftime("%Y-%m")] = months.get(day.strftime("%Y-%m"), timedelta(0)) + work_time
+    return weeks, months
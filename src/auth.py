@@ -0,0 +1,188 @@
+import json
+import time
+import base64
+import config
+import hashlib
+import secrets
+from src import helpers
+from src import metrics
+from html.parser import HTMLParser
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urljoin, urlparse, parse_qs
+
+
+logger = config.LOGGER
+
+
+class AuthError(Exception):
+    pass
+
+
+class FormParser(HTMLParser):
+    """Collects the forms of a page with the names and values of their inputs"""
+    def __init__(self):
+        super().__init__()
+        self.forms: list[dict] = []
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str]]):
+        attrs = dict(attrs)
+        if tag == "form":
+            self.forms.append({"action": attrs.get("action") or "", "method": attrs.get("method") or "get", "inputs": {}})
+        elif tag == "input" and self.forms and attrs.get("name"):
+            self.forms[-1]["inputs"][attrs["name"]] = {"type": (attrs.get("type") or "text").lower(), "value": attrs.get("value") or ""}
+
+
+def is_configured():
+    return bool(config.KEKA_IDENTITY_URL and config.KEKA_CLIENT_ID)
+
+
+def token_claims(token: str):
+    """Claims of a jwt, read without verifying its signature, `{}` if the token isn't a jwt"""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except (AttributeError, IndexError, ValueError):
+        return {}
+    return claims if isinstance(claims, dict) else {}
+
+
+def token_expiry(token: str):
+    """Expiry of a jwt from its `exp` claim, `None` when it has none"""
+    exp = token_claims(token).get("exp")
+    return datetime.fromtimestamp(exp, timezone.utc) if isinstance(exp, (int, float)) else None
+
+
+def pkce_pair():
+    """A PKCE code verifier and its S256 challenge"""
+    verifier = secrets.token_urlsafe(64)
+    challenge = base64.urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest()).rstrip(b"=").decode()
+    return verifier, challenge
+
+
+def login_form(html: str):
+    """The form of a page with a password field"""
+    parser = FormParser()
+    parser.feed(html)
+    for form in parser.forms:
+        if any(x["type"] == "password" for x in form["inputs"].values()):
+            return form
+    return None
+
+
+def fill_login_form(form: dict, email: str, password: str):
+    fields = {}
+    for name, field in form["inputs"].items():
+        if field["type"] == "password":
+            fields[name] = password
+        elif field["type"] in ("email", "text") and any(x in name.lower() for x in ("email", "user")):
+            fields[name] = email
+        elif field["type"] not in ("submit", "button", "checkbox"):
+            # hidden fields like the anti-forgery token and the return url
+            fields[name] = field["value"]
+    return fields
+
+
+def timeout():
+    return (config.KEKA_CONNECT_TIMEOUT, config.KEKA_READ_TIMEOUT)
+
+
+def authorization_code(session, response, state: str, max_redirects: int = 10):
+    """Follows the redirects of a response until keka redirects to `KEKA_REDIRECT_URI` with a code"""
+    for _ in range(max_redirects):
+        location = response.headers.get("Location")
+        if response.status_code not in (301, 302, 303, 307, 308) or not location:
+            return None
+        location = urljoin(response.url, location)
+        if location.startswith(config.KEKA_REDIRECT_URI):
+            query = parse_qs(urlparse(location).query)
+            if query.get("state", [None])[0] != state:
+                raise AuthError("The state of the authorization response doesn't match")
+            if "error" in query:
+                raise AuthError(f"Keka denied the authorization: {query['error'][0]}")
+            return query.get("code", [None])[0]
+        response = session.get(location, allow_redirects=False, timeout=timeout())
+    raise AuthError("Too many redirects after the login form")
+
+
+def login_over_http(email: str, password: str):
+    """
+    Logs into keka without a browser, replaying the authorization code flow (with PKCE) of the dashboard:
+    the login form is fetched from the identity server, posted with the credentials,
+    and the code it redirects with is exchanged for a token
+
+    Returns:
+        the token response of the identity server, with `access_token` and `expires_in`
+
+    Raises:
+        AuthError if the identity server isn't configured, rejects the credentials or answers unexpectedly
+    """
+    if not is_configured():
+        raise AuthError("KEKA_IDENTITY_URL and KEKA_CLIENT_ID are not set")
+
+    timings: dict[str, float] = {}
+    outcome = "failure"
+    verifier, challenge = pkce_pair()
+    state = secrets.token_urlsafe(16)
+    # a session of its own, so the cookies of one login never leak into another
+    session = helpers.get_http_session(pool_size=1, max_retries=config.KEKA_MAX_RETRIES, headers={"user-agent": config.USER_AGENT})
+    try:
+        start = time.monotonic()
+        response = session.get(
+            urljoin(config.KEKA_IDENTITY_URL, "connect/authorize") + "?" + urlencode({
+                "client_id": config.KEKA_CLIENT_ID,
+                "redirect_uri": config.KEKA_REDIRECT_URI,
+                "response_type": "code",
+                "scope": config.KEKA_OAUTH_SCOPE,
+                "state": state,
+                "code_challenge": challenge,
+                "code_challenge_method": "S256",
+            }),
+            timeout=timeout(),
+        )
+        form = login_form(response.text)
+        if not response.ok or form is None:
+            raise AuthError(f"No login form at {response.url} (status {response.status_code})")
+        timings["login page"] = time.monotonic() - start
+
+        start = time.monotonic()
+        response = session.post(
+            urljoin(response.url, form["action"]),
+            data=fill_login_form(form, email, password),
+            allow_redirects=False,
+            timeout=timeout(),
+        )
+        code = authorization_code(session, response, state)
+        if not code:
+            raise AuthError(
+                "Keka rejected the credentials" if login_form(response.text) else
+                f"Keka didn't redirect with an authorization code (status {response.status_code})"
+            )
+        timings["credentials"] = time.monotonic() - start
+
+        start = time.monotonic()
+        response = session.post(
+            urljoin(config.KEKA_IDENTITY_URL, "connect/token"),
+            data={
+                "grant_type": "authorization_code",
+                "client_id": config.KEKA_CLIENT_ID,
+                "code": code,
+                "redirect_uri": config.KEKA_REDIRECT_URI,
+                "code_verifier": verifier,
+            },
+            timeout=timeout(),
+        )
+        if not response.ok or "access_token" not in response.text:
+            raise AuthError(f"The token exchange failed with status {response.status_code}: {response.text[:200]}")
+        timings["token exchange"] = time.monotonic() - start
+        outcome = "success"
+        return response.json()
+    except OSError as e:
+        # connection errors of requests are OSErrors too
+        raise AuthError(f"Couldn't reach the identity server: {e}") from e
+    finally:
+        session.close()
+        metrics.LOGIN_SECONDS.labels("http", outcome).observe(sum(timings.values()))
+        logger.info(
+            f"Http login of {email} took {sum(timings.values()):.2f}s ("
+            + ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in timings.items()) + ")"
+        )
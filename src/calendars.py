@@ -0,0 +1,194 @@
+import config
+import threading
+from datetime import date, datetime, timedelta
+
+
+db = config.DB
+logger = config.LOGGER
+
+
+class HolidayCalendar:
+    """
+    Holidays of a user as a frozenset of dates per year, kept in memory.
+    The db stores them compactly as the days of the year of every holiday.
+    """
+    # a year keka had no holidays for, like the next one in late december, is asked for again after this
+    MISSING_YEAR_RETRY = timedelta(hours=1)
+
+    def __init__(self, email: str):
+        self.email = email
+        # only the years keka returned holidays for
+        self.years: dict[int, frozenset[date]] = {}
+        # years asked for that keka returned no holidays for, and when
+        self.missing: dict[int, datetime] = {}
+        self.stale = False
+        self.lock = threading.Lock()
+
+
+    def covers(self, dt: date):
+        if self.stale:
+            return False
+        if dt.year in self.years:
+            return True
+        asked_at = self.missing.get(dt.year)
+        return asked_at is not None and datetime.now() - asked_at < self.MISSING_YEAR_RETRY
+
+
+    def is_holiday(self, dt: date):
+        return dt in self.years.get(dt.year, ())
+
+
+    def _index(self, holidays: list[dict]):
+        years: dict[int, set[date]] = {}
+        for holiday in holidays:
+            day = date.fromisoformat(holiday.get("date")[:10])
+            years.setdefault(day.year, set()).add(day)
+        # the years of the response replace the indexed ones, the others are kept
+        self.years = self.years | {year: frozenset(days) for year, days in years.items()}
+
+
+    def load(self):
+        """Loads the saved index from the db"""
+        record: dict = db.read_record(config.HOLIDAYS_DB, self.email) or {}
+        with self.lock:
+            if "years" in record:
+                self.years = {
+                    int(year): frozenset(date(int(year), 1, 1) + timedelta(days=x - 1) for x in days)
+                    for year, days in record["years"].items()
+                }
+            elif "value" in record:
+                # record saved before the index existed, with the response of keka as is
+                self._index(record["value"])
+
+
+    def update(self, holidays: dict, year: int):
+        """
+        Indexes the response of `/dashboard/holidays`, asked for the holidays of `year`, and saves the index.
+        Only the years in the response are covered.
+        """
+        with self.lock:
+            self._index(holidays.get("value", []))
+            if year in self.years:
+                self.missing.pop(year, None)
+            else:
+                self.missing[year] = datetime.now()
+                logger.warning(f"Keka returned no holidays of {year} for {self.email}, asking again later")
+            self.stale = False
+            record = {
+                "email": self.email,
+                "years": {
+                    str(year): sorted(x.timetuple().tm_yday for x in days)
+                    for year, days in self.years.items()
+                },
+            }
+        db.upsert_record(config.HOLIDAYS_DB, record, self.email, defer=True)
+        logger.info(f"Indexed {sum(map(len, self.years.values()))} holiday(s) for {self.email}")
+
+
+    def invalidate(self):
+        """Makes the next check fetch the holidays from keka again"""
+        self.stale = True
+
+
+class LeaveCalendar:
+    """
+    Leaves from `/me/leave/calendarevents`, fetched a quarter at a time and indexed by employee and date.
+    Every day maps to the portion of it taken as leave, `0.5` for half days. Only approved leaves are indexed,
+    pending, rejected and cancelled ones don't keep anyone from working.
+    """
+
+    def __init__(self, ttl: timedelta = None):
+        self.ttl = ttl if ttl is not None else timedelta(seconds=config.LEAVE_CACHE_TTL)
+        # employee id of the user, from the keka profile, kept for the lifetime of the process
+        self.employee_id: str | None = None
+        self.days: dict[str, dict[date, float]] = {}
+        # start of every fetched quarter and when it was fetched
+        self.windows: dict[date, datetime] = {}
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def window(dt: date):
+        """First and last day of the quarter of `dt`"""
+        start = date(dt.year, 3 * ((dt.month - 1) // 3) + 1, 1)
+        end = date(start.year + start.month // 10, (start.month + 2) % 12 + 1, 1) - timedelta(days=1)
+        return start, end
+
+
+    def needs_fetch(self, dt: date):
+        fetched_at = self.windows.get(self.window(dt)[0])
+        return fetched_at is None or datetime.now() - fetched_at > self.ttl
+
+
+    @staticmethod
+    def _is_approved(leave: dict):
+        return str(leave.get("status")).strip().lower() in config.LEAVE_APPROVED_STATUSES
+
+
+    def _portions(self, leave: dict):
+        """Yields every day of a leave with the portion of it taken"""
+        from_date = date.fromisoformat(leave.get("fromDate")[:10])
+        to_date = date.fromisoformat(leave.get("toDate")[:10])
+        # sessions are 0 for the first half of a day and 1 for the second half
+        from_session, to_session = leave.get("fromSession", 0), leave.get("toSession", 1)
+        day = from_date
+        while day <= to_date:
+            portion = 1.0
+            if day == from_date and from_session == 1:
+                portion -= 0.5
+            if day == to_date and to_session == 0:
+                portion -= 0.5
+            yield day, max(portion, 0.5)
+            day += timedelta(days=1)
+
+
+    def update(self, start: date, end: date, leaves: dict):
+        """Replaces the leaves between `start` and `end` with the ones in a `calendarevents` response"""
+        with self.lock:
+            for days in self.days.values():
+                for day in [x for x in days if start <= x <= end]:
+                    del days[day]
+            for leave in leaves.get("teamLeaveRequests", []):
+                if not self._is_approved(leave) or not leave.get("fromDate") or not leave.get("toDate"):
+                    continue
+                days = self.days.setdefault(leave.get("employeeId"), {})
+                for day, portion in self._portions(leave):
+                    if start <= day <= end:
+                        days[day] = min(1.0, days.get(day, 0) + portion)
+            self.windows[start] = datetime.now()
+
+
+    def portion(self, dt: date, employee_id: str = None):
+        return self.days.get(employee_id or self.employee_id, {}).get(dt, 0)
+
+
+    def is_leave(self, dt: date, employee_id: str = None):
+        """Whether the whole day is taken as leave, half days are still working days"""
+        return self.portion(dt, employee_id) >= 1
+
+
+class WorkingDayCalendar:
+    """Working days of a user from `start` to `end`, precomputed so that other days need no call to keka"""
+    def __init__(self):
+        self.start: date | None = None
+        self.end: date | None = None
+        self.days: frozenset[date] = frozenset()
+        self.computed_at: datetime | None = None
+
+
+    def covers(self, dt: date):
+        return self.start is not None and self.start <= dt <= self.end
+
+
+    def is_working_day(self, dt: date):
+        return dt in self.days
+
+
+    def update(self, start: date, end: date, days: set[date]):
+        # replaced at once, so that readers never see a half built calendar
+        self.days, self.start, self.end = frozenset(days), start, end
+        self.computed_at = datetime.now()
+
+
+    def upcoming(self, dt: date):
+        return sorted(x for x in self.days if x >= dt)
@@ -0,0 +1,133 @@
+import json
+import time
+import config
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import Future, TimeoutError
+
+
+logger = config.LOGGER
+
+REQUEST_WILL_BE_SENT = "Network.requestWillBeSent"
+
+
+def api_host():
+    return urlparse(config.KEKA_BASE_API_URL).netloc
+
+
+def bearer_token(headers: dict):
+    for name, value in (headers or {}).items():
+        if name.lower() == "authorization" and str(value).startswith("Bearer "):
+            return value[len("Bearer "):].strip() or None
+    return None
+
+
+def request_log(request: dict):
+    # same shape as a performance log entry, so both capture modes save the same record
+    return {"message": {"method": REQUEST_WILL_BE_SENT, "params": {"request": request}}}
+
+
+def token_from_logs(entries: list[dict], host: str = None):
+    """
+    Token and request log of the first call to the keka api with a bearer token
+    among performance log entries, only `Network.requestWillBeSent` entries are parsed
+    """
+    host = host or api_host()
+    for entry in entries:
+        message: str = entry.get("message", "")
+        if f'"{REQUEST_WILL_BE_SENT}"' not in message:
+            continue
+        request = json.loads(message).get("message", {}).get("params", {}).get("request", {})
+        if urlparse(request.get("url", "")).netloc != host:
+            continue
+        token = bearer_token(request.get("headers"))
+        if token:
+            return token, request_log(request)
+    return None, None
+
+
+def wait_token_in_logs(driver, timeout: float):
+    """Reads the performance logs of the driver until a call to the keka api carries a bearer token"""
+    deadline = time.monotonic() + timeout
+    while True:
+        token, log = token_from_logs(driver.get_log("performance"))
+        if token or time.monotonic() >= deadline:
+            return token, log
+        time.sleep(0.2)
+
+
+class CdpTokenCapture:
+    """
+    Subscribes to `Network.requestWillBeSent` over the devtools protocol of a chrome driver,
+    on a thread of its own, and resolves `future` with the token and request log
+    of the first call to the keka api with a bearer token
+    """
+    def __init__(self, driver):
+        self.driver = driver
+        self.host = api_host()
+        self.future: Future = Future()
+        self.subscribed = threading.Event()
+        self.thread: threading.Thread | None = None
+        # trio token and cancel scope of the listener, to stop it from other threads
+        self.listener = None
+
+    def start(self, timeout: float = 10):
+        self.thread = threading.Thread(target=self._run, name="cdp-token-capture", daemon=True)
+        self.thread.start()
+        # requests sent before the subscription would go unseen
+        if not self.subscribed.wait(timeout):
+            logger.warning(f"Not subscribed to the network events of chrome after {timeout}s")
+        return self
+
+    def _run(self):
+        import trio
+
+        try:
+            trio.run(self._listen)
+        except BaseException as e:
+            if not self.future.done():
+                self.future.set_exception(e)
+        finally:
+            self.subscribed.set()
+            if not self.future.done():
+                self.future.set_result((None, None))
+
+    async def _listen(self):
+        import trio
+
+        with trio.CancelScope() as scope:
+            self.listener = (trio.lowlevel.current_trio_token(), scope)
+            async with self.driver.bidi_connection() as connection:
+                session, devtools = connection.session, connection.devtools
+                await session.execute(devtools.network.enable())
+                events = session.listen(devtools.network.RequestWillBeSent, buffer_size=256)
+                self.subscribed.set()
+                async for event in events:
+                    if urlparse(event.request.url).netloc != self.host:
+                        continue
+                    token = bearer_token(event.request.headers)
+                    if token:
+                        self.future.set_result((token, request_log(event.request.to_json())))
+                        return
+
+    def result(self, timeout: float):
+        """Token and request log, or `None`s if no call carried a token within `timeout` seconds"""
+        try:
+            return self.future.result(timeout)
+        except TimeoutError:
+            return None, None
+        except Exception as e:
+            logger.error(f"Couldn't capture the token over the devtools protocol: {e!r}")
+            return None, None
+
+    def stop(self):
+        import trio
+
+        if self.listener and self.thread.is_alive():
+            trio_token, scope = self.listener
+            try:
+                trio.from_thread.run_sync(scope.cancel, trio_token=trio_token)
+            except trio.RunFinishedError:
+                pass
+        if self.thread:
+            self.thread.join(timeout=5)
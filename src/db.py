@@ -1,36 +1,305 @@
 import os
+import json
+import time
+import uuid
+import atexit
 import tinydb
-from deta import Deta
+import logging
+import sqlite3
+import threading
+from src import metrics
+from collections import OrderedDict
 from tinydb.queries import where
 from tinydb.storages import JSONStorage, MemoryStorage
 
 
 class DetaDB():
+    """
+    Deta bases with a read-through LRU/TTL cache, writes made with `defer=True`
+    are batched into `put_many` calls by a background thread.
+    Tables written by both the api and the scheduler (`DETA_UNCACHED_TABLES`) are always read from deta.
+    """
     def __init__(self):
-        DETA_PROJECT_KEY = os.environ.get("DETA_PROJECT_KEY", "c0wq9nq6_eEXMEkVAKQbHfmodX6rAUK7gqLBNAvw1")
-        self.db = Deta(DETA_PROJECT_KEY)
+        # the deta client is created on the first read or write, importing `config` stays cheap
+        self.db = None
+        self.bases = {}
+        self.cache: OrderedDict[tuple[str, str], tuple[float, dict | None]] = OrderedDict()
+        self.cache_size = int(os.environ.get("DETA_CACHE_SIZE", 1024))
+        self.cache_ttl = float(os.environ.get("DETA_CACHE_TTL", 60))
+        # the punch state and the tokens, a copy cached by one process would miss the writes of the other
+        self.uncached = set(filter(None, os.environ.get("DETA_UNCACHED_TABLES", "state,token").split(",")))
+        self.flush_interval = float(os.environ.get("DETA_FLUSH_INTERVAL", 5))
+        self.pending: dict[str, dict[str, dict]] = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+        atexit.register(self.flush)
 
-    def upsert_record(self, db_path: str, data: dict, key: str = None):
-        return self.db.Base(db_path).put(data, key=key)
+    def _base(self, db_path: str):
+        if self.db is None:
+            from deta import Deta
+            self.db = Deta(os.environ.get("DETA_PROJECT_KEY", "c0wq9nq6_eEXMEkVAKQbHfmodX6rAUK7gqLBNAvw1"))
+        if db_path not in self.bases:
+            self.bases[db_path] = self.db.Base(db_path)
+        return self.bases[db_path]
+
+    def _cache_put(self, db_path: str, key: str, value: dict | None):
+        if db_path in self.uncached:
+            return
+        with self.lock:
+            self.cache[(db_path, key)] = (time.monotonic() + self.cache_ttl, value)
+            self.cache.move_to_end((db_path, key))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def upsert_record(self, db_path: str, data: dict, key: str = None, defer: bool = False):
+        if defer:
+            key = key if key is not None else uuid.uuid4().hex
+            record = data | {"key": key}
+            with self.lock:
+                # later writes of the same key replace the pending one
+                self.pending.setdefault(db_path, {})[key] = record
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+                    self.flusher.start()
+            # reads see the pending record until it is written
+            self._cache_put(db_path, key, record)
+            return record
+
+        result = self._base(db_path).put(data, key=key)
+        # dropped once written, a read made before would otherwise cache the old record again
+        with self.lock:
+            self.cache.pop((db_path, key), None)
+            self.pending.get(db_path, {}).pop(key, None)
+        return result
+
+    def upsert_records(self, db_path: str, records: list[dict]):
+        base = self._base(db_path)
+        # deta accepts at most 25 items per `put_many`
+        for i in range(0, len(records), 25):
+            base.put_many(records[i:i+25])
+        with self.lock:
+            for record in records:
+                self.cache.pop((db_path, record.get("key")), None)
 
     def read_record(self, db_path: str, key: str, default: dict = {}):
-        return self.db.Base(db_path).get(key) or default
+        with self.lock:
+            if key in self.pending.get(db_path, {}):
+                return self.pending[db_path][key]
+            cached = self.cache.get((db_path, key))
+            if cached and cached[0] > time.monotonic():
+                self.cache.move_to_end((db_path, key))
+                return cached[1] or default
+        record = self._base(db_path).get(key)
+        self._cache_put(db_path, key, record)
+        return record or default
+
+    def read_records(self, db_path: str):
+        self.flush()
+        base = self._base(db_path)
+        response = base.fetch()
+        records = response.items
+        while response.last:
+            response = base.fetch(last=response.last)
+            records += response.items
+        return records
+
+    def flush(self):
+        """Writes the pending deferred records, reads see them in `pending` until they are written"""
+        with self.lock:
+            pending = {db_path: dict(records) for db_path, records in self.pending.items() if records}
+        for db_path, records in pending.items():
+            try:
+                self.upsert_records(db_path, list(records.values()))
+            except Exception:
+                logging.getLogger().exception(f"Couldn't write {len(records)} record(s) to {db_path!r}")
+                continue
+            with self.lock:
+                # unless they have been overwritten meanwhile
+                current = self.pending.get(db_path, {})
+                for key, record in records.items():
+                    if current.get(key) is record:
+                        del current[key]
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def tables(self):
+        # deta can't list the bases of a project
+        return None
 
 
 class TinyDB():
-    def __init__(self, in_memory: bool = False):
+    def __init__(self, in_memory: bool = False, path: str = "db/data.json"):
         if in_memory:
             self.db = tinydb.TinyDB(storage=MemoryStorage)
         else:
-            os.makedirs(db_location:="db/", exist_ok=True)
-            self.db = tinydb.TinyDB(db_location+"data.json", storage=JSONStorage)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = tinydb.TinyDB(path, storage=JSONStorage)
 
-    def upsert_record(self, db_path: str, data: dict, key: str = None):
+    def upsert_record(self, db_path: str, data: dict, key: str = None, defer: bool = False):
         return self.db.table(db_path).upsert(data | {"key": key}, where("key") == key)
 
+    def upsert_records(self, db_path: str, records: list[dict]):
+        for record in records:
+            self.upsert_record(db_path, record, record.get("key"))
+
     def read_record(self, db_path: str, key: str, default: dict = {}):
         return self.db.table(db_path).get(where("key") == key) or default
 
+    def read_records(self, db_path: str):
+        return [dict(x) for x in self.db.table(db_path).all()]
+
+    def flush(self):
+        pass
+
+    def tables(self):
+        return sorted(self.db.tables())
+
+
+class SqliteDB():
+    """
+    Stores every `db_path` as a table of `key` (primary key) and `data` (json),
+    over a single connection shared by all threads
+    """
+    def __init__(self, path: str = "db/data.sqlite"):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # autocommit, transactions are opened explicitly where needed
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.Lock()
+        self.created_tables = set()
+
+    def _table(self, db_path: str):
+        table = '"' + db_path.replace('"', '""') + '"'
+        if db_path not in self.created_tables:
+            with self.lock:
+                self.conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    "(key TEXT PRIMARY KEY, data TEXT NOT NULL CHECK (json_valid(data)))"
+                )
+            self.created_tables.add(db_path)
+        return table
+
+    def upsert_record(self, db_path: str, data: dict, key: str = None, defer: bool = False):
+        return self.upsert_records(db_path, [data | {"key": key if key is not None else uuid.uuid4().hex}])[0]
+
+    def upsert_records(self, db_path: str, records: list[dict]):
+        table = self._table(db_path)
+        records = [x if x.get("key") is not None else x | {"key": uuid.uuid4().hex} for x in records]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    f"INSERT INTO {table} (key, data) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                    [(x["key"], json.dumps(x)) for x in records],
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return records
+
+    def read_record(self, db_path: str, key: str, default: dict = {}):
+        table = self._table(db_path)
+        with self.lock:
+            row = self.conn.execute(f"SELECT data FROM {table} WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def read_records(self, db_path: str):
+        table = self._table(db_path)
+        with self.lock:
+            rows = self.conn.execute(f"SELECT data FROM {table}").fetchall()
+        return [json.loads(x[0]) for x in rows]
+
+    def tables(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        return sorted(x[0] for x in rows)
+
+    def flush(self):
+        pass
+
+
+class InstrumentedDB():
+    """Times the reads and writes of a db backend per table, everything else is passed through"""
+    def __init__(self, db, backend: str):
+        self.db = db
+        self.backend = backend
+
+    def __getattr__(self, name: str):
+        return getattr(self.db, name)
+
+    def _timed(self, operation: str, db_path: str, func, *args, **kwargs):
+        with metrics.timed(metrics.DB_OPERATION_SECONDS, backend=self.backend, table=db_path, operation=operation):
+            return func(db_path, *args, **kwargs)
+
+    def upsert_record(self, db_path: str, data: dict, key: str = None, defer: bool = False):
+        return self._timed("upsert_deferred" if defer else "upsert", db_path, self.db.upsert_record, data, key, defer)
+
+    def upsert_records(self, db_path: str, records: list[dict]):
+        return self._timed("upsert_many", db_path, self.db.upsert_records, records)
+
+    def read_record(self, db_path: str, key: str, default: dict = {}):
+        return self._timed("read", db_path, self.db.read_record, key, default)
+
+    def read_records(self, db_path: str):
+        return self._timed("read_all", db_path, self.db.read_records)
+
+
+def get_db(local: bool = False, in_memory: bool = False, backend: str = None):
+    """
+    Returns the db backend named by `backend` or the `DB_BACKEND` env var:
+    `deta` (default), `tinydb` (same as `local=True`) or `sqlite`
+    """
+    backend = backend or os.environ.get("DB_BACKEND") or ("deta", "tinydb") [local]
+    if backend == "sqlite":
+        db = SqliteDB(":memory:" if in_memory else os.environ.get("SQLITE_DB_PATH", "db/data.sqlite"))
+    elif backend == "tinydb":
+        db = TinyDB(in_memory=in_memory, path=os.environ.get("TINYDB_PATH", "db/data.json"))
+    else:
+        backend, db = "deta", DetaDB()
+    return InstrumentedDB(db, backend)
+
+
+def migrate(source, target, tables: list[str]):
+    """Copies every record of `tables` from the `source` db to the `target` db"""
+    counts = {}
+    for table in tables:
+        records = source.read_records(table)
+        target.upsert_records(table, [x for x in records if x.get("key") is not None])
+        counts[table] = len(records)
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Copy the records of one db backend into another, e.g. `python -m src.db --source tinydb --target sqlite`"
+    )
+    parser.add_argument("--source", choices=["deta", "tinydb", "sqlite"], required=True)
+    parser.add_argument("--target", choices=["deta", "tinydb", "sqlite"], default="sqlite")
+    parser.add_argument("--source-path", help="path of the source tinydb json or sqlite file")
+    parser.add_argument("--target-path", help="path of the target tinydb json or sqlite file")
+    parser.add_argument("--tables", nargs="*", help="tables to copy, defaults to all the tables of the source")
+    args = parser.parse_args()
+
+    def open_db(backend: str, path: str = None):
+        if backend == "tinydb" and path:
+            return TinyDB(path=path)
+        if backend == "sqlite" and path:
+            return SqliteDB(path)
+        return get_db(backend=backend)
 
-def get_db(local: bool = False, in_memory: bool = False):
-    return (DetaDB(), TinyDB(in_memory=in_memory)) [local]
+    source, target = open_db(args.source, args.source_path), open_db(args.target, args.target_path)
+    import config
+    tables = args.tables or source.tables() or [
+        config.USERS_DB, config.STATE_DB, config.TOKEN_DB, config.LOCATION_DB, config.HOLIDAYS_DB, "requests",
+    ]
+    for table, count in migrate(source, target, tables).items():
+        print(f"Copied {count} record(s) of {table!r}")
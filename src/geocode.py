@@ -0,0 +1,278 @@
+"""
+Offline reverse geocoding over the postal codes of GeoNames (https://download.geonames.org/export/zip/).
+
+The index is a single binary file, memory-mapped once per process. Places are bucketed by cells of
+`CELL_DEGREES` degrees and sorted by cell, so a lookup bisects the cell ids and only measures the
+places of the cells around the point.
+
+GeoNames only serves the latest dumps, so the dumps of the countries are pinned in `geonames.lock.json`,
+by the url of a copy that doesn't change and its sha256. A build only reads pinned dumps and fails when one
+doesn't match its checksum, instead of indexing whatever GeoNames serves that day. Pin and build with
+
+    python -m src.geocode pin --countries IN US --url https://<mirror>/geonames/2026-01-01/{}.zip
+    python -m src.geocode build --countries IN US --output data/geonames.idx
+"""
+import io
+import os
+import csv
+import json
+import math
+import mmap
+import struct
+import bisect
+import config
+import hashlib
+import zipfile
+import argparse
+from datetime import date
+from functools import lru_cache
+
+
+logger = config.LOGGER
+
+MAGIC = b"AKGEO1\0\0"
+# magic, cell size, number of cells and number of places
+HEADER = struct.Struct("<8sdII")
+CELL_DEGREES = 0.1
+# cells are searched in growing rings around the point, up to this many cells away
+MAX_RINGS = 5
+GEONAMES_URL = "https://download.geonames.org/export/zip/{}.zip"
+# pinned dumps by country code, committed with the code
+GEONAMES_LOCK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "geonames.lock.json")
+# columns of the GeoNames postal code files
+COUNTRY, POSTAL_CODE, PLACE, STATE, _, DISTRICT, _, _, _, LATITUDE, LONGITUDE = range(11)
+
+
+def cell_of(lat: float, lng: float, size: float = CELL_DEGREES):
+    row = int((lat + 90) // size)
+    column = int((lng + 180) // size)
+    return row * int(round(360 / size)) + column, row, column
+
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float):
+    # equirectangular approximation, precise enough over the few kilometers between neighbours
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371 * math.hypot(x, y)
+
+
+class GeoIndex:
+    """Nearest place to a point, read from a memory-mapped index built by `build_index`"""
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.cell_size, cells, places = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a geocoding index")
+        self.columns = int(round(360 / self.cell_size))
+        view = memoryview(self.map)
+        offset = HEADER.size
+        # ids of the non empty cells, sorted, and the index of the first place of every cell
+        self.cells = view[offset:offset + 4 * cells].cast("I")
+        offset += 4 * cells
+        self.starts = view[offset:offset + 4 * (cells + 1)].cast("I")
+        offset += 4 * (cells + 1)
+        self.lats = view[offset:offset + 4 * places].cast("f")
+        offset += 4 * places
+        self.lngs = view[offset:offset + 4 * places].cast("f")
+        offset += 4 * places
+        self.texts = view[offset:offset + 4 * (places + 1)].cast("I")
+        self.text_offset = offset + 4 * (places + 1)
+
+
+    def __len__(self):
+        return len(self.lats)
+
+
+    def _places(self, cell: int):
+        i = bisect.bisect_left(self.cells, cell)
+        if i < len(self.cells) and self.cells[i] == cell:
+            return range(self.starts[i], self.starts[i + 1])
+        return range(0)
+
+
+    def _ring(self, row: int, column: int, ring: int):
+        for dr in range(-ring, ring + 1):
+            for dc in range(-ring, ring + 1):
+                if max(abs(dr), abs(dc)) == ring and 0 <= row + dr < self.columns // 2:
+                    yield (row + dr) * self.columns + (column + dc) % self.columns
+
+
+    def place(self, i: int):
+        text = bytes(self.map[self.text_offset + self.texts[i]:self.text_offset + self.texts[i + 1]]).decode()
+        country, postal_code, place, state, district = text.split("\t")
+        return {
+            "country_code": country, "postal_code": postal_code, "place": place, "state": state,
+            "district": district, "latitude": self.lats[i], "longitude": self.lngs[i],
+        }
+
+
+    def nearest(self, lat: float, lng: float):
+        """The closest place with its `distance_km`, `None` if there is none within `MAX_RINGS` cells"""
+        _, row, column = cell_of(lat, lng, self.cell_size)
+        # kilometers across a cell at this latitude, along its narrower side
+        cell_km = self.cell_size * 111.2 * math.cos(math.radians(lat))
+        best, best_distance = None, math.inf
+        for ring in range(MAX_RINGS + 1):
+            # every place of this ring and the ones after it is at least `ring - 1` cells away
+            if best is not None and best_distance <= (ring - 1) * cell_km:
+                break
+            for cell in self._ring(row, column, ring):
+                for i in self._places(cell):
+                    distance = distance_km(lat, lng, self.lats[i], self.lngs[i])
+                    if distance < best_distance:
+                        best, best_distance = i, distance
+        if best is None:
+            return None
+        return self.place(best) | {"distance_km": best_distance}
+
+
+    def close(self):
+        for view in (self.cells, self.starts, self.lats, self.lngs, self.texts):
+            view.release()
+        self.map.close()
+        self.file.close()
+
+
+@lru_cache(maxsize=1)
+def get_index():
+    """The index at `GEOCODE_INDEX_PATH`, loaded once per process, `None` when it hasn't been built"""
+    if not os.path.exists(config.GEOCODE_INDEX_PATH):
+        logger.warning(f"No geocoding index at {config.GEOCODE_INDEX_PATH!r}, locations are looked up online")
+        return None
+    try:
+        return GeoIndex(config.GEOCODE_INDEX_PATH)
+    except (OSError, ValueError) as e:
+        logger.error(f"Couldn't load the geocoding index: {e}")
+        return None
+
+
+def read_source(source: str, sha256: str = None):
+    """Content of a path or an url, checked against `sha256` when given"""
+    if source.startswith(("http://", "https://")):
+        import requests
+
+        response = requests.get(source, timeout=300)
+        response.raise_for_status()
+        data = response.content
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+    if sha256 and hashlib.sha256(data).hexdigest() != sha256.lower():
+        raise ValueError(f"{source} doesn't match its pinned sha256 {sha256}, pin it again or point at an unchanged copy")
+    return data
+
+
+def read_rows(source: str, sha256: str = None):
+    """Rows of a GeoNames postal code file, a `.zip` as downloaded or the `.txt` in it, from a path or an url"""
+    data = read_source(source, sha256)
+    if data[:2] == b"PK":
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            name = next(x for x in archive.namelist() if x.endswith(".txt") and not x.lower().startswith("readme"))
+            data = archive.read(name)
+    yield from csv.reader(io.StringIO(data.decode()), delimiter="\t", quoting=csv.QUOTE_NONE)
+
+
+def load_pins(path: str = GEONAMES_LOCK) -> dict[str, dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def pin(countries: list[str], url: str = GEONAMES_URL, path: str = GEONAMES_LOCK):
+    """
+    Pins the dumps of the countries at `url` (formatted with the country code) by their sha256.
+    `url` should be a copy that doesn't change, like a release asset, the dumps of GeoNames change daily.
+    """
+    pins = load_pins(path)
+    for country in (x.upper() for x in countries):
+        source = url.format(country)
+        data = read_source(source)
+        pins[country] = {"url": source, "sha256": hashlib.sha256(data).hexdigest(), "pinned_at": date.today().isoformat()}
+        logger.info(f"Pinned {country} at {source} ({len(data)} bytes)")
+    with open(path + ".tmp", "w") as f:
+        json.dump(pins, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(path + ".tmp", path)
+    return pins
+
+
+def pinned_sources(countries: list[str], path: str = GEONAMES_LOCK):
+    """Url and sha256 of the pinned dump of every country, raises `KeyError` with the countries that aren't pinned"""
+    pins = load_pins(path)
+    missing = [x.upper() for x in countries if x.upper() not in pins]
+    if missing:
+        raise KeyError(missing)
+    return {pins[x.upper()]["url"]: pins[x.upper()]["sha256"] for x in countries}
+
+
+def build_index(sources: list[str], output: str, cell_size: float = CELL_DEGREES, checksums: dict[str, str] = None):
+    """Builds the index from GeoNames files or urls, checking those in `checksums` against their sha256"""
+    places = {}
+    checksums = checksums or {}
+    for source in sources:
+        for row in read_rows(source, checksums.get(source)):
+            if len(row) <= LONGITUDE or not row[LATITUDE] or not row[LONGITUDE]:
+                continue
+            lat, lng = float(row[LATITUDE]), float(row[LONGITUDE])
+            text = "\t".join(x.replace("\t", " ") for x in (row[COUNTRY], row[POSTAL_CODE], row[PLACE], row[STATE], row[DISTRICT]))
+            # rows repeated across the sources are indexed once
+            places.setdefault((cell_of(lat, lng, cell_size)[0], lat, lng, text), None)
+    places = sorted(places)
+
+    cells, starts = [], []
+    for i, (cell, *_) in enumerate(places):
+        if not cells or cells[-1] != cell:
+            cells.append(cell)
+            starts.append(i)
+    starts.append(len(places))
+    texts = [x[3].encode() for x in places]
+    text_offsets = [0]
+    for text in texts:
+        text_offsets.append(text_offsets[-1] + len(text))
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, cell_size, len(cells), len(places)))
+        f.write(struct.pack(f"<{len(cells)}I", *cells))
+        f.write(struct.pack(f"<{len(starts)}I", *starts))
+        f.write(struct.pack(f"<{len(places)}f", *(x[1] for x in places)))
+        f.write(struct.pack(f"<{len(places)}f", *(x[2] for x in places)))
+        f.write(struct.pack(f"<{len(text_offsets)}I", *text_offsets))
+        f.write(b"".join(texts))
+    os.replace(output + ".tmp", output)
+    logger.info(f"Indexed {len(places)} places in {len(cells)} cells into {output} ({os.path.getsize(output)} bytes)")
+    return len(places)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the offline reverse geocoding index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="builds the index from GeoNames postal code files")
+    build.add_argument("--countries", nargs="*", default=[], help="country codes of pinned dumps, e.g. IN US")
+    build.add_argument("--source", nargs="*", default=[], help="local GeoNames files or urls, not checked")
+    build.add_argument("--output", default=config.GEOCODE_INDEX_PATH)
+    pin_parser = subparsers.add_parser("pin", help="pins the dumps of countries in geonames.lock.json")
+    pin_parser.add_argument("--countries", nargs="+", required=True)
+    pin_parser.add_argument("--url", default=GEONAMES_URL, help="url of the dumps, `{}` is replaced by the country code")
+    lookup = subparsers.add_parser("lookup", help="prints the nearest place to a point")
+    lookup.add_argument("lat", type=float)
+    lookup.add_argument("lng", type=float)
+    lookup.add_argument("--index", default=config.GEOCODE_INDEX_PATH)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        try:
+            checksums = pinned_sources(args.countries)
+        except KeyError as e:
+            parser.error(f"{', '.join(e.args[0])} not pinned in {GEONAMES_LOCK}, pin with `python -m src.geocode pin`")
+        sources = args.source + list(checksums)
+        if not sources:
+            parser.error("give --countries or --source")
+        build_index(sources, args.output, checksums=checksums)
+    elif args.command == "pin":
+        pin(args.countries, args.url)
+    else:
+        print(GeoIndex(args.index).nearest(args.lat, args.lng))
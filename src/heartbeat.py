@@ -0,0 +1,82 @@
+import os
+import json
+import time
+import config
+import socket
+import threading
+from datetime import datetime
+
+
+write_lock = threading.Lock()
+
+
+def write_heartbeat(status: dict, path: str = None):
+    """Replaces the heartbeat file atomically, readers see either the previous beat or this one"""
+    path = path or config.SCHEDULER_HEARTBEAT_FILE
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    status = status | {"pid": os.getpid(), "host": socket.gethostname(), "heartbeat_at": time.time()}
+    with write_lock:
+        with open(path + ".tmp", "w") as f:
+            json.dump(status, f)
+        os.replace(path + ".tmp", path)
+
+
+def remove_heartbeat(path: str = None):
+    try:
+        os.remove(path or config.SCHEDULER_HEARTBEAT_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def read_heartbeat(path: str = None):
+    try:
+        with open(path or config.SCHEDULER_HEARTBEAT_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def is_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to someone else
+        return True
+    return True
+
+
+def heartbeat_status(path: str = None, now: float = None):
+    """
+    The last heartbeat of the scheduler with `healthy` and the `age` of the beat in seconds.
+    A beat older than `HEARTBEAT_STALE_AFTER` seconds, or from a process of this host that is gone, is unhealthy,
+    and so is a scheduler whose loop or next job is late by more than `SCHEDULER_LOOP_GRACE` seconds.
+    """
+    beat = read_heartbeat(path)
+    if beat is None:
+        return {"healthy": False, "reason": "no heartbeat"}
+    now = now or time.time()
+    age = now - beat.get("heartbeat_at", 0)
+    status = beat | {"age": round(age, 3), "healthy": True}
+    if age > config.HEARTBEAT_STALE_AFTER:
+        status |= {"healthy": False, "reason": f"no heartbeat for {age:.0f}s"}
+    elif beat.get("host") == socket.gethostname() and not is_alive(beat.get("pid", 0)):
+        status |= {"healthy": False, "reason": f"process {beat.get('pid')} is gone"}
+    elif late := loop_lateness(beat, now):
+        status |= {"healthy": False, "reason": late}
+    return status
+
+
+def loop_lateness(beat: dict, now: float):
+    """Why the loop of the scheduler looks stuck, `None` while it runs on time"""
+    if beat.get("last_loop_at") and beat.get("loop_sleep") is not None:
+        late = now - beat["last_loop_at"] - beat["loop_sleep"]
+        if late > config.SCHEDULER_LOOP_GRACE:
+            return f"the loop is {late:.0f}s late"
+    if beat.get("next_jobs"):
+        job = beat["next_jobs"][0]
+        late = now - datetime.fromisoformat(job["at"]).timestamp()
+        if late > config.SCHEDULER_LOOP_GRACE:
+            return f"{job['job']} is {late:.0f}s overdue"
+    return None
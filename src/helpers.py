@@ -1,16 +1,15 @@
 import os
 import json
 import config
-from typing import Literal
-from selenium import webdriver
+import shutil
+from functools import lru_cache
 from src.models import LogModel
+from typing import Literal, TYPE_CHECKING
 from datetime import datetime, timedelta
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.webdriver import WebDriver
-from selenium.webdriver.support import expected_conditions as EC
+
+# selenium takes a while to import and only the token refresh needs it, so it is imported where it is used
+if TYPE_CHECKING:
+    from selenium.webdriver.chrome.webdriver import WebDriver
 
 
 def encode_password(passw: str):
@@ -18,14 +17,33 @@ def encode_password(passw: str):
     return hashlib.sha256(passw.encode()).hexdigest()
 
 
+def get_fernet():
+    if not config.TENANT_SECRET_KEY:
+        return None
+    from cryptography.fernet import Fernet
+    return Fernet(config.TENANT_SECRET_KEY.encode())
+
+
+def encrypt_secret(value: str):
+    fernet = get_fernet()
+    return fernet.encrypt(value.encode()).decode() if fernet and value else None
+
+
+def decrypt_secret(value: str):
+    fernet = get_fernet()
+    return fernet.decrypt(value.encode()).decode() if fernet and value else None
+
+
 def reverse_geocode(lat, lng):
     from geopy.geocoders import Nominatim
     from geopy.location import Location
-    from geopy.exc import GeocoderUnavailable
+    from geopy.exc import GeopyError
     try:
         geocoder = Nominatim(user_agent = 'automate-keka')
         location: Location = geocoder.reverse((lat, lng))
-    except GeocoderUnavailable:
+    except GeopyError as e:
+        # unavailable, rate limited or timed out
+        config.LOGGER.warning(f"Nominatim couldn't reverse geocode {lat},{lng}: {e!r}")
         return None
     return location
 
@@ -61,7 +79,59 @@ def read_or_write_json(file_path: str, mode: Literal["w", "r"] = "r", data: dict
     return None
 
 
+def get_http_session(
+    pool_size: int = 10, max_retries: int = 3, backoff_factor: float = 0.5, headers: dict = None
+):
+    """
+    Creates a `requests.Session` that keeps connections alive and retries on failures
+
+    Args:
+        pool_size: maximum number of connections kept open per host
+        max_retries: number of retries on connection errors and 5xx responses
+        backoff_factor: sleep between retries grows as `backoff_factor * 2 ** (retry - 1)`
+        headers: default headers sent with every request
+
+    Returns:
+        the configured session
+    """
+    import requests
+    from urllib3.util.retry import Retry
+    from requests.adapters import HTTPAdapter
+
+    # non idempotent methods (like the POST of a punch) are not retried,
+    # so a 5xx can never result in a duplicate punch
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(headers or {})
+    return session
+
+
+@lru_cache(maxsize=1)
+def get_chrome_driver_path():
+    """
+    Resolves the chromedriver binary once per process, from `CHROME_DRIVER_PATH`, the `PATH`
+    or, as a last resort, webdriver-manager (which checks the latest version over the network)
+    """
+    path = config.CHROME_DRIVER_PATH or shutil.which("chromedriver")
+    if path:
+        return path
+    from webdriver_manager.chrome import ChromeDriverManager
+    return ChromeDriverManager().install()
+
+
 def get_chrome_driver(headless=False, enable_logs=False, proxy=""):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
     options = Options()
     options.headless = headless
     options.add_argument("--incognito")
@@ -73,7 +143,7 @@ def get_chrome_driver(headless=False, enable_logs=False, proxy=""):
         )
     if proxy:
         options.add_argument(f"--proxy-server={proxy}")
-    browser = webdriver.Chrome(ChromeDriverManager().install(), options=options)
+    browser = webdriver.Chrome(service=Service(get_chrome_driver_path()), options=options)
     if not headless:
         browser.maximize_window()
     return browser
@@ -116,24 +186,7 @@ def get_browsermob_proxy(version="2.1.4"):
     return proxy
 
 
-def wait_element(browser: WebDriver, by: By, element_selector):
-    """this funstion will make you wait untill the element is located in the browser and returns the completely loaded browser"""
-    i = 0
-    delay = 5
-
-    while i <= 8:
-        i += 1
-        try:
-            WebDriverWait(browser, delay).until(
-                EC.presence_of_element_located((by, element_selector)))
-            print("-------------------------")
-            break
-        except:
-            continue
-    return browser
-
-
-def get_log_entries(driver: WebDriver):
+def get_log_entries(driver: "WebDriver"):
     ##visit your website, login, etc. then:
     log_entries = driver.get_log("performance")
 
@@ -187,13 +240,12 @@ def format_time_delta(pre: str = '', td: timedelta = timedelta(seconds=0), post:
     return message[:-2] + post
 
 
-def get_logs(log_file: str, length: int = 100):
-    if not os.path.exists(log_file):
-        return []
-    with open(log_file) as f:
-        logs = f.read()
-        log_model_keys = list(LogModel.schema().get("properties", {}).keys())
-        valid_logs = list(filter(lambda x: [y for y in log_model_keys if y in x], logs.split("\n")))
-        valid_logs = [LogModel.parse_raw(x) for x in valid_logs]
-    length = (len(valid_logs), length) [length >= 0]
-    return valid_logs[-length:][::-1]
+def get_logs(log_file: str, length: int = 100, **filters):
+    """
+    Latest `length` records of a json log file, newest first, with the cursor of the next page.
+    See `log_utils.read_logs` for the filters.
+    """
+    from src.log_utils import read_logs
+
+    records, cursor = read_logs(log_file, length, **filters)
+    return [LogModel(**x) for x in records], cursor
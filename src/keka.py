@@ -1,24 +1,78 @@
-import re
 import time
 import json
 import config
-import requests
-import pandas as pd
+import hashlib
+import threading
+from src import auth
 from src import user
+from src import capture
 from src import helpers
+from src import metrics
+from src import attendance
 from src.models import *
-from itertools import zip_longest
+from src.calendars import HolidayCalendar, LeaveCalendar, WorkingDayCalendar
+from functools import lru_cache
+from urllib.parse import urlparse, urljoin
 from datetime import datetime, timedelta
-from selenium.webdriver.common.by import By
 
 
 db = config.DB
 logger = config.LOGGER
 
+HOLIDAY_MESSAGE = "It's a holiday or weekend. Not punching"
+LEAVE_MESSAGE = "Relax! You are on leave today..."
+
+browser_slots = threading.BoundedSemaphore(config.MAX_CONCURRENT_BROWSERS)
+
+TOKEN_MAX_AGE = timedelta(days=6, hours=12)
+
+# elements of keka's login page
+LOGIN_CONTAINER = "login-container-center"
+LOGIN_WITH_PASSWORD_BUTTON = '//*[@id="login-container-center"]/div/div/div[3]/form/button[2]'
+LOGIN_SUBMIT_BUTTON = '//*[@id="login-container-center"]/div/div/form/div/div[4]/div/button'
+LOGIN_ERRORS = '//*[@id="login-container-center"]//*[contains(@class, "text-danger") or contains(@class, "alert-danger")]'
+
+
+class LoginError(Exception):
+    pass
+
+
+# token and its timestamp and expiry for every user, shared by all the `Keka` instances of the process
+token_cache: dict[str, dict] = {}
+# seconds tokens were found to last, per user, for tokens that don't carry their expiry
+token_lifetimes: dict[str, float] = {}
+# number of refreshes of every user, made in the background by the scheduler or inline when a token was needed
+refresh_counts: dict[str, dict[str, int]] = {}
+# last token keka answered with a 401, per user
+rejected_tokens: dict[str, str] = {}
+# when the inline refreshes of a user last failed, in `time.monotonic()` seconds
+refresh_failures: dict[str, float] = {}
+token_locks: dict[str, threading.RLock] = {}
+token_locks_lock = threading.Lock()
+
+
+def get_token_lock(email: str):
+    with token_locks_lock:
+        return token_locks.setdefault(email, threading.RLock())
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    # one pooled, keep-alive session per process, shared by every `Keka` instance
+    return helpers.get_http_session(
+        pool_size=config.KEKA_POOL_SIZE,
+        max_retries=config.KEKA_MAX_RETRIES,
+        backoff_factor=config.KEKA_RETRY_BACKOFF,
+        headers=config.HEADERS,
+    )
+
 
 class Keka:
     def __init__(self, user: user.User):
         self.user = user
+        self.holidays = HolidayCalendar(user.email)
+        self.leaves = LeaveCalendar()
+        self.working_days = WorkingDayCalendar()
 
     def save_state(self, punch_type: config.PunchType):
         data = {
@@ -38,45 +92,81 @@ class Keka:
             data.get("timestamp", datetime.now(self.user.timezone).isoformat()),
             config.DATETIME_FORMAT,
         )
-        message = helpers.format_time_delta(
-            f"{punch_message} ", datetime.now(self.user.timezone) - timestamp, " ago"
-        )
-        logger.info(message)
+        # called on every punch and state check, so only formatted when debug logs are on
+        if logger.isEnabledFor(10):
+            logger.debug(helpers.format_time_delta(
+                f"{punch_message} ", datetime.now(self.user.timezone) - timestamp, " ago"
+            ))
         return punch_status, timestamp
 
 
-    def make_request(self, url: str, method: str = "GET", data: dict = None, params: dict = None):
+    def _request_args(self, url: str, method: str, data: dict, params: dict, token: str):
         if url.startswith("/") and config.KEKA_BASE_API_URL.endswith("/"):
             url = url[1:]
+        if not url.startswith("http"):
+            url = config.KEKA_BASE_API_URL + url
+
+        return {
+            "method": method,
+            "url": url,
+            "headers": {"authorization": f"Bearer {token}"},
+            "data": json.dumps(data),
+            "params": params,
+        }
 
-        config.HEADERS["authorization"] = f"Bearer {self.get_token()}"
-        response = requests.request(
-            method,
-            config.KEKA_BASE_API_URL + url,
-            headers=config.HEADERS,
-            data=json.dumps(data),
-            params=params,
-        )
+
+    @staticmethod
+    def _endpoint(url: str):
+        # path of the call without the base url of the api and the query, so that the metrics have few labels
+        path, base = urlparse(url).path, urlparse(config.KEKA_BASE_API_URL).path
+        return "/" + path[len(base):].lstrip("/") if path.startswith(base) else path
+
+
+    def _send(self, url: str, method: str, data: dict, params: dict, token: str):
+        kwargs = self._request_args(url, method, data, params, token)
+        with metrics.timed(metrics.KEKA_REQUEST_SECONDS, method=method, endpoint=self._endpoint(kwargs["url"]), status="error") as labels:
+            response = get_session().request(**kwargs, timeout=(config.KEKA_CONNECT_TIMEOUT, config.KEKA_READ_TIMEOUT))
+            labels["status"] = response.status_code
         return response
 
 
-    def get_or_ingest_data(self, url: str, method: str = "GET",
-        ingest=False, db_path: str = None, data: dict = None, params: dict = None
-    ):
-        response = self.make_request(url, method=method, data=data, params=params)
+    def make_request(self, url: str, method: str = "GET", data: dict = None, params: dict = None):
+        token = self.get_token()
+        response = self._send(url, method, data, params, token)
+        if response.status_code == 401:
+            # the request was rejected, so it is safe to send it again with a new token
+            logger.warning("Keka rejected the token, getting a new one")
+            self.invalidate_token(token)
+            response = self._send(url, method, data, params, self.get_token())
+        return response
+
+
+    def _parse_response(self, url: str, response, ingest=False, db_path: str = None):
         if response.status_code != 200:
             logger.error(f"Error getting {url}! Response code: {response.status_code}")
             return {}
         response = response.json()
         if ingest:
-            db.upsert_record(db_path, response | {"email": self.user.email}, self.user.email)
+            # ingested data isn't critical, so it is written in the background
+            db.upsert_record(db_path, response | {"email": self.user.email}, self.user.email, defer=True)
         return response
 
 
+    def get_or_ingest_data(self, url: str, method: str = "GET",
+        ingest=False, db_path: str = None, data: dict = None, params: dict = None
+    ):
+        response = self.make_request(url, method=method, data=data, params=params)
+        return self._parse_response(url, response, ingest, db_path)
+
+
     def get_leaves_for_date(self, dt: datetime):
+        return self.get_leaves_for_range(dt, dt)
+
+
+    def get_leaves_for_range(self, from_date: datetime, to_date: datetime):
         return self.get_or_ingest_data(
             "/me/leave/calendarevents",
-            params={"fromDate": dt.isoformat(), "toDate": dt.isoformat()}
+            params={"fromDate": from_date.isoformat(), "toDate": to_date.isoformat()}
         )
         
     
@@ -87,66 +177,97 @@ class Keka:
         return data
 
 
-    def get_work_time_for_date(self, dt: datetime):
-        data = self.get_or_ingest_data(
+    def get_attendance_requests(self, from_date: datetime, to_date: datetime):
+        return self.get_or_ingest_data(
             "/mytime/attendance/attendancerequests",
-            params={"fromDate": dt.isoformat(), "toDate": dt.isoformat()},
+            params={"fromDate": from_date.isoformat(), "toDate": to_date.isoformat()},
+        )
+
+
+    def get_work_time_for_date(self, dt: datetime):
+        return self._work_time_from_attendance(self.get_attendance_requests(dt, dt), dt)
+
+
+    def get_work_time_for_range(self, from_date: datetime, to_date: datetime):
+        """Time worked on every day of the range, with one request per `ATTENDANCE_CHUNK_DAYS` days"""
+        days = {}
+        for start, end in attendance.date_chunks(from_date, to_date, config.ATTENDANCE_CHUNK_DAYS):
+            days |= self._work_time_by_day(self.get_attendance_requests(start, end), start, end)
+        return days
+
+
+    def _work_time_by_day(self, data: dict, from_date: datetime, to_date: datetime):
+        return attendance.work_time_by_day(data, from_date, to_date, datetime.now(self.user.timezone))
+
+
+    def _work_time_from_attendance(self, data: dict, dt: datetime):
+        return attendance.pair_punches(
+            attendance.clockin_entries(data, dt), dt, datetime.now(self.user.timezone)
         )
-        clockin_requests = [
-            y
-            for x in data.get("remoteClockInRequests", [])
-            for y in x.get("timeEntries", [])
-            if x.get("requestDate") == dt.isoformat()
-        ]
-        if len(clockin_requests) == 0:
-            return timedelta(seconds=0)
-        df = pd.DataFrame.from_records(clockin_requests)[["punchStatus", "actualTimestamp"]]
-        if len(df)%2 == 1 or df.iloc[-1]["punchStatus"] != 1:
-            last_punch_ts = datetime.fromisoformat(df.iloc[-1]["actualTimestamp"])
-            df.loc[len(df)] = (
-                [1, last_punch_ts.isoformat()] if last_punch_ts.date() == dt
-                else [1, datetime.now().isoformat()]
-            )
 
-        return timedelta(seconds=sum(map(
-            lambda x: (datetime.fromisoformat(x[1]) - datetime.fromisoformat(x[0])).total_seconds(),
-            df.groupby("punchStatus")
-            .agg({"actualTimestamp": list})
-            .transpose()
-            .apply(lambda x: zip_longest(x[0], x[1], fillvalue=datetime.now()), axis=1)
-            .iloc[0]
-        )))
-    
 
     def get_keka_profile(self):
         return self.get_or_ingest_data("/me/publicprofile")
 
 
+    def _update_leaves(self, profile: dict | None, leaves: dict | None, start: datetime, end: datetime):
+        if profile and self.leaves.employee_id is None:
+            self.leaves.employee_id = profile.get("id")
+        # an empty response means the request failed, the quarter is fetched again on the next check
+        if leaves and "teamLeaveRequests" in leaves:
+            self.leaves.update(start, end, leaves)
+
+
     def is_leave(self, dt: datetime):
-        keka_user_id = self.get_keka_profile().get("id")
-        leaves = self.get_leaves_for_date(dt)
-        print(leaves)
-        leaves = list(filter(
-            lambda x: (x.get("employeeId") == keka_user_id)
-            and ("2023-01-09" in [x.get("fromDate"), x.get("toDate")]),
-            leaves.get("teamLeaveRequests", [])
-        ))
-        return len(leaves) > 0
+        profile, leaves = None, None
+        if self.leaves.employee_id is None:
+            profile = self.get_keka_profile()
+        start, end = self.leaves.window(dt)
+        if self.leaves.needs_fetch(dt):
+            leaves = self.get_leaves_for_range(start, end)
+        self._update_leaves(profile, leaves, start, end)
+        return self.leaves.is_leave(dt)
 
 
     def is_holiday_or_weekend(self, dt: datetime):
-        is_first_day_of_year = dt.timetuple().tm_yday == 1
-        holidays = db.read_record(config.HOLIDAYS_DB, self.user.email)
-        if not holidays or is_first_day_of_year:
-            holidays = self.get_or_ingest_data("/dashboard/holidays", ingest=True, db_path=config.HOLIDAYS_DB)
-        is_holiday = dt in [datetime.fromisoformat(holiday.get("date")).date() for holiday in holidays.get("value")]
-        is_weekend = dt.weekday() in [5, 6]
+        if not self.holidays.covers(dt):
+            self.holidays.load()
+        if not self.holidays.covers(dt):
+            holidays = self.get_or_ingest_data("/dashboard/holidays")
+            if holidays:
+                self.holidays.update(holidays, dt.year)
+        return self._is_holiday_or_weekend_from(dt)
+
+
+    def _is_holiday_or_weekend_from(self, dt: datetime):
+        is_holiday = self.holidays.is_holiday(dt)
+        is_weekend = dt.weekday() in config.WEEKEND_DAYS
         return is_holiday or is_weekend
 
 
-    def punch(self, punch_type: config.PunchType | None = None, force: bool = False):
+    def refresh_working_days(self, start: datetime = None, days: int = config.WORKING_DAY_HORIZON):
+        """
+        Precomputes the working days of the next `days` days from the holidays, the weekends and the leaves.
+        Holidays are fetched once a year, or again after `holidays.invalidate()`, and leaves once per quarter,
+        weekends and holidays are ruled out before the leaves are looked at.
+        """
+        start = start or datetime.now(self.user.timezone).date()
+        end = start + timedelta(days=days - 1)
+        working_days = set()
+        day = start
+        while day <= end:
+            if not self.is_holiday_or_weekend(day) and not self.is_leave(day):
+                working_days.add(day)
+            day += timedelta(days=1)
+        self.working_days.update(start, end, working_days)
+        logger.info(f"{self.user.email} works on {len(working_days)} of the next {days} day(s)")
+        return self.working_days
+
+
+    def _prepare_punch(self, punch_type: config.PunchType | None, force: bool):
+        """Resolves the punch type and returns a result if the punch should not go ahead"""
         if punch_type == config.PunchType.NO_PUNCH:
-            return 200, config.SUCCESS
+            return punch_type, (200, config.SUCCESS)
 
         if not self.user.location_data.city:
             raise ValueError("Location data is not set")
@@ -159,20 +280,16 @@ class Keka:
                 last_punch_status.value if last_punch_status.value in [0, 1] else 1
             ))
 
-        user_current_time = datetime.now(self.user.timezone)
-        
-        if not force:
-            if last_punch_status == punch_type:
-                return 400, helpers.format_time_delta(
-                    f"Already {config.punch_message_map[punch_type.value]} ",
-                    user_current_time - last_punch_time, " ago"
-                )
-            if self.is_holiday_or_weekend(user_current_time.date()):
-                return 400, "It's a holiday or weekend. Not punching"
-            if self.is_leave(user_current_time.date()):
-                return 400, "Relax! You are on leave today..."
+        if not force and last_punch_status == punch_type:
+            return punch_type, (400, helpers.format_time_delta(
+                f"Already {config.punch_message_map[punch_type.value]} ",
+                datetime.now(self.user.timezone) - last_punch_time, " ago"
+            ))
+        return punch_type, None
+
 
-        json_data = {
+    def _punch_payload(self, punch_type: config.PunchType, user_current_time: datetime):
+        return {
             "attendanceLogSource": 1,
             "locationAddress": self.user.location_data.dict(),
             "manualClockinType": 3,
@@ -181,121 +298,405 @@ class Keka:
             "timestamp": user_current_time.replace(tzinfo=None).isoformat()[:-3] + "Z",
         }
 
-        response = self.make_request("/mytime/attendance/remoteclockin", "POST", json_data)
-        status = response.status_code
-        
+
+    def punch(self, punch_type: config.PunchType | None = None, force: bool = False):
+        with metrics.timed(metrics.PUNCH_SECONDS, punch_type=getattr(punch_type, "name", "AUTO"), status="error") as labels:
+            status, message = self._punch(punch_type, force)
+            labels["status"] = status
+        return status, message
+
+
+    def _punch(self, punch_type: config.PunchType | None, force: bool):
+        punch_type, result = self._prepare_punch(punch_type, force)
+        if result:
+            return result
+
+        user_current_time = datetime.now(self.user.timezone)
+
+        if not force:
+            if self.is_holiday_or_weekend(user_current_time.date()):
+                return 400, HOLIDAY_MESSAGE
+            if self.is_leave(user_current_time.date()):
+                return 400, LEAVE_MESSAGE
+
+        response = self.make_request(
+            "/mytime/attendance/remoteclockin", "POST", self._punch_payload(punch_type, user_current_time)
+        )
+        return self._handle_punch_response(punch_type, response.status_code, response.text)
+
+
+    def _handle_punch_response(self, punch_type: config.PunchType, status: int, text: str):
         if status == 200:
             self.save_state(punch_type)
             logger.info(message:=config.punch_message_map[punch_type.value])
             priority = NtfyPriority.Default
         else:
-            logger.error(message:=f"Error!!! Status Code: {status}, Response: {response.text}")
+            logger.error(message:=f"Error!!! Status Code: {status}, Response: {text}")
             priority = NtfyPriority.Max
 
         self.user.notify(message, priority, True)
         return status, message
 
 
+    def _token_expiry(self, data: dict, timestamp: datetime):
+        """
+        Expiry of a token and where it comes from: the `exp` claim of the token, the `expires_in`
+        of the token response, the lifetime learned from 401s, or `TOKEN_MAX_AGE` by default
+        """
+        expires_at = auth.token_expiry(data.get("token"))
+        if expires_at is not None:
+            return expires_at.astimezone(timestamp.tzinfo), "claims"
+        if data.get("expires_at"):
+            return datetime.fromisoformat(data["expires_at"]), "response"
+        lifetime = token_lifetimes.get(self.user.email) or data.get("learned_lifetime")
+        if lifetime:
+            token_lifetimes[self.user.email] = lifetime
+            return timestamp + timedelta(seconds=lifetime), "learned"
+        return timestamp + TOKEN_MAX_AGE, "default"
+
+
+    def _load_token(self, reload: bool = False):
+        """
+        Returns the cached token of the user, reading it from the db only when it isn't cached,
+        or with `reload`, to pick up a token another process refreshed
+        """
+        cached = None if reload else token_cache.get(self.user.email)
+        if cached is not None:
+            return cached
+
+        data: dict = db.read_record(config.TOKEN_DB, self.user.email) or {}
+        saved_email = data.get("email", "")
+        # added the email check to avoid using the token of another user,
+        # a token keka has already rejected is treated as expired
+        expired = (
+            data.get("timestamp") is None or saved_email != self.user.email
+            or data.get("token") == rejected_tokens.get(self.user.email)
+        )
+        if expired:
+            timestamp = datetime(2020, 1, 1, tzinfo=self.user.timezone)
+            expires_at, source = timestamp, "expired"
+        else:
+            timestamp = datetime.strptime(data.get("timestamp"), config.DATETIME_FORMAT)
+            expires_at, source = self._token_expiry(data, timestamp)
+        cached = {
+            "token": data.get("token"),
+            "timestamp": timestamp,
+            "expires_at": expires_at,
+            "expiry_source": source,
+            "refresh_lead": data.get("refresh_lead"),
+        }
+        token_cache[self.user.email] = cached
+        return cached
+
+
+    def _cache_token(self, data: dict):
+        timestamp = datetime.strptime(data["timestamp"], config.DATETIME_FORMAT)
+        expires_at, source = self._token_expiry(data, timestamp)
+        token_cache[self.user.email] = {
+            "token": data["token"],
+            "timestamp": timestamp,
+            "expires_at": expires_at,
+            "expiry_source": source,
+            "refresh_lead": data.get("refresh_lead"),
+        }
+        rejected_tokens.pop(self.user.email, None)
+
+
+    def invalidate_token(self, token: str = None):
+        """
+        Drops the cached token, if `token` is given only when it is still the cached one.
+        The age of a token keka rejects is remembered as the lifetime of the tokens of the user,
+        unless they carry their expiry.
+        """
+        with get_token_lock(self.user.email):
+            cached = token_cache.get(self.user.email)
+            if token is None or (cached and cached["token"] == token):
+                token_cache.pop(self.user.email, None)
+                rejected_tokens[self.user.email] = token
+                if cached and cached["expiry_source"] in ("learned", "default"):
+                    self._learn_lifetime(datetime.now(self.user.timezone) - cached["timestamp"])
+
+
+    def _learn_lifetime(self, lifetime: timedelta):
+        if lifetime <= timedelta(0):
+            return
+        token_lifetimes[self.user.email] = lifetime.total_seconds()
+        data: dict = db.read_record(config.TOKEN_DB, self.user.email) or {}
+        if data.get("email") == self.user.email:
+            db.upsert_record(
+                config.TOKEN_DB, data | {"learned_lifetime": lifetime.total_seconds()}, self.user.email, defer=True
+            )
+        logger.info(helpers.format_time_delta("Learned a token lifetime of ", lifetime, f" for {self.user.email}"))
+
+
     def get_token_age(self, timestamp: datetime = None, now: datetime = None, auto_load = False):
         if auto_load:
-            data: dict = db.read_record(config.TOKEN_DB, self.user.email) or {}
-            saved_email = data.get("email", "")
-            timestamp = (
-                datetime(2020, 1, 1, tzinfo=self.user.timezone)
-                if data.get("timestamp") is None or saved_email != self.user.email
-                else datetime.strptime(data.get("timestamp"), config.DATETIME_FORMAT)
-            )
+            timestamp = self._load_token()["timestamp"]
 
         now = now if now else datetime.now(self.user.timezone)
         token_age = now - timestamp
-        logger.log(
-            20 if auto_load else 10,
-            helpers.format_time_delta("Token is ", token_age, " old"),
-        )
+        level = 20 if auto_load else 10
+        if logger.isEnabledFor(level):
+            logger.log(level, helpers.format_time_delta("Token is ", token_age, " old"))
         return token_age, timestamp if auto_load else None
 
 
-    def get_token(
-        self, max_age: timedelta = timedelta(days=6, hours=12), max_retries: int = 3
-    ):
-        data: dict = db.read_record(config.TOKEN_DB, self.user.email)
+    def _is_fresh(self, cached: dict, max_age: timedelta = TOKEN_MAX_AGE, now: datetime = None):
+        now = now or datetime.now(self.user.timezone)
+        # `max_age` only applies to tokens with an unknown lifetime
+        expires_at = cached["timestamp"] + max_age if cached["expiry_source"] == "default" else cached["expires_at"]
+        return bool(cached["token"]) and now < expires_at - timedelta(seconds=config.TOKEN_EXPIRY_MARGIN)
+
+
+    def refresh_at(self, cached: dict = None):
+        """
+        When the token should be refreshed in the background: ahead of its expiry by `TOKEN_REFRESH_LEAD`
+        (at most a quarter of its lifetime) plus a jitter that stays the same for a user
+        """
+        cached = cached or self._load_token()
+        lifetime = cached["expires_at"] - cached["timestamp"]
+        lead = min(timedelta(seconds=config.TOKEN_REFRESH_LEAD), lifetime / 4)
+        jitter_span = min(timedelta(seconds=config.TOKEN_REFRESH_JITTER), lifetime / 10)
+        jitter = int(hashlib.sha1(self.user.email.encode()).hexdigest(), 16) % 1000 / 1000
+        return cached["expires_at"] - lead - jitter_span * jitter
+
+
+    def token_status(self, now: datetime = None):
+        """Expiry, lifetime and refresh times of the token"""
+        now = now or datetime.now(self.user.timezone)
+        cached = self._load_token()
+        counts = refresh_counts.get(self.user.email, {})
+        return {
+            "expires_at": cached["expires_at"].isoformat(),
+            "expires_in": (cached["expires_at"] - now).total_seconds(),
+            "lifetime": (cached["expires_at"] - cached["timestamp"]).total_seconds(),
+            "expiry_source": cached["expiry_source"],
+            "refresh_at": self.refresh_at(cached).isoformat(),
+            # seconds the last refresh happened before the previous token expired, negative if after
+            "refresh_lead": cached["refresh_lead"],
+            "background_refreshes": counts.get("background", 0),
+            "inline_refreshes": counts.get("inline", 0),
+        }
 
-        saved_email = data.get("email", "")
-        timestamp = data.get("timestamp")
 
-        # added the email check to avoid using the token of another user
-        timestamp = (
-            datetime(2020, 1, 1, 0, 0, 0, tzinfo=self.user.timezone).strftime(config.DATETIME_FORMAT)
-            if timestamp is None or saved_email != self.user.email
-            else timestamp
+    def cached_token(self, max_age: timedelta = TOKEN_MAX_AGE):
+        """Returns the cached token if it is fresh, without touching the db or refreshing it"""
+        cached = token_cache.get(self.user.email)
+        if cached and self._is_fresh(cached, max_age):
+            return cached["token"]
+        return None
+
+
+    def get_token(self, max_age: timedelta = TOKEN_MAX_AGE, max_retries: int = 3):
+        cached = self._load_token()
+        if self._is_fresh(cached, max_age):
+            return cached["token"]
+
+        # only one caller refreshes the token, the others wait for it and share its outcome
+        waiting_since = time.monotonic()
+        with get_token_lock(self.user.email):
+            # the scheduler refreshes tokens in its own process, so the db may hold a fresh one
+            cached = self._load_token(reload=True)
+            if self._is_fresh(cached, max_age):
+                return cached["token"]
+            if refresh_failures.get(self.user.email, 0) > waiting_since:
+                logger.warning(f"The token of {self.user.email} couldn't be refreshed while waiting, not trying again")
+                return cached["token"]
+
+            while not self._is_fresh(cached, max_age) and max_retries > 0:
+                # the background refresh of the scheduler should have kept this from happening
+                logger.warning(f"Token was last refreshed at {cached['timestamp'].isoformat()}. Refreshing token...")
+                self._count_refresh("inline")
+                self.refresh_token()
+                cached = self._load_token()
+                max_retries -= 1
+                logger.info(f"Retrying to get token. Retries left: {max_retries}")
+            if not self._is_fresh(cached, max_age):
+                refresh_failures[self.user.email] = time.monotonic()
+
+        return cached["token"]
+
+
+    def _count_refresh(self, kind: str):
+        counts = refresh_counts.setdefault(self.user.email, {})
+        counts[kind] = counts.get(kind, 0) + 1
+        metrics.TOKEN_REFRESHES.labels(kind).inc()
+
+
+    def refresh_token_if_due(self, now: datetime = None, before: datetime = None):
+        """
+        Refreshes the token if it is due for a background refresh, or won't be fresh anymore at `before`
+
+        Returns:
+            whether the token was refreshed, `None` if it wasn't due
+        """
+        now = now or datetime.now(self.user.timezone)
+        with get_token_lock(self.user.email):
+            due = lambda cached: now >= self.refresh_at(cached) or not self._is_fresh(cached, now=before or now)
+            # another process may have refreshed it already
+            if not due(self._load_token()) or not due(self._load_token(reload=True)):
+                return None
+            self._count_refresh("background")
+            return "token" in self.refresh_token(headless=True)
+
+
+    @staticmethod
+    def _logged_in(driver):
+        """Wait condition of the login, true once keka leaves the login page for the dashboard"""
+        from selenium.webdriver.common.by import By
+
+        errors = [x.text.strip() for x in driver.find_elements(By.XPATH, LOGIN_ERRORS) if x.is_displayed()]
+        if any(errors):
+            raise LoginError(f"Keka rejected the login: {'; '.join(filter(None, errors))}")
+        return (
+            urlparse(driver.current_url).netloc == urlparse(config.KEKA_LOGIN_URL).netloc
+            and not driver.find_elements(By.ID, LOGIN_CONTAINER)
         )
-        token_age, _ = self.get_token_age(
-            datetime.strptime(timestamp, config.DATETIME_FORMAT)
-        )
-
-        while token_age > max_age and max_retries > 0:
-            if token_age > max_age:
-                logger.info(f"Token was last refreshed at {timestamp}. Refreshing token...")
-                data = self.refresh_token()
-            token_age, _ = self.get_token_age(
-                datetime.strptime(
-                    data.get("timestamp", timestamp), config.DATETIME_FORMAT
-                )
-            )
-            max_retries -= 1
-            logger.info(f"Retrying to get token. Retries left: {max_retries}")
-
-        token = data.get("token")
-        return token
-
-
-    def login(self, email: str, password: str, headless=False):
-        driver = helpers.get_chrome_driver(headless=headless, enable_logs=True)
-        driver.get(config.KEKA_LOGIN_URL)
-        time.sleep(15)
 
-        driver.find_element(
-            By.XPATH, '//*[@id="login-container-center"]/div/div/div[3]/form/button[2]'
-        ).click()
-        time.sleep(5)
 
-        driver.find_element(By.ID, "email").send_keys(email)
-        time.sleep(1)
-
-        driver.find_element(By.ID, "password").send_keys(password)
-        time.sleep(1)
+    def login(self, email: str, password: str, headless=False, enable_logs=True, on_start=None):
+        """
+        Logs into keka with chrome and returns the driver, waiting for every element instead of sleeping.
+        `on_start` is called with the driver before keka is opened.
+
+        Raises:
+            LoginError if keka rejects the credentials, an element doesn't show up within
+            `LOGIN_STEP_TIMEOUT` seconds or the whole login takes longer than `LOGIN_TIMEOUT` seconds
+        """
+        # selenium is only imported by the processes that log in with a browser
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException, StaleElementReferenceException
+
+        deadline = time.monotonic() + config.LOGIN_TIMEOUT
+        timings: dict[str, float] = {}
+
+        def step(name: str, condition, timeout: float = None):
+            start = time.monotonic()
+            timeout = min(timeout or config.LOGIN_STEP_TIMEOUT, deadline - start)
+            try:
+                if timeout <= 0:
+                    raise TimeoutException()
+                return WebDriverWait(
+                    driver, timeout, poll_frequency=0.1, ignored_exceptions=[StaleElementReferenceException]
+                ).until(condition)
+            except TimeoutException:
+                raise LoginError(f"Timed out waiting for {name} after {time.monotonic() - start:.1f}s") from None
+            finally:
+                timings[name] = time.monotonic() - start
+
+        start = time.monotonic()
+        driver = helpers.get_chrome_driver(headless=headless, enable_logs=enable_logs)
+        timings["browser"] = time.monotonic() - start
+        outcome = "failure"
+        try:
+            if on_start:
+                start = time.monotonic()
+                on_start(driver)
+                timings["capture"] = time.monotonic() - start
+            driver.get(config.KEKA_LOGIN_URL)
+            step("login page", EC.element_to_be_clickable((By.XPATH, LOGIN_WITH_PASSWORD_BUTTON))).click()
+            step("email field", EC.visibility_of_element_located((By.ID, "email"))).send_keys(email)
+            step("password field", EC.visibility_of_element_located((By.ID, "password"))).send_keys(password)
+            step("submit button", EC.element_to_be_clickable((By.XPATH, LOGIN_SUBMIT_BUTTON))).click()
+            step("dashboard", self._logged_in)
+            outcome = "success"
+        except Exception:
+            driver.quit()
+            raise
+        finally:
+            metrics.LOGIN_SECONDS.labels("browser", outcome).observe(sum(timings.values()))
+            logger.info(
+                f"Login of {email} took {sum(timings.values()):.1f}s ("
+                + ", ".join(f"{name}: {seconds:.1f}s" for name, seconds in timings.items()) + ")"
+            )
 
-        driver.find_element(
-            By.XPATH,
-            '//*[@id="login-container-center"]/div/div/form/div/div[4]/div/button',
-        ).click()
-        # TODO: Add a check to see if login was successful
         logger.info("Login successful")
-        time.sleep(5)
-
         return driver
 
 
+    def _token_over_http(self):
+        """Token, request log and lifetime from a login over plain http, `None`s if it fails"""
+        try:
+            response = auth.login_over_http(self.user.email, self.user.passw)
+        except auth.AuthError as e:
+            logger.warning(f"Http login of {self.user.email} failed: {e}")
+            return None, None, None
+        url = urljoin(config.KEKA_IDENTITY_URL, "connect/token")
+        return response["access_token"], capture.request_log({"url": url, "method": "POST"}), response.get("expires_in")
+
+
+    def _token_from_browser(self, headless=True):
+        """Token, request log and lifetime (never known) from a login with chrome, `None`s if it fails"""
+        token, log, listener = None, None, None
+        use_cdp = config.TOKEN_CAPTURE_MODE == "cdp"
+
+        def start_capture(driver):
+            nonlocal listener
+            listener = capture.CdpTokenCapture(driver).start()
+
+        # chrome is heavy, so only a few users can refresh their tokens at once
+        with browser_slots:
+            try:
+                driver = self.login(
+                    self.user.email, self.user.passw, headless=headless,
+                    enable_logs=not use_cdp, on_start=start_capture if use_cdp else None,
+                )
+                try:
+                    # the dashboard calls the api with the token right after loading,
+                    # the browser is closed as soon as it does
+                    start = time.monotonic()
+                    token, log = (
+                        listener.result(config.LOGIN_STEP_TIMEOUT) if use_cdp
+                        else capture.wait_token_in_logs(driver, config.LOGIN_STEP_TIMEOUT)
+                    )
+                    logger.info(f"Waited {time.monotonic() - start:.1f}s for a request with the token")
+                finally:
+                    driver.quit()
+            except LoginError as e:
+                logger.error(f"Login of {self.user.email} failed: {e}")
+            finally:
+                if listener:
+                    listener.stop()
+        return token, log, None
+
+
     def refresh_token(self, headless=True):
         if not (self.user.email and self.user.passw):
             logger.exception("Email or password is not set")
 
-        driver = self.login(self.user.email, self.user.passw, headless=headless)
-        request_logs: list[dict] = driver.get_log("performance")
-        data = {"email": self.user.email}
+        token, log, expires_in = None, None, None
+        strategy = config.TOKEN_REFRESH_STRATEGY
+        # never more than one refresh at a time for the same user
+        with metrics.timed(metrics.TOKEN_REFRESH_SECONDS, strategy="none", outcome="failure") as labels, \
+                get_token_lock(self.user.email):
+            previous = self._load_token()
+            if strategy == "http" or (strategy == "auto" and auth.is_configured()):
+                labels["strategy"] = "http"
+                token, log, expires_in = self._token_over_http()
+            if not token and strategy in ("auto", "browser"):
+                labels["strategy"] = "browser"
+                token, log, expires_in = self._token_from_browser(headless=headless)
+            labels["outcome"] = "success" if token else "failure"
+            data = {"email": self.user.email}
 
-        for x in request_logs:
-            token = re.findall(r"(?:Bearer\s)([a-zA-Z0-9]+)", str(x))
             if token:
-                request_log = json.loads(x.get("message", "{}"))
-                request_log["email"] = self.user.email
-                db.upsert_record("requests", request_log, self.user.email)
-                data["token"] = token[0]
-                data["timestamp"] = datetime.now(self.user.timezone).isoformat()
-                break
+                now = datetime.now(self.user.timezone)
+                db.upsert_record("requests", log | {"email": self.user.email}, self.user.email, defer=True)
+                data["token"] = token
+                data["timestamp"] = now.isoformat()
+                if expires_in:
+                    data["expires_at"] = (now + timedelta(seconds=expires_in)).isoformat()
+                if token_lifetimes.get(self.user.email):
+                    data["learned_lifetime"] = token_lifetimes[self.user.email]
+                if previous["expiry_source"] != "expired":
+                    data["refresh_lead"] = (previous["expires_at"] - now).total_seconds()
+                # saved and cached under the lock, so that the callers waiting on it see the new token
+                db.upsert_record(config.TOKEN_DB, data, self.user.email)
+                self._cache_token(data)
 
         if "token" in data:
-            db.upsert_record(config.TOKEN_DB, data, self.user.email)
             logger.info(message:=f"Token has been updated!")
             priority = NtfyPriority.Default
         else:
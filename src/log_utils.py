@@ -1,27 +1,78 @@
+import io
+import os
+import re
 import sys
+import gzip
 import json
+import time
+import zlib
+import queue
+import atexit
 import logging
 from datetime import datetime
-from src.models import LogModel
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
+
 
 class LoggingFormatter(logging.Formatter):
+    """Formats records as json lines of `message`, `severity` and `timestamp`, straight from the record"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # timestamps have a precision of a second, so the last one is reused
+        self.last_second = (None, "")
+
     def format(self, record: logging.LogRecord) -> str:
         s = super().format(record)
-        return LogModel(
-            message=s,
-            severity=record.levelname,
-            timestamp=datetime.fromtimestamp(record.created).isoformat()[:-7],
-        ).json()
+        second, timestamp = self.last_second
+        if int(record.created) != second:
+            second = int(record.created)
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(second))
+            self.last_second = (second, timestamp)
+        return json.dumps({"message": s, "severity": record.levelname, "timestamp": timestamp})
+
+
+# writes the queued records on a thread of its own
+listener: QueueListener | None = None
+
+
+def stop_listener():
+    """Writes the records still queued and makes the root logger write directly to the handlers"""
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    logger = logging.getLogger()
+    for handler in [x for x in logger.handlers if isinstance(x, QueueHandler)]:
+        logger.removeHandler(handler)
+    for handler in listener.handlers:
+        logger.addHandler(handler)
+    listener = None
 
 
-def create_logger(level=logging.DEBUG):
+def create_logger(level=logging.DEBUG, log_file: str = None):
+    global listener
+    stop_listener()
     logger = logging.getLogger()
     if logger.hasHandlers():
         logger.handlers.clear()
-    handler = logging.StreamHandler(sys.stdout)
     formatter = LoggingFormatter(fmt="[%(name)s] %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    log_file = log_file if log_file is not None else os.environ.get("LOG_FILE")
+    if log_file:
+        handlers.append(SegmentedFileHandler(
+            log_file,
+            max_bytes=int(os.environ.get("LOG_MAX_BYTES", 50 * 2 ** 20)),
+            interval=float(os.environ.get("LOG_ROTATE_INTERVAL", 24 * 60 * 60)),
+            backup_count=int(os.environ.get("LOG_BACKUP_COUNT", 30)),
+            compression=os.environ.get("LOG_COMPRESSION", "gzip"),
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    # the calling thread only renders the message and queues the record,
+    # formatting it as json, writing and rotating the file happen on the listener's thread
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    logger.addHandler(QueueHandler(log_queue))
     logger.setLevel(level)
     return logger
 
@@ -29,3 +80,291 @@ def create_logger(level=logging.DEBUG):
 def get_logger(level=logging.INFO):
     create_logger(level)
     return logging.getLogger()
+
+
+atexit.register(stop_listener)
+
+
+SEVERITIES = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+SEVERITY_FIELD = re.compile(rb'"severity":\s*"(\w+)"')
+TIMESTAMP_FIELD = re.compile(rb'"timestamp":\s*"([^"]+)"')
+
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+INDEX_SUFFIX = ".idx.json"
+TMP_SUFFIX = ".tmp"
+
+
+def open_compressed(path: str, mode: str = "rb"):
+    if path.endswith(".zst"):
+        import zstandard
+        f = open(path, mode)
+        return zstandard.ZstdCompressor().stream_writer(f) if "w" in mode else zstandard.ZstdDecompressor().stream_reader(f)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=6) if "w" in mode else gzip.open(path, mode)
+    return open(path, mode)
+
+
+def archive_segment(path: str, compression: str = "gzip"):
+    """
+    Compresses a rotated log file and writes its sidecar index in the same pass: the time range,
+    the number of records and the number of records of every severity in the segment.
+    The compressed file only shows up under its name once it is complete, readers see the rotated file until then.
+    """
+    index = {"first": None, "last": None, "records": 0, "severities": {}}
+    target = path + COMPRESSED_SUFFIXES[compression]
+    # the suffix of the compression goes last, `open_compressed` picks the codec from it
+    partial = path + TMP_SUFFIX + COMPRESSED_SUFFIXES[compression]
+    # without compression the rotated file stays as it is and only gets its index
+    with open(path, "rb") as source, open_compressed(partial if target != path else os.devnull, "wb") as f:
+        for line in source:
+            f.write(line)
+            timestamp, severity = TIMESTAMP_FIELD.search(line), SEVERITY_FIELD.search(line)
+            if timestamp is None or severity is None:
+                continue
+            timestamp, severity = timestamp[1].decode(), severity[1].decode()
+            index["first"] = index["first"] or timestamp
+            index["last"] = timestamp
+            index["records"] += 1
+            index["severities"][severity] = index["severities"].get(severity, 0) + 1
+    with open(target + INDEX_SUFFIX, "w") as f:
+        json.dump(index, f)
+    if target != path:
+        os.replace(partial, target)
+        os.remove(path)
+    return target
+
+
+def log_segments(path: str):
+    """
+    The log file and its rotated segments, newest first. Segments being compressed are skipped,
+    and so is a rotated file once its compressed copy is complete.
+    """
+    directory, name = os.path.split(path)
+    if not os.path.isdir(directory or "."):
+        return [path]
+    files = set(os.listdir(directory or "."))
+    rotated = [
+        x for x in files
+        if x.startswith(name + ".") and not x.endswith(INDEX_SUFFIX)
+        and TMP_SUFFIX not in x[len(name):]
+        and not any(x + suffix in files for suffix in COMPRESSED_SUFFIXES.values() if suffix)
+    ]
+    # segments are named after the time they were rotated at
+    return [path] + [os.path.join(directory, x) for x in sorted(rotated, reverse=True)]
+
+
+def read_index(segment: str):
+    try:
+        with open(segment + INDEX_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SegmentedFileHandler(BaseRotatingHandler):
+    """
+    Writes to `path` and rotates it once it grows past `max_bytes` or gets older than `interval` seconds.
+    Rotated segments are compressed, get a sidecar index and only the latest `backup_count` are kept.
+    """
+    def __init__(
+        self, path: str, max_bytes: int = 0, interval: float = 0, backup_count: int = 0, compression: str = "gzip",
+    ):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        super().__init__(path, "a", encoding="utf-8")
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                compression = "gzip"
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.compression = compression
+        self.rollover_at = self.segment_start() + interval if interval else None
+
+    def segment_start(self):
+        """Time of the first record of the current file, so restarts don't reset its age"""
+        with open(self.baseFilename, "rb") as f:
+            match = TIMESTAMP_FIELD.search(f.readline())
+        try:
+            return datetime.fromisoformat(match[1].decode()).timestamp()
+        except (TypeError, ValueError):
+            return time.time()
+
+    def shouldRollover(self, record: logging.LogRecord):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.stream.tell() == 0:
+            return False
+        return bool(
+            (self.max_bytes and self.stream.tell() >= self.max_bytes)
+            or (self.rollover_at and record.created >= self.rollover_at)
+        )
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        now = time.time()
+        rotated = f"{self.baseFilename}.{time.strftime('%Y%m%dT%H%M%S', time.localtime(now))}{int(now % 1 * 1e6):06d}"
+        os.rename(self.baseFilename, rotated)
+        archive_segment(rotated, self.compression)
+        if self.backup_count:
+            for segment in log_segments(self.baseFilename)[1 + self.backup_count:]:
+                for x in (segment, segment + INDEX_SUFFIX):
+                    if os.path.exists(x):
+                        os.remove(x)
+        self.stream = self._open()
+        self.rollover_at = now + self.interval if self.interval else None
+
+
+def reverse_lines(f, end: int = None, block_size: int = 1 << 16):
+    """
+    Yields `(offset, line)` for the lines of a seekable binary file from the last to the first,
+    reading blocks backwards from byte `end` (the end of the file by default)
+    """
+    size = f.seek(0, os.SEEK_END)
+    position = size if end is None else max(0, min(end, size))
+    tail = b""
+    while position > 0:
+        read = min(block_size, position)
+        position -= read
+        f.seek(position)
+        lines = (f.read(read) + tail).split(b"\n")
+        # the first line may have started in an earlier block
+        tail = lines.pop(0)
+        line_end = position + len(tail) + 1 + sum(len(x) + 1 for x in lines) - 1
+        for line in reversed(lines):
+            start = line_end - len(line)
+            if line:
+                yield start, line
+            line_end = start - 1
+    if tail:
+        yield 0, tail
+
+
+def open_segment(segment: str):
+    """A seekable binary file of a segment, compressed segments are decompressed in memory"""
+    if segment.endswith((".gz", ".zst")):
+        with open_compressed(segment) as f:
+            return io.BytesIO(f.read())
+    return open(segment, "rb")
+
+
+def first_line_id(f):
+    """Checksum of the first line of a segment, which stays the same when the log file is rotated into a segment"""
+    line = f.read(1 << 12).split(b"\n", 1)[0]
+    return f"{zlib.crc32(line):08x}"
+
+
+def find_segment(segments: list[str], cursor: str):
+    """
+    Index of the segment a cursor points into. Cursors into the log file are `@<first line id>:<offset>`,
+    so that once the file is rotated they point into the segment it became instead of into the new file.
+    """
+    name, _, _ = cursor.rpartition(":")
+    names = [os.path.basename(x) for x in segments]
+    if not name.startswith("@"):
+        return names.index(name) if name in names else None
+    for i, segment in enumerate(segments):
+        try:
+            # only the start of the segment is decompressed
+            with open_compressed(segment) as f:
+                if first_line_id(f) == name[1:]:
+                    return i
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def read_logs(
+    path: str,
+    length: int = 100,
+    severity: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    contains: str = None,
+    cursor: str = None,
+):
+    """
+    Reads the latest json log records of a file and its rotated segments, newest first,
+    parsing only the lines it returns. Segments whose index shows they can't match are not opened.
+
+    Args:
+        path: the log file
+        length: maximum number of records, all of them if negative
+        severity: minimum severity of the records, like `WARNING`
+        since: oldest timestamp of the records
+        until: newest timestamp of the records
+        contains: text the message has to contain
+        cursor: the cursor returned with the previous page, to read the records before it
+
+    Returns:
+        the records and the cursor of the next page, `None` when the oldest segment was read
+    """
+    min_level = SEVERITIES.get((severity or "").upper(), 0)
+    since, until = [x.astimezone().replace(tzinfo=None) if x and x.tzinfo else x for x in (since, until)]
+    needle = json.dumps(contains)[1:-1].encode() if contains else None
+
+    # cursors are `<segment>:<offset>`, or `@<first line id>:<offset>` within the log file
+    segments = log_segments(path)
+    names = [os.path.basename(x) for x in segments]
+    start, end = 0, None
+    if cursor:
+        start, end = find_segment(segments, cursor), int(cursor.rpartition(":")[2])
+        if start is None:
+            # the segment was removed, past `LOG_BACKUP_COUNT`
+            return [], None
+
+    records = []
+    for i, segment in enumerate(segments[start:], start):
+        index = read_index(segment) if i else None
+        if index:
+            if since and index["last"] and datetime.fromisoformat(index["last"]) < since:
+                break
+            if (
+                (until and index["first"] and datetime.fromisoformat(index["first"]) > until)
+                or not any(n for x, n in index["severities"].items() if SEVERITIES.get(x, 0) >= min_level)
+            ):
+                end = None
+                continue
+        try:
+            f = open_segment(segment)
+        except FileNotFoundError:
+            # removed since it was listed, once compressed or past `LOG_BACKUP_COUNT`
+            continue
+        with f:
+            for offset, line in reverse_lines(f, end):
+                if 0 <= length <= len(records):
+                    if not i:
+                        f.seek(0)
+                    return records, f"{names[i] if i else '@' + first_line_id(f)}:{offset + len(line) + 1}"
+                if not line.startswith(b"{"):
+                    continue
+                # severity and timestamp are matched on the raw line, only the lines that pass are parsed
+                if min_level:
+                    match = SEVERITY_FIELD.search(line)
+                    if not match or SEVERITIES.get(match[1].decode(), 0) < min_level:
+                        continue
+                if since or until:
+                    match = TIMESTAMP_FIELD.search(line)
+                    try:
+                        timestamp = datetime.fromisoformat(match[1].decode())
+                    except (TypeError, ValueError):
+                        continue
+                    if since and timestamp < since:
+                        # the segments are in chronological order, everything before this is older still
+                        return records, None
+                    if until and timestamp > until:
+                        continue
+                if needle and needle not in line:
+                    continue
+                try:
+                    record: dict = json.loads(line)
+                except ValueError:
+                    continue
+                if needle and contains not in record.get("message", ""):
+                    continue
+                records.append(record)
+        end = None
+    return records, None
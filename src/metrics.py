@@ -0,0 +1,63 @@
+"""
+Prometheus metrics of the process, served by `/metrics` for the api and on `SCHEDULER_METRICS_PORT` for the scheduler.
+The default registry also exports the RSS, cpu time and open files of the process.
+"""
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+
+# buckets in seconds, from a cached db read to a browser login
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+DRIFT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600)
+
+KEKA_REQUEST_SECONDS = Histogram(
+    "keka_request_seconds", "Calls to the keka api", ["method", "endpoint", "status"], buckets=SLOW_BUCKETS,
+)
+DB_OPERATION_SECONDS = Histogram(
+    "db_operation_seconds", "Reads and writes of the db", ["backend", "table", "operation"], buckets=FAST_BUCKETS,
+)
+LOGIN_SECONDS = Histogram(
+    "keka_login_seconds", "Logins into keka", ["method", "outcome"], buckets=SLOW_BUCKETS,
+)
+TOKEN_REFRESH_SECONDS = Histogram(
+    "token_refresh_seconds", "Token refreshes, from the lock to the saved token", ["strategy", "outcome"], buckets=SLOW_BUCKETS,
+)
+TOKEN_REFRESHES = Counter(
+    "token_refreshes", "Token refreshes, made in the background by the scheduler or inline when a token was needed", ["kind"],
+)
+PUNCH_SECONDS = Histogram(
+    "punch_seconds", "Punches from the state check to keka's answer", ["punch_type", "status"], buckets=SLOW_BUCKETS,
+)
+NOTIFY_SECONDS = Histogram(
+    "notify_seconds", "Sends of coalesced notifications to ntfy", ["outcome"], buckets=SLOW_BUCKETS,
+)
+NOTIFICATIONS = Counter(
+    "notifications", "Notifications by what became of them", ["outcome"],
+)
+NOTIFY_QUEUE = Gauge(
+    "notify_queue", "Notifications enqueued in memory and not spooled yet",
+)
+SCHEDULER_DRIFT_SECONDS = Histogram(
+    "scheduler_drift_seconds", "Delay between the time a job was planned for and the time it ran", ["job"], buckets=DRIFT_BUCKETS,
+)
+SCHEDULER_QUEUE_SECONDS = Histogram(
+    "scheduler_queue_seconds", "Time jobs waited in the pool of the scheduler for a worker", ["job"], buckets=DRIFT_BUCKETS,
+)
+SCHEDULER_JOB_FAILURES = Counter(
+    "scheduler_job_failures", "Jobs of the scheduler that raised, by job", ["job"],
+)
+SCHEDULER_JOBS = Gauge(
+    "scheduler_jobs", "Jobs of the scheduler, planned punches included",
+)
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    """Observes the duration of the block, with the labels the block sets in the yielded dict"""
+    start = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
@@ -23,12 +23,27 @@ class DbUser(BaseUser):
     lng: str
     passw: str
     timestamp: str
+    secret: str | None = None
+    timezone: str | None = None
+
+class NewUser(BaseModel):
+    email: str
+    passw: str
+    lat: str
+    lng: str
+    timezone: str | None = None
     
 class LogModel(BaseModel):
     message: str
     severity: str
     timestamp: str
 
+class ScheduleModel(BaseModel):
+    time: str
+    min_jitter: int
+    max_jitter: int
+    enabled: bool = True
+
 class NtfyPriority(IntEnum):
     Max = 5
     High = 4
@@ -0,0 +1,235 @@
+import os
+import time
+import queue
+import atexit
+import config
+import random
+import sqlite3
+import threading
+from src import helpers
+from src import metrics
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = config.LOGGER
+
+# seconds a claimed notification stays hidden from the other processes sharing the spool while it is sent
+LEASE = 60
+
+
+class Outbox:
+    """
+    Notifications to ntfy, enqueued in memory by the callers and written to a sqlite spool by a background
+    worker, which sends them over a pooled session. Notifications of a channel that pile up within
+    `NOTIFY_COALESCE_WINDOW` seconds are sent as one, failed ones are retried with exponential backoff.
+    Several processes can share the spool, a notification is claimed by one of them before it is sent.
+    """
+    def __init__(self, path: str = None, url: str = None):
+        self.path = path or config.NOTIFY_SPOOL_PATH
+        self.url = (url or config.NTFY_URL).rstrip("/")
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.conn: sqlite3.Connection | None = None
+        self.session = None
+        self.senders = ThreadPoolExecutor(max_workers=config.NOTIFY_WORKERS, thread_name_prefix="notify")
+        self.worker: threading.Thread | None = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # true while the queue is empty and nothing in the spool is due, guarded by `changed`
+        self.idle = False
+        self.changed = threading.Condition()
+        self.sent = 0
+
+
+    def start(self):
+        if self.worker is None:
+            with self.lock:
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self._run, name="outbox", daemon=True)
+                    self.worker.start()
+        return self
+
+
+    def enqueue(self, channel: str, message: str, priority: int = 3, email: str = None):
+        """Only puts the notification in memory, the worker spools and sends it"""
+        with self.changed:
+            self.idle = False
+            self.queue.put((channel, message, int(priority), email, time.time()))
+        metrics.NOTIFICATIONS.labels("enqueued").inc()
+        self.start()
+
+
+    def _connect(self):
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, channel TEXT NOT NULL, message TEXT NOT NULL, "
+            "priority INTEGER NOT NULL, email TEXT, created_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at)")
+        return conn
+
+
+    def _drain(self, timeout: float):
+        """Notifications of the queue, waiting up to `timeout` seconds for the first one"""
+        try:
+            items = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        # the rest of a burst is gathered before anything is sent, so it can be coalesced
+        time.sleep(config.NOTIFY_COALESCE_WINDOW)
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                return items
+
+
+    def _spool(self, items: list[tuple]):
+        self.conn.executemany(
+            "INSERT INTO outbox (channel, message, priority, email, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [item + (item[-1],) for item in items],
+        )
+
+
+    def _claim(self, now: float):
+        """Due notifications grouped by channel, leased to this process"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute(
+                "SELECT id, channel, message, priority, email, attempts FROM outbox WHERE next_attempt_at <= ? ORDER BY id",
+                (now,),
+            ).fetchall()
+            self.conn.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?", [(now + LEASE, x[0]) for x in rows])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        channels: dict[str, list[tuple]] = {}
+        for row in rows:
+            channels.setdefault(row[1], []).append(row)
+        return channels
+
+
+    def _next_due(self):
+        row = self.conn.execute("SELECT MIN(next_attempt_at) FROM outbox").fetchone()
+        return row[0]
+
+
+    def _send(self, channel: str, rows: list[tuple]):
+        """Sends the notifications of a channel as one, returns whether ntfy took them and whether to retry"""
+        if self.session is None:
+            self.session = helpers.get_http_session(pool_size=config.NOTIFY_WORKERS, max_retries=0)
+        priority = max(x[3] for x in rows)
+        email = next((x[4] for x in rows if x[4]), None)
+        headers = {"Priority": str(priority), "Tags": ("heavy_check_mark", "x")[priority > 3]}
+        if email:
+            headers["Email"] = email
+        if len(rows) > 1:
+            headers["Title"] = f"{len(rows)} notifications"
+        with metrics.timed(metrics.NOTIFY_SECONDS, outcome="error") as labels:
+            try:
+                response = self.session.post(
+                    f"{self.url}/{channel}",
+                    data="\n".join(x[2] for x in rows).encode(encoding="utf-8"),
+                    headers=headers,
+                    timeout=(config.NOTIFY_CONNECT_TIMEOUT, config.NOTIFY_READ_TIMEOUT),
+                )
+            except OSError as e:
+                logger.warning(f"Couldn't reach ntfy for {channel!r}: {e!r}")
+                return False, True
+            labels["outcome"] = response.status_code
+        if response.status_code == 200:
+            return True, False
+        logger.warning(f"ntfy answered {response.status_code} for {channel!r}: {response.text[:200]}")
+        return False, response.status_code == 429 or response.status_code >= 500
+
+
+    def _settle(self, channel: str, rows: list[tuple], sent: bool, retry: bool, now: float):
+        ids = [(x[0],) for x in rows]
+        attempts = max(x[5] for x in rows) + 1
+        if sent:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", ids)
+            self.sent += len(rows)
+            metrics.NOTIFICATIONS.labels("sent").inc(len(rows))
+            logger.info(f"Notified {channel!r} of {len(rows)} message(s) on '{self.url}/{channel}'")
+        elif retry and attempts < config.NOTIFY_MAX_ATTEMPTS:
+            delay = min(config.NOTIFY_RETRY_BACKOFF * 2 ** (attempts - 1), config.NOTIFY_MAX_BACKOFF)
+            # jitter, so that the channels that failed together are not retried together
+            delay *= random.uniform(0.5, 1)
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                [(attempts, now + delay, x[0]) for x in ids],
+            )
+            metrics.NOTIFICATIONS.labels("retried").inc(len(rows))
+        else:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", ids)
+            metrics.NOTIFICATIONS.labels("dropped").inc(len(rows))
+            logger.error(f"Dropped {len(rows)} notification(s) of {channel!r} after {attempts} attempt(s)")
+
+
+    def _run(self):
+        self.conn = self._connect()
+        while True:
+            try:
+                next_due = self._next_due()
+                timeout = max(0.0, next_due - time.time()) if next_due is not None else None
+                with self.changed:
+                    self.idle = self.queue.empty() and (timeout is None or timeout > 0)
+                    self.changed.notify_all()
+                if self.stopping.is_set():
+                    self._spool(self._drain(0))
+                    return
+                # the queue is waited on in short steps, so that a stop is noticed
+                items = self._drain(min(timeout, 1) if timeout is not None else 1)
+                if items:
+                    self._spool(items)
+                now = time.time()
+                channels = self._claim(now)
+                if not channels:
+                    continue
+                try:
+                    results = self.senders.map(lambda x: (x[0], x[1], *self._send(*x)), channels.items())
+                except RuntimeError:
+                    # the interpreter is exiting and shut the senders down before `stop` ran, what is in memory
+                    # is spooled and the claimed notifications are sent by the next process once their lease ends
+                    self.stopping.set()
+                    continue
+                for channel, rows, sent, retry in results:
+                    self._settle(channel, rows, sent, retry, time.time())
+            except Exception:
+                logger.exception("The notification outbox failed")
+                time.sleep(1)
+
+
+    def flush(self, timeout: float = 10):
+        """Waits until every notification due has been sent or rescheduled, returns whether it happened in time"""
+        with self.changed:
+            return self.changed.wait_for(lambda: self.idle, timeout)
+
+
+    def stop(self):
+        """Spools what is still in memory, it is sent by the next process using the spool"""
+        self.stopping.set()
+        if self.worker is not None:
+            self.worker.join(timeout=5)
+            if self.worker.is_alive():
+                # still sending, its daemon thread ends with the process
+                return
+        self.senders.shutdown(wait=False)
+
+
+@lru_cache(maxsize=1)
+def get_outbox():
+    # started right away, so that what earlier processes left in the spool is sent
+    outbox = Outbox().start()
+    metrics.NOTIFY_QUEUE.set_function(outbox.queue.qsize)
+    atexit.register(outbox.stop)
+    return outbox
+
+
+def notify(channel: str, message: str, priority: int = 3, email: str = None):
+    get_outbox().enqueue(channel, message, priority, email)
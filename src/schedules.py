@@ -0,0 +1,51 @@
+import config
+from datetime import time
+
+
+db = config.DB
+logger = config.LOGGER
+
+# punches the scheduler runs every day, at `time` in every user's timezone plus a random delay
+# of `min_jitter` to `max_jitter` seconds that differs for every user
+DEFAULTS = {
+    config.PunchType.PUNCH_IN.name: {
+        "time": config.PUNCH_IN_TIME, "min_jitter": config.PUNCH_MIN_JITTER, "max_jitter": config.PUNCH_MAX_JITTER, "enabled": True,
+    },
+    config.PunchType.PUNCH_OUT.name: {
+        "time": config.PUNCH_OUT_TIME, "min_jitter": config.PUNCH_MIN_JITTER, "max_jitter": config.PUNCH_MAX_JITTER, "enabled": True,
+    },
+}
+
+
+def validate(schedule: dict):
+    if time.fromisoformat(schedule["time"]).tzinfo is not None:
+        # punches are planned in the timezone of every user
+        raise ValueError("The time can't have a timezone offset")
+    if not 0 <= schedule["min_jitter"] <= schedule["max_jitter"]:
+        raise ValueError("The jitter must be 0 <= min_jitter <= max_jitter")
+    return schedule
+
+
+def load_schedules():
+    """Punch schedules saved in `SCHEDULES_DB` over the defaults, by the name of their punch type"""
+    schedules = {name: dict(schedule) for name, schedule in DEFAULTS.items()}
+    for record in db.read_records(config.SCHEDULES_DB):
+        name = record.get("key")
+        if name not in schedules:
+            continue
+        schedule = schedules[name] | {x: record[x] for x in schedules[name] if x in record}
+        try:
+            schedules[name] = validate(schedule)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Ignoring the saved schedule of {name}: {e}")
+    return schedules
+
+
+def save_schedule(name: str, schedule: dict):
+    """Validates and saves the schedule of a punch type, the scheduler picks it up without a restart"""
+    if name not in DEFAULTS:
+        raise KeyError(name)
+    schedule = validate(DEFAULTS[name] | schedule)
+    db.upsert_record(config.SCHEDULES_DB, schedule, name)
+    logger.info(f"Saved the schedule of {name}: {schedule}")
+    return schedule
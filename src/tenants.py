@@ -0,0 +1,74 @@
+import config
+import threading
+from src.user import User
+from src.keka import Keka
+
+
+db = config.DB
+logger = config.LOGGER
+
+
+class Tenant:
+    def __init__(self, user: User, keka: Keka):
+        self.user = user
+        self.keka = keka
+
+    @property
+    def email(self):
+        return self.user.email
+
+    def __str__(self):
+        return self.email
+
+
+class TenantRegistry:
+    """Keeps a `User` and a `Keka` for every user in `USERS_DB`, built the first time they are needed"""
+
+    def __init__(self, keka_cls: type[Keka] = Keka):
+        self.keka_cls = keka_cls
+        self.tenants: dict[str, Tenant] = {}
+        self.default: Tenant | None = None
+        self.lock = threading.Lock()
+
+
+    def add(self, user: User):
+        tenant = Tenant(user, self.keka_cls(user))
+        with self.lock:
+            self.tenants[user.email] = tenant
+        return tenant
+
+
+    def set_default(self, user: User):
+        self.default = self.add(user)
+        return self.default
+
+
+    def register(self, email: str, passw: str, lat: str, lng: str, tz: str = None):
+        logger.info(f"Registering user {email}")
+        return self.add(User(email, passw, lat, lng, tz=tz))
+
+
+    def get(self, email: str):
+        if email in self.tenants:
+            return self.tenants[email]
+        record = db.read_record(config.USERS_DB, email)
+        if not record:
+            raise KeyError(email)
+        return self.add(User.from_record(record))
+
+
+    def load(self):
+        """Adds the users saved in `USERS_DB` that aren't loaded yet and returns all tenants"""
+        for record in db.read_records(config.USERS_DB):
+            email = record.get("email")
+            if email and email not in self.tenants:
+                try:
+                    self.add(User.from_record(record))
+                except Exception:
+                    logger.exception(f"Couldn't load user {email!r}")
+        return self.all()
+
+
+    def all(self):
+        with self.lock:
+            return list(self.tenants.values())
@@ -1,8 +1,8 @@
 import re
-
-import requests
 import config
 from src import helpers
+from src import geocode
+from src import outbox
 from src.models import *
 from datetime import datetime
 from pytz import timezone, country_timezones
@@ -12,22 +12,36 @@ db = config.DB
 logger = config.LOGGER
 
 class User:
-    def __init__(self, email: str = None, passw: str = None, lat=None, lng=None):
+    def __init__(
+        self, email: str = None, passw: str = None, lat=None, lng=None, tz: str = None, save: bool = True
+    ):
         self.email = email if email else config.KEKA_USERNAME
-        self.passw = passw if passw else config.KEKA_PASSWORD
+        self.passw = passw if passw is not None else config.KEKA_PASSWORD
         self.lat = lat if lat else config.USER_LAT
         self.lng = lng if lng else config.USER_LNG
-        
+        self.tz = tz
+
         self.ntfy_channel = re.sub(r'[\.@_\-]', '_', self.email)
 
         self.location_data = self.get_location(self.lat, self.lng)
 
         self.timezone = timezone(
-            country_timezones(self.location_data.countryCode)[0]
+            tz if tz else country_timezones(self.location_data.countryCode)[0]
         )
 
         self.current_time = datetime.now(self.timezone)
-        self.save_user()
+        if save:
+            self.save_user()
+
+
+    @classmethod
+    def from_record(cls, record: dict):
+        """Builds a user from its `USERS_DB` record without saving it again"""
+        data = DbUser.parse_obj(record)
+        passw = helpers.decrypt_secret(data.secret)
+        if passw is None:
+            logger.warning(f"No password saved for {data.email!r}, token refresh won't be possible")
+        return cls(data.email, passw or "", data.lat, data.lng, tz=data.timezone, save=False)
 
 
     def save_user(self):
@@ -38,10 +52,12 @@ class User:
             lat=self.lat,
             lng=self.lng,
             timestamp=self.current_time.isoformat(),
+            secret=helpers.encrypt_secret(self.passw),
+            timezone=self.tz,
         )
-        db.upsert_record(config.USERS_DB, data.dict(), self.email)
+        db.upsert_record(config.USERS_DB, data.dict(), self.email, defer=True)
         logger.info(f"Saved user {self.email}")
-        logger.info(f"For notifications, subscribe to 'https://ntfy.sh/{self.ntfy_channel}'")
+        logger.info(f"For notifications, subscribe to '{config.NTFY_URL.rstrip('/')}/{self.ntfy_channel}'")
 
 
     def get_user(self):
@@ -53,22 +69,8 @@ class User:
     
     
     def notify(self, data: str, priority: NtfyPriority = NtfyPriority.Default, send_email = True):
-        resp = requests.post(
-            f"https://ntfy.sh/{self.ntfy_channel}", 
-            data=data.encode(encoding='utf-8'),
-            headers={
-                "Email": (None, self.email) [send_email],
-                "Priority": str(priority.value), 
-                "Tags": ("heavy_check_mark", "x") [priority.value > 3],
-            }
-        )
-        if resp.status_code == 200:
-            logger.info(f"Notified user {self.email!r} on 'https://ntfy.sh/{self.ntfy_channel}'")
-        else:
-            logger.error((
-                f"Couldn't notify user {self.email!r}. "
-                f"Received Status Code: {resp.status_code}, Response: {resp.text}"
-            ))
+        # only enqueued, the outbox sends it in the background
+        outbox.notify(self.ntfy_channel, data, priority.value, (None, self.email) [send_email])
 
 
     def get_location(self, lat: str, lng: str):
@@ -78,13 +80,46 @@ class User:
             logger.info(f"Using cached location: {location_data.addressLine1}")
             return location_data
 
+        # the offline index answers in microseconds, nominatim (about a request per second) only refines it
+        # when `GEOCODE_REFINE` is set, or stands in for it when it isn't built
+        location_data = self.get_offline_location(lat, lng)
+        if location_data is None or config.GEOCODE_REFINE:
+            location_data = self.get_online_location(lat, lng) or location_data
+        if location_data is None:
+            # not cached, so that the next start tries again
+            logger.error(f"Unable to reverse geocode location {lat},{lng}")
+            return LocationData()
+
+        db.upsert_record(config.LOCATION_DB, location_data.dict(), f"{lat},{lng}")
+        return location_data
+
+
+    def get_offline_location(self, lat: str, lng: str):
+        index = geocode.get_index()
+        place = index.nearest(float(lat), float(lng)) if index else None
+        if not place or place["distance_km"] > config.GEOCODE_MAX_DISTANCE_KM:
+            return None
+        address = ", ".join(filter(None, (place["place"], place["district"], place["state"], place["postal_code"])))
+        logger.info(f"Using Location: {address} ({place['distance_km']:.1f} km away, offline)")
+        return LocationData(
+            latitude=lat,
+            longitude=lng,
+            zip=place["postal_code"] or None,
+            countryCode=place["country_code"],
+            state=place["state"] or None,
+            city=place["district"] or place["place"],
+            addressLine1=address,
+            addressLine2=place["place"] or None,
+        )
+
+
+    def get_online_location(self, lat: str, lng: str):
         location = helpers.reverse_geocode(lat, lng)
-        address = location.address if location else None
         if not location:
-            logger.error("Unable to reverse geocode location")
-        else:
-            logger.info(f"Using Location: {address}")
-        location_data = LocationData(
+            return None
+        address = location.address
+        logger.info(f"Using Location: {address}")
+        return LocationData(
             latitude=lat,
             longitude=lng,
             zip=location.raw.get("address", {}).get("postcode"),
@@ -93,7 +128,4 @@ class User:
             city=location.raw.get("address", {}).get("city"),
             addressLine1=address,
             addressLine2=location.raw.get("address", {}).get("city"),
-        ) if location else LocationData()
-
-        db.upsert_record(config.LOCATION_DB, location_data.dict(), f"{lat},{lng}")
-        return location_data
+        )